@@ -0,0 +1,208 @@
+""":mod:`benchmarks` --- Micro benchmarks of nirum_wsgi
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Run all benchmarks, or only the given ones:
+
+.. code-block:: bash
+
+   python benchmarks.py
+   python benchmarks.py error_flood
+
+It requires the same environment as tests (i.e., the schema fixture
+has to be installed).
+
+"""
+import argparse
+import datetime
+import json
+import sys
+import timeit
+import typing
+import uuid
+
+from fixture import ComplexKeyMap, Offset, Point, Shape
+from nirum.constructs import NameDict
+from nirum.service import Service
+from werkzeug.test import create_environ
+
+from nirum_wsgi import HealthCheck, LegacyWsgiApp, WsgiApp
+from tests import MusicServiceImpl
+
+
+def start_response(status, headers, exc_info=None):
+    pass
+
+
+def call(app, environ):
+    # Environments having a body are given as functions that make them,
+    # since a body can be read only once.
+    environ = environ() if callable(environ) else dict(environ)
+    for _ in app(environ, start_response):
+        pass
+
+
+def run(app, environs, number):
+    def requests():
+        for environ in environs:
+            call(app, environ)
+    elapsed = timeit.timeit(requests, number=number)
+    return elapsed / (number * len(environs))
+
+
+def bench_error_flood(number):
+    """A flood of misses like what scanners make: unknown paths, disallowed
+    HTTP methods, missing and unknown ``?method=``.
+
+    """
+    app = WsgiApp(MusicServiceImpl())
+    environs = [
+        create_environ('/wp-login.php', method='GET'),
+        create_environ('/.env', method='GET'),
+        create_environ('/artists/damien/', method='DELETE'),
+        create_environ('/', method='POST'),
+        create_environ('/admin/', method='POST'),
+        create_environ('/?method=xmlrpc', method='POST'),
+    ]
+    return run(app, environs, number)
+
+
+def bench_health_check(number):
+    """Liveness and readiness probes of load balancers."""
+    app = WsgiApp(MusicServiceImpl(), health_check=HealthCheck())
+    environs = [
+        create_environ('/_health', method='GET'),
+        create_environ('/_ready', method='GET'),
+    ]
+    return run(app, environs, number)
+
+
+def bench_routing(number):
+    """Requests routed through ``http-resource`` annotations."""
+    app = WsgiApp(MusicServiceImpl())
+    environs = [
+        create_environ('/artists/damien/', method='GET'),
+        create_environ('/artists/damien%20rice/', method='GET'),
+        create_environ('/artists/damien/', method='OPTIONS'),
+    ]
+    return run(app, environs, number)
+
+
+class RecordService(Service):
+    """A service whose method takes many arguments including nested
+    records, written in the way Nirum compiler generates.
+
+    """
+
+    __nirum_service_methods__ = {
+        'put_records': {
+            '_v': 2,
+            '_return': lambda: type(None),
+            '_names': NameDict([
+                ('name', 'name'), ('count', 'count'), ('ratio', 'ratio'),
+                ('enabled', 'enabled'), ('day', 'day'), ('token', 'token'),
+                ('note', 'note'), ('points', 'points'),
+                ('key_map', 'key_map'), ('shape', 'shape'),
+            ]),
+            'name': lambda: typing.Text,
+            'count': lambda: int,
+            'ratio': lambda: float,
+            'enabled': lambda: bool,
+            'day': lambda: datetime.date,
+            'token': lambda: uuid.UUID,
+            'note': lambda: typing.Optional[typing.Text],
+            'points': lambda: typing.Sequence[Point],
+            'key_map': lambda: ComplexKeyMap,
+            'shape': lambda: Shape,
+        },
+        'get_points': {
+            '_v': 2,
+            '_return': lambda: typing.Sequence[Point],
+            '_names': NameDict([]),
+        },
+    }
+    __nirum_method_names__ = NameDict([('put_records', 'put_records'),
+                                       ('get_points', 'get_points')])
+    __nirum_method_annotations__ = {'put_records': {}, 'get_points': {}}
+
+    def put_records(self, **kwargs):
+        pass
+
+    def get_points(self):
+        return [Point(left=Offset(float(i)), top=Offset(0.0))
+                for i in range(50)]
+
+
+POINT = {'_type': 'point', 'x': 1.5, 'top': 2.5}
+RECORDS = json.dumps({
+    'name': u'records',
+    'count': 3,
+    'ratio': 0.5,
+    'enabled': True,
+    'day': '2018-05-25',
+    'token': str(uuid.UUID(int=1)),
+    'note': None,
+    'points': [POINT] * 10,
+    'key_map': {
+        '_type': 'complex_key_map',
+        'value': [
+            {'key': dict(POINT, x=i), 'value': POINT} for i in range(10)
+        ],
+    },
+    'shape': {'_type': 'shape', '_tag': 'circle', 'origin': POINT,
+              'radius': 3.0},
+})
+
+
+def bench_legacy_arguments(number):
+    """Calls of a method with many arguments including nested records
+    through :class:`~nirum_wsgi.LegacyWsgiApp`.
+
+    """
+    app = LegacyWsgiApp(RecordService())
+    environs = [
+        lambda: create_environ('/?method=put_records', method='POST',
+                               data=RECORDS),
+    ]
+    return run(app, environs, number)
+
+
+def bench_legacy_results(number):
+    """Calls of a method returning a list of records through
+    :class:`~nirum_wsgi.LegacyWsgiApp`, which validates results.
+
+    """
+    app = LegacyWsgiApp(RecordService())
+    environs = [
+        lambda: create_environ('/?method=get_points', method='POST'),
+    ]
+    return run(app, environs, number)
+
+
+BENCHMARKS = {
+    name[len('bench_'):]: function
+    for name, function in globals().items()
+    if name.startswith('bench_')
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--number', type=int, default=2000,
+                        help='the number of iterations of each benchmark')
+    parser.add_argument('benchmarks', nargs='*',
+                        help='benchmarks to run; all by default.  '
+                             'choices: ' + ', '.join(sorted(BENCHMARKS)))
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error('no such benchmark: ' + name)
+    for name in args.benchmarks or sorted(BENCHMARKS):
+        seconds = BENCHMARKS[name](args.number)
+        print('{0}: {1:.1f} us/request, {2:.0f} requests/s'.format(
+            name, seconds * 1e6, 1 / seconds
+        ))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,35 +4,98 @@
 
 """
 import argparse
+import atexit
+import base64
+import bisect
+import codecs
 import collections
+import copy
+import datetime
+import decimal
+import enum
+import functools
+import hashlib
+import heapq
+import hmac
+import inspect
+import io
 import itertools
 import json
 import logging
+import math
+import mmap
+import multiprocessing
+import numbers
 import os
+import random
 import re
+import signal
+import socket
+import struct
 import sys
+import tempfile
+import threading
+import time
 import typing
+import uuid
+import weakref
 
 from nirum._compat import get_union_types, is_union_type
-from nirum.datastructures import List
-from nirum.deserialize import deserialize_meta
+from nirum.datastructures import List, Map
+from nirum.deserialize import (deserialize_meta, deserialize_primitive,
+                               is_support_abstract_type)
 from nirum.serialize import serialize_meta
 from nirum.service import Service
-from six import integer_types, text_type
-from six.moves import reduce
+from six import integer_types, reraise, string_types, text_type
+from six.moves import queue, reduce, reprlib
 from six.moves.urllib import parse as urlparse
 from werkzeug.http import HTTP_STATUS_CODES
-from werkzeug.serving import run_simple
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler, run_simple
+from werkzeug.test import create_environ
 from werkzeug.wrappers import Request, Response
+from werkzeug.wsgi import ClosingIterator, LimitedStream, wrap_file
 
-__version__ = '0.3.1'
+try:
+    import asyncio
+    import concurrent.futures
+except ImportError:
+    asyncio = None
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    from opentelemetry import trace as opentelemetry_trace
+except ImportError:
+    opentelemetry_trace = None
+
+__version__ = '0.4.0'
 __all__ = (
-    'AnnotationError', 'InvalidJsonError',
+    'AccessLog', 'AnnotationError', 'ArgumentStream', 'ArgumentStreamError',
+    'ArgumentStreaming', 'Benchmark', 'BenchmarkResult', 'BinaryResponses',
+    'BinaryUploads', 'BulkCalls', 'CompositeWsgiApp',
+    'ContextualAwaitable', 'CoroutineRunner', 'CoroutineTimeoutError',
+    'DeadlinePolicy',
+    'FileIdempotencyStore', 'FileSpanExporter', 'HealthCheck',
+    'IdempotencyPolicy',
+    'IdempotencyStore', 'Metrics',
+    'InvalidJsonError', 'LoadShedder', 'MemoryIdempotencyStore',
     'MethodArgumentError', 'MethodDispatch', 'MethodDispatchError',
-    'PathMatch', 'ServiceMethodError',
+    'OpenTelemetryIdGenerator', 'OpenTelemetrySpanExporter', 'PathMatch',
+    'PayloadLimitError', 'PayloadLimits', 'QueueLogHandler',
+    'RequestContext', 'ServiceMethodError',
+    'SingleFlight', 'SingleFlightTimeoutError', 'SlowRequest',
+    'SlowRequestTracker', 'Span', 'SpanExporter', 'StoredResponse',
+    'ThreadPoolServer', 'TraceContext', 'Tracing',
+    'TrafficCapture', 'TrafficReplayResult',
     'UriTemplateMatchResult', 'UriTemplateMatcher',
-    'WsgiApp',
-    'is_optional_type', 'match_request', 'parse_json_payload',
+    'WorkerSupervisor', 'WsgiApp',
+    'check_payload_length', 'compile_deserializer', 'compile_serializer',
+    'current_request_context',
+    'encode_response', 'is_optional_type', 'percentile',
+    'load_traffic', 'match_request', 'parse_json_payload', 'parse_traceparent',
+    'remaining_file_size', 'replay_traffic', 'resident_set_size', 'sort_rules',
+    'truncated_repr',
 )
 MethodDispatch = collections.namedtuple('MethodDispatch', [
     'request', 'routed', 'service_method',
@@ -44,6 +107,24 @@ PathMatch = collections.namedtuple('PathMatch', [
 UriTemplateRule = collections.namedtuple('UriTemplateRule', [
     'uri_template', 'matcher', 'verb', 'name'
 ])
+StoredResponse = collections.namedtuple('StoredResponse', [
+    'fingerprint', 'status_code', 'headers', 'content'
+])
+SlowRequest = collections.namedtuple('SlowRequest', [
+    'started_at', 'duration', 'http_method', 'path', 'service_method',
+    'route', 'status_code', 'argument_size', 'phases'
+])
+ERROR_TAGS = {
+    status_code: text.lower().replace(' ', '_')
+    for status_code, text in HTTP_STATUS_CODES.items()
+}
+JSON_RESPONSE_HEADERS = (('Content-type', 'application/json'),)
+BINARY_RESPONSE_HEADERS = (('Content-type', 'application/octet-stream'),)
+BULK_RESPONSE_HEADERS = (('Content-type', 'application/x-ndjson'),)
+DEADLINE_EXPIRED_MESSAGE = 'The deadline of the request has already passed.'
+LOOPBACK_ADDRESSES = frozenset(['127.0.0.1', '::1'])
+# Python 2 has no awaitables.
+_isawaitable = getattr(inspect, 'isawaitable', None)
 
 
 def is_optional_type(type_):
@@ -51,86 +132,3638 @@ def is_optional_type(type_):
     return is_union_type(type_) and type(None) in get_union_types(type_)
 
 
-def match_request(rules, request_method, path_info, querystring):
-    # Ignore root path.
-    if path_info == '/':
-        return None, None
-    matched_verb = []
-    match = None
-    request_rules = sorted(rules, key=lambda x: x[1].names, reverse=True)
-    for rule in request_rules:
-        if isinstance(path_info, bytes):
-            # FIXME Decode properly; URI is not unicode
-            path_info = path_info.decode()
-        variable_match = rule.matcher.match_path(path_info)
-        querystring_match = True
-        if querystring:
-            querystring_match = rule.matcher.match_querystring(querystring)
-            if querystring_match:
-                variable_match.update(querystring_match)
-        verb = rule.verb.upper()
-        if variable_match and querystring_match:
-            matched_verb.append(verb)
-            if request_method in (rule.verb, 'OPTIONS') and \
-                    match is None:
-                match = PathMatch(match_group=variable_match, verb=verb,
-                                  method_name=rule.name)
-    return match, matched_verb
+def compile_deserializer(cls, _cache=None):
+    """Compile a function which deserializes JSON-decoded data to the given
+    type like :func:`nirum.deserialize.deserialize_meta()` does, but which
+    has already figured out how to deserialize the type and its fields,
+    elements, and variants.  Invalid data is rejected with the same error
+    as :func:`~nirum.deserialize.deserialize_meta()` raises.
+
+    Types it doesn't know how to compile are deserialized through
+    :func:`~nirum.deserialize.deserialize_meta()` as they are.
+
+    :param cls: The type to deserialize to.
+    :return: A function which takes JSON-decoded data and returns
+             a deserialized value.
+    :rtype: :class:`~typing.Callable`
+
+    """
+    if _cache is None:
+        _cache = {}
+    try:
+        return _cache[cls]
+    except KeyError:
+        pass
+    if hasattr(cls, '__nirum_tag__') or hasattr(cls, 'Tag'):
+        deserializer = _compile_union_deserializer(cls, _cache)
+    elif hasattr(cls, '__nirum_record_behind_name__'):
+        deserializer = _compile_record_deserializer(cls, _cache)
+    elif (hasattr(cls, '__nirum_get_inner_type__') or
+          hasattr(cls, '__nirum_inner_type__')):
+        deserializer = _compile_unboxed_deserializer(cls, _cache)
+    elif type(cls) is getattr(typing, 'TupleMeta', None):
+        deserializer = None
+    elif is_support_abstract_type(cls):
+        deserializer = _compile_abstract_deserializer(cls, _cache)
+    elif is_optional_type(cls):
+        deserializer = _compile_optional_deserializer(cls, _cache)
+    elif cls in (int, float, bool, uuid.UUID):
+        deserializer = cls
+    elif cls is numbers.Integral:
+        deserializer = _identity
+    elif cls is text_type:
+        deserializer = _deserialize_text
+    elif cls in (datetime.datetime, datetime.date, decimal.Decimal):
+        deserializer = functools.partial(deserialize_primitive, cls)
+    elif isinstance(cls, enum.EnumMeta):
+        deserializer = cls
+    else:
+        deserializer = None
+    if deserializer is None:
+        deserializer = functools.partial(deserialize_meta, cls)
+    _cache[cls] = deserializer
+    return deserializer
+
+
+def _identity(value):
+    return value
+
+
+def _deserialize_text(data):
+    if not isinstance(data, text_type):
+        raise ValueError("'{}' is not a string.".format(data))
+    return text_type(data)
+
+
+def _compile_union_deserializer(cls, cache):
+    if hasattr(cls, '__nirum_tag__'):
+        variants = None
+        classes = [cls]
+    else:
+        classes = cls.__subclasses__()
+        if not all(hasattr(c, '__nirum_tag__') for c in classes):
+            return None
+        variants = {}
+        for variant in classes:
+            variants.setdefault(variant.__nirum_tag__.value, variant)
+    fields = {}
+
+    def deserialize(value):
+        if '_type' not in value:
+            raise ValueError('"_type" field is missing.')
+        if '_tag' not in value:
+            raise ValueError('"_tag" field is missing.')
+        if variants is None:
+            variant = cls
+        else:
+            try:
+                variant = variants[value['_tag']]
+            except (KeyError, TypeError):
+                raise ValueError(
+                    '{0!r} is not deserialzable tag of `{1}`.'.format(
+                        value, typing._type_repr(cls)
+                    )
+                )
+        if not variant.__nirum_union_behind_name__ == value['_type']:
+            raise ValueError('{0} expect "_type" equal to'
+                             ' "{1.__nirum_union_behind_name__}"'
+                             ', but found {2}.'.format(
+                                 typing._type_repr(variant), variant,
+                                 value['_type']
+                             ))
+        if not variant.__nirum_tag__.value == value['_tag']:
+            # The message is the same as deserialize_union_type() of nirum
+            # (including the unused argument) so that both behave the same.
+            raise ValueError('{0} expect "_tag" equal to'  # noqa: F523
+                             ' "{1.__nirum_tag__.value}"'
+                             ', but found {1}.'.format(
+                                 typing._type_repr(variant), variant,
+                                 value['_tag']
+                             ))
+        behind_names, deserializers = fields[variant]
+        args = {}
+        for attribute_name, item in value.items():
+            if attribute_name in ('_type', '_tag'):
+                continue
+            if attribute_name in behind_names:
+                name = behind_names[attribute_name]
+            else:
+                name = attribute_name
+            args[name] = deserializers[name](item)
+        return variant(**args)
+    # Registered before compiling fields, since they can refer to the union
+    # itself.
+    cache[cls] = deserialize
+    for variant in classes:
+        tag_types = variant.__nirum_tag_types__
+        if callable(tag_types):  # old compiler could generate non-callable map
+            tag_types = dict(tag_types())
+        fields[variant] = (
+            variant.__nirum_tag_names__.behind_names,
+            {
+                name: compile_deserializer(type_, cache)
+                for name, type_ in tag_types.items()
+            }
+        )
+    return deserialize
+
+
+def _compile_record_deserializer(cls, cache):
+    behind_name = cls.__nirum_record_behind_name__
+    behind_names = cls.__nirum_field_names__.behind_names
+    deserializers = {}
+
+    def deserialize(value):
+        if '_type' not in value:
+            raise ValueError('"_type" field is missing.')
+        if not behind_name == value['_type']:
+            raise ValueError(
+                '{0} expect "_type" equal to '
+                '"{1.__nirum_record_behind_name__}", but found {2}.'.format(
+                    typing._type_repr(cls),
+                    cls, value['_type']
+                )
+            )
+        args = {}
+        for attribute_name, item in value.items():
+            if attribute_name == '_type':
+                continue
+            if attribute_name in behind_names:
+                name = behind_names[attribute_name]
+            else:
+                name = attribute_name
+            args[name] = deserializers[name](item)
+        return cls(**args)
+    # Registered before compiling fields, since they can refer to the record
+    # itself.
+    cache[cls] = deserialize
+    field_types = cls.__nirum_field_types__
+    if callable(field_types):
+        # old compiler could generate non-callable dictionary
+        field_types = field_types()
+    for name, type_ in field_types.items():
+        deserializers[name] = compile_deserializer(type_, cache)
+    return deserialize
+
+
+def _compile_unboxed_deserializer(cls, cache):
+    try:
+        inner_type = cls.__nirum_get_inner_type__()
+    except AttributeError:
+        inner_type = cls.__nirum_inner_type__
+    deserialize_inner = getattr(inner_type, '__nirum_deserialize__', None)
+    if not deserialize_inner:
+        deserialize_inner = compile_deserializer(inner_type, cache)
+
+    def deserialize(value):
+        return cls(value=deserialize_inner(value))
+    return deserialize
+
+
+def _compile_abstract_deserializer(cls, cache):
+    origin = cls.__origin__ or cls
+    if origin in (typing.Sequence, typing.List):
+        container = list
+    elif origin in (typing.Set, typing.AbstractSet):
+        container = set
+    elif origin is typing.Mapping:
+        container = Map
+    else:
+        return None
+    type_params = getattr(cls, '__args__', None)
+    if not isinstance(type_params, tuple) or \
+       any(isinstance(t, typing.TypeVar) for t in type_params):
+        return None
+    if len(type_params) == 1 and container is not Map:
+        deserialize_element = compile_deserializer(type_params[0], cache)
+
+        def deserialize(data):
+            return container(deserialize_element(d) for d in data)
+        return deserialize
+    elif len(type_params) != 2 or container is not Map:
+        return None
+    deserialize_key = compile_deserializer(type_params[0], cache)
+    deserialize_value = compile_deserializer(type_params[1], cache)
+
+    def parse_pair(pair):
+        if not isinstance(pair, collections.Mapping):
+            raise ValueError('map item must be a JSON object')
+        try:
+            key = pair['key']
+            value = pair['value']
+        except KeyError:
+            raise ValueError('map item must consist of "key" and "value" '
+                             'fields e.g. {"key": ..., "value": ...}')
+        return deserialize_key(key), deserialize_value(value)
+
+    def deserialize_map(data):
+        if not isinstance(data, collections.Sequence):
+            raise ValueError('map must be an array of item objects e.g. '
+                             '[{"key": ..., "value": ...}, ...]')
+        return Map(map(parse_pair, data))
+    return deserialize_map
+
+
+def _compile_optional_deserializer(cls, cache):
+    deserializers = []
+    for type_ in get_union_types(cls):
+        try:
+            if isinstance(None, type_):
+                continue
+        except TypeError:
+            # deserialize_meta() fails at run time for such types as well.
+            return None
+        deserializers.append(compile_deserializer(type_, cache))
+
+    def deserialize(data):
+        if data is None:
+            return data
+        for deserialize_type in deserializers:
+            try:
+                return deserialize_type(data)
+            except ValueError:
+                continue
+        raise ValueError()
+    return deserialize
+
+
+def compile_serializer(cls, _cache=None):
+    """Compile a function which serializes values of the given type to
+    JSON-ready data like :func:`nirum.serialize.serialize_meta()` does, but
+    which has already figured out how to serialize the type and its
+    elements.  Values of unexpected types, e.g., invalid return values,
+    are serialized through :func:`~nirum.serialize.serialize_meta()`
+    as they are, so that the result is always the same.
+
+    :param cls: The type to serialize values of.
+    :return: A function which takes a value and returns JSON-ready data.
+    :rtype: :class:`~typing.Callable`
+
+    """
+    if _cache is None:
+        _cache = {}
+    try:
+        return _cache[cls]
+    except KeyError:
+        pass
+    if hasattr(cls, '__nirum_serialize__'):
+        serializer = _compile_nirum_type_serializer(cls)
+    elif is_support_abstract_type(cls):
+        serializer = _compile_abstract_serializer(cls, _cache)
+    elif is_optional_type(cls):
+        serializer = _compile_optional_serializer(cls, _cache)
+    elif cls in _SCALAR_TYPES or cls is numbers.Integral:
+        serializer = _serialize_scalar
+    elif cls in (datetime.datetime, datetime.date):
+        serializer = _serialize_datetime
+    elif cls in (decimal.Decimal, uuid.UUID):
+        serializer = _serialize_as_str
+    else:
+        serializer = None
+    if serializer is None:
+        serializer = serialize_meta
+    _cache[cls] = serializer
+    return serializer
+
+
+_SCALAR_TYPES = frozenset(string_types + integer_types + (bool, float))
+
+
+def _serialize_scalar(value):
+    if type(value) in _SCALAR_TYPES:
+        return value
+    return serialize_meta(value)
+
+
+def _serialize_datetime(value):
+    if type(value) in (datetime.datetime, datetime.date):
+        return value.isoformat()
+    return serialize_meta(value)
+
+
+def _serialize_as_str(value):
+    if type(value) in (decimal.Decimal, uuid.UUID):
+        return str(value)
+    return serialize_meta(value)
+
+
+def _compile_nirum_type_serializer(cls):
+    def serialize(value):
+        if isinstance(value, cls):
+            return value.__nirum_serialize__()
+        return serialize_meta(value)
+    return serialize
+
+
+def _compile_abstract_serializer(cls, cache):
+    origin = cls.__origin__ or cls
+    if origin in (typing.Sequence, typing.List):
+        types = list, tuple, List
+    elif origin in (typing.Set, typing.AbstractSet):
+        types = set, frozenset
+    elif origin is typing.Mapping:
+        types = dict, Map
+    else:
+        return None
+    type_params = getattr(cls, '__args__', None)
+    if not isinstance(type_params, tuple) or \
+       any(isinstance(t, typing.TypeVar) for t in type_params):
+        return None
+    if len(type_params) == 1 and Map not in types:
+        serialize_element = compile_serializer(type_params[0], cache)
+
+        def serialize(value):
+            if type(value) in types:
+                return [serialize_element(e) for e in value]
+            return serialize_meta(value)
+        return serialize
+    elif len(type_params) != 2 or Map not in types:
+        return None
+    serialize_key = compile_serializer(type_params[0], cache)
+    serialize_value = compile_serializer(type_params[1], cache)
+
+    def serialize_map(value):
+        if type(value) in types:
+            return [
+                {'key': serialize_key(k), 'value': serialize_value(v)}
+                for k, v in value.items()
+            ]
+        return serialize_meta(value)
+    return serialize_map
+
+
+def _compile_optional_serializer(cls, cache):
+    none_type = type(None)
+    types = [t for t in get_union_types(cls) if t is not none_type]
+    if len(types) != 1:
+        return None
+    serialize_type = compile_serializer(types[0], cache)
+
+    def serialize(value):
+        if value is None:
+            return None
+        return serialize_type(value)
+    return serialize
+
+
+def sort_rules(rules):
+    """Sort the given routing rules in the order :func:`match_request()`
+    tries them, i.e., rules having more variables first.
+
+    :param rules: The routing rules to sort.
+    :type rules: :class:`~typing.Iterable`\\ [:class:`UriTemplateRule`]
+    :return: The sorted rules.
+    :rtype: :class:`~typing.Sequence`\\ [:class:`UriTemplateRule`]
+
+    """
+    return sorted(rules, key=lambda x: x[1].names, reverse=True)
+
+
+def match_request(rules, request_method, path_info, querystring,
+                  presorted=False):
+    # Ignore root path.
+    if path_info == '/':
+        return None, None
+    if isinstance(path_info, bytes):
+        # FIXME Decode properly; URI is not unicode
+        path_info = path_info.decode()
+    matched_verb = []
+    match = None
+    for rule in rules if presorted else sort_rules(rules):
+        variable_match = rule.matcher.match_path(path_info)
+        if not variable_match:
+            continue
+        if querystring:
+            querystring_match = rule.matcher.match_querystring(querystring)
+            if not querystring_match:
+                continue
+            variable_match.update(querystring_match)
+        verb = rule.verb.upper()
+        matched_verb.append(verb)
+        if match is None and request_method in (rule.verb, 'OPTIONS'):
+            match = PathMatch(variable_match, verb, rule.name)
+    return match, matched_verb
+
+
+def check_payload_length(request, limits=None):
+    """Check the ``Content-Length`` of the request against
+    :attr:`PayloadLimits.max_length` before reading the payload.
+
+    :raise PayloadLimitError: When the payload is too long.
+
+    """
+    if limits is not None and limits.max_length is not None and \
+       (request.content_length or 0) > limits.max_length:
+        raise PayloadLimitError(
+            413, '', 'The payload must not be longer than {0} bytes.'.format(
+                limits.max_length
+            )
+        )
+
+
+def parse_json_payload(request, limits=None):
+    check_payload_length(request, limits)
+    payload = request.get_data(as_text=True)
+    if payload:
+        try:
+            json_payload = json.loads(payload)
+        except (TypeError, ValueError):
+            raise InvalidJsonError(payload)
+        except RuntimeError:
+            # RecursionError on Python 3.5+.
+            if limits is None:
+                raise
+            raise PayloadLimitError(400, '', limits.depth_message)
+        if limits is not None:
+            limits.check(json_payload)
+        return json_payload
+    else:
+        return {}
+
+
+class InvalidJsonError(ValueError):
+    """Exception raised when a payload is not a valid JSON."""
+
+
+class AnnotationError(ValueError):
+    """Exception raised when the given Nirum annotation is invalid."""
+
+
+class ServiceMethodError(LookupError):
+    """Exception raised when a method is not found."""
+
+
+class MethodDispatchError(ValueError):
+    """Exception raised when failed to dispatch method."""
+
+    def __init__(self, request, status_code, message=None,
+                 *args, **kwargs):
+        self.request = request
+        self.status_code = status_code
+        self.message = message
+        #: (:class:`~typing.AbstractSet`\\ [:class:`~typing.Tuple`\\
+        #: [:class:`str`, :class:`str`]]) Pairs of paths and messages of
+        #: errors in the payload, if any.
+        self.errors = kwargs.pop('errors', None)
+        super(MethodDispatchError, self).__init__(*args, **kwargs)
+
+
+class MethodArgumentError(ValueError):
+    """An exception type raised when the given method arguments are invalid."""
+
+    def __init__(self):
+        self.errors = set()
+        super(MethodArgumentError, self).__init__('')
+
+    def on_error(self, field, message):
+        self.errors.add((field, message))
+        line = '{0}: {1}'.format(field, message)
+        if self.args[0]:
+            line = '{0}\n{1}'.format(self.args[0], line)
+        self.args = (line,)
+
+    def raise_if_errored(self):
+        if self.errors:
+            raise self
+
+
+class PayloadLimitError(MethodArgumentError):
+    """Exception raised when a payload exceeds :class:`PayloadLimits`.
+
+    .. attribute:: status_code
+
+       The HTTP status code to respond with: 400 for too deep payloads,
+       and 413 for too large ones.
+
+    """
+
+    def __init__(self, status_code, field, message):
+        super(PayloadLimitError, self).__init__()
+        self.status_code = status_code
+        self.on_error(field, message)
+
+
+class PayloadLimits(object):
+    """Limit the complexity of JSON payloads so that the CPU time to parse
+    and deserialize a request is bounded.  Payloads exceeding the limits
+    are responded with ``400 Bad Request`` (too deep) or ``413 Payload Too
+    Large`` (too many elements or too long), along with the path of
+    the offending value.
+
+    Limits of :const:`None` are not checked.
+
+    Note that only ``max_length`` bounds the cost to parse a payload,
+    since the other limits are checked after the payload is parsed
+    (except that payloads too deep to be parsed are rejected too).
+    Don't turn it off unless the payload size is bounded by other means,
+    e.g., by the web server.
+
+    :param max_depth: The maximum nesting depth of arrays and objects.
+                      The arguments object itself is of depth 1.
+    :type max_depth: :class:`int`
+    :param max_elements: The maximum number of values in total, including
+                         arrays, objects, and the arguments object itself.
+    :type max_elements: :class:`int`
+    :param max_string_length: The maximum length of strings, including
+                              object keys.
+    :type max_string_length: :class:`int`
+    :param max_length: The maximum number of bytes of the payload.  It's
+                       checked before the payload is read.  16 MiB by
+                       default.
+    :type max_length: :class:`int`
+
+    """
+
+    def __init__(self, max_depth=32, max_elements=100000,
+                 max_string_length=1048576, max_length=16777216):
+        self.max_depth = max_depth
+        self.max_elements = max_elements
+        self.max_string_length = max_string_length
+        self.max_length = max_length
+        self.depth_message = 'Exceeded the maximum depth ({0}).'.format(
+            max_depth
+        )
+
+    def check(self, payload):
+        """Check the given JSON-decoded ``payload``.
+
+        :raise PayloadLimitError: When the payload exceeds the limits.
+
+        """
+        max_depth = self.max_depth
+        max_elements = self.max_elements
+        max_string_length = self.max_string_length
+        elements = 1
+        # Paths are linked lists of (parent, key) pairs, which are formatted
+        # only when a limit is exceeded.
+        stack = [(payload, None, 1)]
+        while stack:
+            value, path, depth = stack.pop()
+            if isinstance(value, dict):
+                items = value.items()
+            elif isinstance(value, list):
+                items = enumerate(value)
+            else:
+                if max_string_length is not None and \
+                   isinstance(value, string_types) and \
+                   len(value) > max_string_length:
+                    raise PayloadLimitError(
+                        413, self._format_path(path),
+                        'Exceeded the maximum string length ({0}).'.format(
+                            max_string_length
+                        )
+                    )
+                continue
+            if max_depth is not None and depth > max_depth:
+                raise PayloadLimitError(400, self._format_path(path),
+                                        self.depth_message)
+            elements += len(value)
+            if max_elements is not None and elements > max_elements:
+                raise PayloadLimitError(
+                    413, self._format_path(path),
+                    'Exceeded the maximum number of elements ({0}).'.format(
+                        max_elements
+                    )
+                )
+            for key, item in items:
+                if max_string_length is not None and \
+                   isinstance(key, string_types) and \
+                   len(key) > max_string_length:
+                    raise PayloadLimitError(
+                        413, self._format_path((path, key)),
+                        'Exceeded the maximum string length ({0}).'.format(
+                            max_string_length
+                        )
+                    )
+                stack.append((item, (path, key), depth + 1))
+
+    @staticmethod
+    def _format_path(path):
+        keys = []
+        while path is not None:
+            path, key = path
+            keys.append(key)
+        return ''.join(
+            '[{0}]'.format(key) if isinstance(key, integer_types)
+            else '.' + key
+            for key in reversed(keys)
+        )
+
+
+class ArgumentStreamError(MethodArgumentError):
+    """Exception raised by :class:`ArgumentStream` when an element is
+    invalid or the payload is malformed.  If a service method lets it
+    propagate, the request is responded with ``400 Bad Request``.
+
+    """
+
+    def __init__(self, field, message):
+        super(ArgumentStreamError, self).__init__()
+        self.on_error(field, message)
+
+
+class ArgumentStreaming(object):
+    """Decode the list argument of the given methods incrementally from
+    the request body, and pass it to the methods as a lazy iterator
+    (:class:`ArgumentStream`) of deserialized elements instead of a list,
+    so that memory usage stays flat regardless of the payload size.
+
+    Each of the methods has to take exactly one parameter, which is of
+    a list type (i.e., ``[T]``), and its payload has to consist of only
+    the argument, e.g., ``{"records": [...]}``.
+
+    :param methods: The facial names (i.e., names in Python) of methods
+                    to stream arguments.
+    :type methods: :class:`~typing.AbstractSet`\\ [:class:`str`]
+    :param chunk_size: The number of bytes to read from the request body
+                       at a time.
+    :type chunk_size: :class:`int`
+    :param max_element_size: The maximum number of characters of
+                             an element.  A larger element makes
+                             the stream invalid.
+    :type max_element_size: :class:`int`
+
+    """
+
+    def __init__(self, methods, chunk_size=65536, max_element_size=1048576):
+        if isinstance(methods, string_types):
+            raise TypeError('methods must be a set of method names, not ' +
+                            repr(methods))
+        self.methods = frozenset(methods)
+        self.chunk_size = chunk_size
+        self.max_element_size = max_element_size
+
+
+class ArgumentStream(object):
+    """A lazy iterator of the elements of a list argument, decoded
+    incrementally from the request body.  See also :class:`ArgumentStreaming`.
+
+    An invalid element raises :exc:`ArgumentStreamError`, and the stream
+    can be iterated further to skip it.  A malformed payload raises
+    :exc:`ArgumentStreamError` as well, but ends the stream, and the request
+    is responded with ``400 Bad Request`` even if the service method
+    ignores it.
+
+    """
+
+    _json_decoder = json.JSONDecoder()
+    _whitespace = re.compile(r'[ \t\n\r]*')
+
+    def __init__(self, stream, behind_name, type_name, deserialize,
+                 chunk_size=65536, max_element_size=1048576):
+        self._stream = stream
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._buffer = u''
+        self._pos = 0
+        self._eof = False
+        self._done = False
+        self._index = 0
+        #: (:class:`ArgumentStreamError`) The error which ended the stream
+        #: due to a malformed payload, if any.
+        self.error = None
+        self._behind_name = behind_name
+        self._path = '.' + behind_name
+        self._type_name = type_name
+        self._deserialize = deserialize
+        self._chunk_size = chunk_size
+        self._max_element_size = max_element_size
+
+    def start(self):
+        """Read the payload until the beginning of the list.  It's called
+        before the service method is called.
+
+        :raise ArgumentStreamError: When the payload is malformed or
+                                    doesn't have the argument.
+
+        """
+        try:
+            self._expect(u'{')
+            if self._peek() == u'}':
+                raise ArgumentStreamError(self._path, 'Expected to exist.')
+            key = self._decode_value(self._path)
+            if key != self._behind_name:
+                raise ArgumentStreamError(
+                    '', 'Expected only the {0} argument.'.format(self._path)
+                )
+            self._expect(u':')
+            if self._peek() != u'[':
+                raise ArgumentStreamError(
+                    self._path, 'Expected {0}.'.format(self._type_name)
+                )
+            self._pos += 1
+        except ArgumentStreamError as e:
+            self._done = True
+            self.error = e
+            raise
+        except ValueError:
+            self._done = True
+            self.error = ArgumentStreamError('', 'Invalid JSON payload.')
+            raise self.error
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._done:
+            raise StopIteration()
+        path = '{0}[{1}]'.format(self._path, self._index)
+        try:
+            if self._peek() == u']':
+                self._pos += 1
+                self._expect(u'}')
+                self._done = True
+                raise StopIteration()
+            if self._index:
+                self._expect(u',')
+                self._peek()
+            data = self._decode_value(path)
+        except ArgumentStreamError as e:
+            self._done = True
+            self.error = e
+            raise
+        except ValueError:
+            self._done = True
+            self.error = ArgumentStreamError(path, 'Invalid JSON payload.')
+            raise self.error
+        self._index += 1
+        try:
+            return self._deserialize(data)
+        except (TypeError, ValueError):
+            raise ArgumentStreamError(
+                path,
+                'Expected {0}, but {1} was given.'.format(
+                    self._type_name, typing._type_repr(type(data))
+                )
+            )
+
+    next = __next__
+
+    def _fill(self):
+        if self._eof:
+            return False
+        # Drop the consumed part so that the buffer doesn't grow.
+        buffer_ = self._buffer[self._pos:]
+        self._pos = 0
+        chunk = self._stream.read(self._chunk_size)
+        if chunk:
+            self._buffer = buffer_ + self._decoder.decode(chunk)
+        else:
+            self._eof = True
+            self._buffer = buffer_ + self._decoder.decode(b'', True)
+        return True
+
+    def _peek(self):
+        # Skip whitespaces and return the next character, or an empty
+        # string if it reached the end.
+        while True:
+            self._pos = self._whitespace.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer) or not self._fill():
+                return self._buffer[self._pos:self._pos + 1]
+
+    def _expect(self, char):
+        if self._peek() != char:
+            raise ValueError('expected ' + char)
+        self._pos += 1
+
+    def _decode_value(self, path):
+        while True:
+            try:
+                value, end = self._json_decoder.raw_decode(self._buffer,
+                                                           self._pos)
+            except ValueError:
+                if self._eof:
+                    raise
+            else:
+                # A value reaching the end of the buffer can be cut off,
+                # e.g., a number.
+                if end < len(self._buffer) or self._eof:
+                    self._pos = end
+                    return value
+            if len(self._buffer) - self._pos > self._max_element_size:
+                raise ArgumentStreamError(
+                    path,
+                    'Exceeded the maximum element size ({0}).'.format(
+                        self._max_element_size
+                    )
+                )
+            self._fill()
+
+
+class BinaryResponses(object):
+    """Respond with results of methods returning ``binary`` as they are,
+    instead of base64-encoded JSON strings.  The response body is
+    ``application/octet-stream`` with ``Content-Length``.
+
+    Methods can return a file-like object instead of :class:`bytes` as
+    well.  It's sent through ``wsgi.file_wrapper`` if the server provides
+    it (e.g., for :func:`os.sendfile()`), and closed afterward.
+
+    :param methods: The facial names (i.e., names in Python) of methods
+                    which always respond with raw binary.
+    :type methods: :class:`~typing.AbstractSet`\\ [:class:`str`]
+    :param negotiate: Respond with raw binary for any method returning
+                      ``binary`` if a request prefers
+                      ``application/octet-stream`` to ``application/json``
+                      through its ``Accept`` header.
+    :type negotiate: :class:`bool`
+    :param block_size: The number of bytes to read from a file-like result
+                       at a time.
+    :type block_size: :class:`int`
+
+    """
+
+    def __init__(self, methods=frozenset(), negotiate=True, block_size=65536):
+        if isinstance(methods, string_types):
+            raise TypeError('methods must be a set of method names, not ' +
+                            repr(methods))
+        self.methods = frozenset(methods)
+        self.negotiate = negotiate
+        self.block_size = block_size
+
+
+class BulkCalls(object):
+    """Let the given methods be called in bulk: a request body of
+    ``application/x-ndjson`` consists of newline-delimited JSON objects of
+    arguments, and the method is called with each of them in order.
+    Requests of other content types are handled as usual.
+
+    The response is streamed as ``application/x-ndjson`` as well, a line per
+    call in the same order, e.g., ``{"status": 200, "result": ...}`` or
+    ``{"status": 400, "error": {...}}``, so that memory usage stays flat
+    regardless of the number of calls.  Calls are neither coalesced nor
+    fingerprinted for idempotency, and the deadline of the request, if any,
+    applies to the whole stream.
+
+    :param methods: The facial names (i.e., names in Python) of methods
+                    to be called in bulk.
+    :type methods: :class:`~typing.AbstractSet`\\ [:class:`str`]
+    :param max_line_size: The maximum number of bytes of a line.  A longer
+                          line is skipped and answered with an error.
+    :type max_line_size: :class:`int`
+
+    """
+
+    MIMETYPE = 'application/x-ndjson'
+
+    def __init__(self, methods, max_line_size=1048576):
+        if isinstance(methods, string_types):
+            raise TypeError('methods must be a set of method names, not ' +
+                            repr(methods))
+        self.methods = frozenset(methods)
+        self.max_line_size = max_line_size
+
+    def lines(self, stream):
+        """Read lines from a request body one by one, skipping blank lines.
+
+        :param stream: The request body stream, which ends at the end of
+                       the body (e.g.,
+                       :attr:`werkzeug.wrappers.Request.stream`).
+        :return: An iterator of lines, having :const:`None` in place of
+                 lines longer than ``max_line_size``.
+        :rtype: :class:`~typing.Iterator`\\ [:class:`bytes`]
+
+        """
+        limit = self.max_line_size
+        while True:
+            # The newline is counted out of the limit.
+            line = stream.readline(limit + 1)
+            if not line:
+                break
+            elif len(line) > limit and not line.endswith(b'\n'):
+                while line and not line.endswith(b'\n'):
+                    line = stream.readline(limit)
+                yield None
+            elif line.strip():
+                yield line
+
+
+class BinaryUploads(object):
+    """Let the given methods taking only a ``binary`` parameter accept
+    ``application/octet-stream`` request bodies, which are bound to
+    the parameter as they are instead of base64 inside a JSON object.
+    Requests of other content types are handled as JSON as usual.
+
+    A body up to ``spool_threshold`` bytes is read into a buffer and
+    passed as :class:`bytes`.  A larger body (or a body of unknown length
+    growing beyond that) is spooled to a temporary file instead, and passed
+    as a file-like object positioned at the start, so that the methods have
+    to accept file-like objects as well if uploads can be large.  The file
+    is closed after the method returns.
+
+    :param methods: The facial names (i.e., names in Python) of methods
+                    to accept raw binary uploads.
+    :type methods: :class:`~typing.AbstractSet`\\ [:class:`str`]
+    :param spool_threshold: The maximum number of bytes to pass as
+                            :class:`bytes`.
+    :type spool_threshold: :class:`int`
+    :param chunk_size: The number of bytes to read from the request body
+                       at a time while spooling.
+    :type chunk_size: :class:`int`
+
+    """
+
+    def __init__(self, methods, spool_threshold=1048576, chunk_size=65536):
+        if isinstance(methods, string_types):
+            raise TypeError('methods must be a set of method names, not ' +
+                            repr(methods))
+        self.methods = frozenset(methods)
+        self.spool_threshold = spool_threshold
+        self.chunk_size = chunk_size
+
+    def read(self, stream, content_length=None):
+        """Read a request body.
+
+        :param stream: The request body stream, which ends at the end of
+                       the body (e.g.,
+                       :attr:`werkzeug.wrappers.Request.stream`).
+        :param content_length: The length of the body if it's known.
+        :type content_length: :class:`int`
+        :return: The body as :class:`bytes` if it's not larger than
+                 :attr:`spool_threshold`, or a temporary file otherwise.
+
+        """
+        if content_length is not None and \
+           content_length <= self.spool_threshold:
+            return stream.read(content_length)
+        chunks = []
+        size = 0
+        spool = None
+        while True:
+            chunk = stream.read(self.chunk_size)
+            if not chunk:
+                break
+            elif spool is not None:
+                spool.write(chunk)
+                continue
+            chunks.append(chunk)
+            size += len(chunk)
+            if size > self.spool_threshold:
+                spool = tempfile.TemporaryFile()
+                spool.writelines(chunks)
+                del chunks[:]
+        if spool is None:
+            return b''.join(chunks)
+        spool.seek(0)
+        return spool
+
+
+def remaining_file_size(file_):
+    """Get the number of bytes left to read from the given file-like object.
+
+    :param file_: A seekable file-like object.
+    :return: The number of bytes, or :const:`None` if it can't be
+             determined (e.g., the file is a pipe).
+    :rtype: :class:`int`
+
+    """
+    try:
+        position = file_.tell()
+        try:
+            size = os.fstat(file_.fileno()).st_size
+        except (AttributeError, EnvironmentError, ValueError):
+            file_.seek(0, 2)
+            size = file_.tell()
+            file_.seek(position)
+    except (AttributeError, EnvironmentError, ValueError):
+        return None
+    return max(0, size - position)
+
+
+class SingleFlightTimeoutError(RuntimeError):
+    """Exception raised when a coalesced call waited for the in-flight
+    execution longer than :attr:`SingleFlight.timeout`.
+
+    """
+
+
+class SingleFlight(object):
+    """Coalesce concurrent identical calls into a single in-flight execution.
+
+    While a call for a key is running, other calls for the same key don't
+    run the function again, but wait for the running one and share its
+    result.  If the running call raises an exception, each of the waiting
+    calls raises its own copy of the exception, without the traceback of
+    the running call.
+
+    :param timeout: The maximum seconds to wait for an in-flight call.
+                    :const:`None` means to wait forever.
+    :type timeout: :class:`numbers.Real`
+
+    """
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def call(self, key, function, timeout=None):
+        """Call the given ``function``, or wait for the in-flight call of
+        the same ``key`` and return its result instead.
+
+        :param key: A hashable key which identifies the call.
+        :param function: A callable which takes no arguments.
+        :param timeout: The maximum seconds to wait for the in-flight call,
+                        if it's shorter than :attr:`timeout`, e.g.,
+                        the remaining time of the waiting request.
+                        :const:`None` means to follow :attr:`timeout`.
+        :type timeout: :class:`numbers.Real`
+        :return: The return value of the ``function``.
+        :raise SingleFlightTimeoutError: When the in-flight call did not
+                                         finish in time.
+
+        """
+        if timeout is None or (self.timeout is not None and
+                               self.timeout < timeout):
+            timeout = self.timeout
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                flight.waiters += 1
+        if not leader:
+            if not flight.done.wait(timeout):
+                raise SingleFlightTimeoutError(
+                    'timed out while waiting for the in-flight call'
+                )
+            if flight.error is not None:
+                # Raising the same exception object on every thread would
+                # mix up their tracebacks.
+                try:
+                    error = copy.copy(flight.error)
+                except Exception:
+                    error = RuntimeError(
+                        'the in-flight call failed: ' + repr(flight.error)
+                    )
+                reraise(type(error), error, None)
+            return flight.value
+        try:
+            flight.value = function()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.value
+
+
+class _Flight(object):
+
+    __slots__ = 'done', 'value', 'error', 'waiters'
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+        self.waiters = 0
+
+
+class CoroutineTimeoutError(RuntimeError):
+    """Exception raised when an awaitable returned by a service method
+    didn't complete in time.
+
+    """
+
+
+class ContextualAwaitable(object):
+    """Wrap an awaitable so that :func:`current_request_context()` returns
+    the given ``context`` whenever the awaitable runs, even on the thread
+    of an event loop shared by requests (see also :class:`CoroutineRunner`).
+
+    :param awaitable: An awaitable, e.g., a coroutine object.
+    :param context: The context of the request which awaits it.
+    :type context: :class:`RequestContext`
+
+    """
+
+    __slots__ = 'awaitable', 'context', '_iterator'
+
+    def __init__(self, awaitable, context):
+        self.awaitable = awaitable
+        self.context = context
+        # asyncio treats it as a coroutine and steps it without calling
+        # __await__().  Generator-based coroutines have no __await__().
+        await_ = getattr(awaitable, '__await__', None)
+        self._iterator = awaitable if await_ is None else await_()
+
+    def __await__(self):
+        return self
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.send(None)
+
+    next = __next__
+
+    def send(self, value):
+        return self._step(self._iterator.send, value)
+
+    def throw(self, *args):
+        return self._step(self._iterator.throw, *args)
+
+    def close(self):
+        close = getattr(self._iterator, 'close', None)
+        if close is not None:
+            close()
+
+    def _step(self, function, *args):
+        previous_context = getattr(_request_context, 'context', None)
+        _request_context.context = self.context
+        try:
+            return function(*args)
+        finally:
+            _request_context.context = previous_context
+
+
+class CoroutineRunner(object):
+    """Run awaitables returned by service methods (e.g., methods defined
+    using ``async def``) on a shared event loop.
+
+    A WSGI server calls the application from synchronous threads, so
+    awaitables can't be awaited there.  Instead, they are scheduled on
+    a long-lived event loop running in its own daemon thread, and the
+    request thread waits for their results.  Since every awaitable shares
+    the same loop, concurrent I/O-bound calls don't need their own
+    event loops.
+
+    :class:`WsgiApp` wraps awaitables in :class:`ContextualAwaitable` so
+    that :func:`current_request_context()` works inside them.  Awaitables
+    run directly through :meth:`run()` don't see the context of the calling
+    thread, since the loop runs on its own thread.
+
+    It's available on Python 3.5 or later.
+
+    :param max_concurrency: The maximum number of awaitables running at
+                            a time.  Calls beyond that wait for a slot.
+    :type max_concurrency: :class:`numbers.Integral`
+    :param timeout: The maximum seconds to wait for an awaitable, including
+                    the time to wait for a slot.  An awaitable which
+                    doesn't complete in time is cancelled.  :const:`None`
+                    means to wait forever.  The deadline of the request
+                    (see also :class:`DeadlinePolicy`) limits it as well.
+    :type timeout: :class:`numbers.Real`
+
+    """
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    @classmethod
+    def shared(cls):
+        """Get the process-wide runner used by apps which aren't given
+        their own runner.
+
+        :return: The shared runner.
+        :rtype: :class:`CoroutineRunner`
+
+        """
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    def __init__(self, max_concurrency=100, timeout=None):
+        if asyncio is None:
+            raise RuntimeError('coroutines are supported on Python 3.5 or '
+                               'later')
+        elif max_concurrency < 1:
+            raise ValueError('max_concurrency must be greater than zero, '
+                             'not {0!r}'.format(max_concurrency))
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self._loop = None
+        self._thread = None
+        self._pid = None
+
+    @property
+    def loop(self):
+        """The event loop which runs awaitables.  Its thread is started
+        on the first access.
+
+        """
+        with self._lock:
+            if self._loop is None or self._pid != os.getpid():
+                # A forked worker (see also WorkerSupervisor) doesn't have
+                # the thread of its parent.
+                self._pid = os.getpid()
+                self._slots = threading.BoundedSemaphore(self.max_concurrency)
+                loop = asyncio.new_event_loop()
+                thread = threading.Thread(
+                    target=self._run_loop, args=(loop,),
+                    name='nirum-wsgi-event-loop'
+                )
+                thread.daemon = True
+                thread.start()
+                self._loop, self._thread = loop, thread
+            return self._loop
+
+    @staticmethod
+    def _run_loop(loop):
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_forever()
+        finally:
+            loop.close()
+
+    def run(self, awaitable, timeout=None):
+        """Run the given ``awaitable`` on the event loop, and wait for its
+        result.
+
+        :param awaitable: An awaitable, e.g., a coroutine object.
+        :param timeout: The maximum seconds to wait, if it's shorter than
+                        :attr:`timeout`.  :const:`None` means to follow
+                        :attr:`timeout`.
+        :type timeout: :class:`numbers.Real`
+        :return: The result of the ``awaitable``.
+        :raise CoroutineTimeoutError: When the ``awaitable`` didn't
+                                      complete in time.  It's cancelled.
+
+        """
+        if timeout is None or (self.timeout is not None and
+                               self.timeout < timeout):
+            timeout = self.timeout
+        started_at = time.time()
+        loop = self.loop
+        if not self._slots.acquire(True, timeout):
+            close = getattr(awaitable, 'close', None)
+            if close is not None:
+                # Prevent "coroutine was never awaited" warnings.
+                close()
+            raise CoroutineTimeoutError(
+                'timed out while waiting for a slot to run the coroutine'
+            )
+        future = concurrent.futures.Future()
+        try:
+            loop.call_soon_threadsafe(self._schedule, awaitable, future)
+        except BaseException:
+            self._slots.release()
+            raise
+        if timeout is not None:
+            timeout = max(0.0, timeout - (time.time() - started_at))
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            # The task is cancelled by the callback _schedule() added.
+            future.cancel()
+            raise CoroutineTimeoutError(
+                'the coroutine did not complete in time'
+            )
+
+    def _schedule(self, awaitable, future):
+        # Runs on the loop thread.  A slot is released when the task is
+        # actually done, so that cancelled tasks still count toward
+        # max_concurrency until they stop.
+        if future.cancelled():
+            close = getattr(awaitable, 'close', None)
+            if close is not None:
+                close()
+            self._slots.release()
+            return
+        try:
+            task = asyncio.ensure_future(awaitable, loop=self._loop)
+        except BaseException as e:
+            self._slots.release()
+            future.set_exception(e)
+            return
+
+        def on_task_done(task):
+            self._slots.release()
+            if future.cancelled():
+                return
+            try:
+                if task.cancelled():
+                    future.cancel()
+                elif task.exception() is not None:
+                    future.set_exception(task.exception())
+                else:
+                    future.set_result(task.result())
+            except Exception:
+                # The waiting thread has cancelled the future meanwhile.
+                pass
+
+        def on_future_done(future):
+            if future.cancelled() and not task.done():
+                self._loop.call_soon_threadsafe(task.cancel)
+        task.add_done_callback(on_task_done)
+        future.add_done_callback(on_future_done)
+
+    def close(self):
+        """Stop the event loop and wait for its thread to finish."""
+        with self._lock:
+            loop, thread = self._loop, self._thread
+            self._loop = self._thread = None
+        if loop is not None:
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+
+
+class RequestContext(object):
+    """The context of the request being handled by the current thread.
+    Service methods can get it through :func:`current_request_context()`.
+
+    .. attribute:: environ
+
+       The WSGI environment dictionary of the request.
+
+    .. attribute:: started_at
+
+       The Unix timestamp when the request has arrived.
+
+    .. attribute:: deadline
+
+       The Unix timestamp until when the caller waits for the response,
+       or :const:`None` if there's no deadline.
+
+    .. attribute:: service_method
+
+       The behind name of the requested service method, or :const:`None`
+       if it's not determined yet.
+
+    .. attribute:: routed
+
+       Whether the request has been routed through ``http-resource``
+       annotation, or :const:`None` if it's not determined yet.
+
+    .. attribute:: route
+
+       The URI template of ``http-resource`` annotation which the request
+       has been routed through, or :const:`None`.
+
+    .. attribute:: status_code
+
+       The HTTP status code of the response, or :const:`None` if it's not
+       determined yet.
+
+    .. attribute:: phases
+
+       The list of ``(name, started_at, ended_at)`` triples of the phases
+       which the request has gone through, e.g., ``'dispatch'``,
+       ``'decode'``, ``'call'``, and ``'encode'``.  ``'parse'`` of
+       the request body is recorded within ``'dispatch'``.
+
+    .. attribute:: trace
+
+       The :class:`TraceContext` of the request if :class:`Tracing` is
+       turned on, or :const:`None`.
+
+    .. attribute:: streamed
+
+       Whether the work of the request goes on while its response body is
+       streamed, e.g., :class:`BulkCalls`.  Such a request is observed
+       (e.g., :class:`Metrics`) until the response body is closed.
+
+    """
+
+    __slots__ = ('environ', 'started_at', 'deadline', 'service_method',
+                 'routed', 'route', 'status_code', 'phases', 'trace',
+                 'streamed')
+
+    def __init__(self, environ, started_at=None, deadline=None):
+        self.environ = environ
+        self.started_at = time.time() if started_at is None else started_at
+        self.deadline = deadline
+        self.service_method = None
+        self.routed = None
+        self.route = None
+        self.status_code = None
+        self.phases = []
+        self.trace = None
+        self.streamed = False
+
+    def record_phase(self, name, started_at):
+        """Record a phase which the request has gone through.
+
+        :param name: The name of the phase.
+        :type name: :class:`str`
+        :param started_at: The Unix timestamp when the phase has started.
+        :type started_at: :class:`float`
+        :return: The Unix timestamp when the phase has ended, i.e., now.
+        :rtype: :class:`float`
+
+        """
+        ended_at = time.time()
+        self.phases.append((name, started_at, ended_at))
+        return ended_at
+
+    def remaining_time(self):
+        """Get the remaining seconds until the :attr:`deadline`.
+
+        :return: The remaining seconds, which is never negative.
+                 :const:`None` if there's no deadline.
+        :rtype: :class:`float`
+
+        """
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.time())
+
+    @property
+    def expired(self):
+        """Whether the :attr:`deadline` has already passed."""
+        return self.deadline is not None and self.deadline <= time.time()
+
+
+_request_context = threading.local()
+#: (:class:`str`) The key of the WSGI environment dictionary which contains
+#: the :class:`RequestContext` of the request.
+REQUEST_CONTEXT_ENVIRON_KEY = 'nirum_wsgi.request_context'
+
+
+def current_request_context():
+    """Get the context of the request being handled by the current thread.
+
+    Service methods can use it to shorten timeouts of their own downstream
+    calls, e.g.:
+
+    .. code-block:: python
+
+       timeout = current_request_context().remaining_time()
+
+    :return: The context of the current request, or :const:`None` if
+             the current thread is not handling any request.
+    :rtype: :class:`RequestContext`
+
+    """
+    return getattr(_request_context, 'context', None)
+
+
+def record_phase(name, started_at):
+    context = current_request_context()
+    if context is None:
+        return time.time()
+    return context.record_phase(name, started_at)
+
+
+class DeadlinePolicy(object):
+    """Determine deadlines of requests.
+
+    A deadline is the earliest of the time budget which the client sent
+    through the ``header`` and the default ``timeouts`` of the method.
+    Both are counted from when the request has arrived, and if a load
+    balancer in front stamps it through the ``start_header`` (e.g.,
+    ``X-Request-Start: t=1527210000.123``) queueing delay is counted as well.
+
+    :param header: The request header which contains the remaining time
+                   budget of the client in seconds (e.g., ``1.5``).
+    :type header: :class:`str`
+    :param start_header: The request header which contains the Unix
+                         timestamp when the request has arrived.
+                         Seconds, milliseconds, and microseconds are all
+                         recognized.  Not used by default.
+    :type start_header: :class:`str`
+    :param timeouts: Default timeouts in seconds of methods.  Keys are
+                     method names in Python (e.g., ``'get_foo'``).
+    :type timeouts: :class:`~typing.Mapping`
+    :param default_timeout: The default timeout in seconds of the methods
+                            not in ``timeouts``.  No timeout by default.
+    :type default_timeout: :class:`numbers.Real`
+
+    """
+
+    def __init__(self, header='X-Request-Timeout', start_header=None,
+                 timeouts=None, default_timeout=None):
+        self.header = header
+        self.start_header = start_header
+        self.timeouts = dict(timeouts or {})
+        self.default_timeout = default_timeout
+        self._header_key = environ_header_key(header)
+        self._start_header_key = start_header and \
+            environ_header_key(start_header)
+
+    def request_context(self, environ):
+        """Create a :class:`RequestContext` of the given request, with its
+        deadline sent by the client.
+
+        :param environ: WSGI environment dictionary.
+        :return: The context of the request.
+        :rtype: :class:`RequestContext`
+        :raise ValueError: When the headers are malformed.
+
+        """
+        started_at = None
+        if self._start_header_key in environ:
+            start = environ[self._start_header_key]
+            try:
+                started_at = parse_timestamp(start)
+            except ValueError:
+                raise ValueError('{0} header must be a Unix timestamp, not '
+                                 '{1!r}.'.format(self.start_header, start))
+        context = RequestContext(environ, started_at)
+        try:
+            budget = environ[self._header_key]
+        except KeyError:
+            return context
+        try:
+            context.deadline = context.started_at + float(budget)
+        except ValueError:
+            raise ValueError('{0} header must be a number of seconds, not '
+                             '{1!r}.'.format(self.header, budget))
+        return context
+
+    def restrict(self, context, method_name):
+        """Shorten the deadline of the given request ``context`` to
+        the default timeout of the method, if needed.
+
+        :param context: The context of the request.
+        :type context: :class:`RequestContext`
+        :param method_name: The method name in Python.
+        :type method_name: :class:`str`
+
+        """
+        timeout = self.timeouts.get(method_name, self.default_timeout)
+        if timeout is None:
+            return
+        deadline = context.started_at + timeout
+        if context.deadline is None or deadline < context.deadline:
+            context.deadline = deadline
+
+
+def environ_header_key(header):
+    return 'HTTP_' + header.upper().replace('-', '_')
+
+
+def parse_timestamp(value):
+    number = float(value.strip().lstrip('t='))
+    if number > 1e14:
+        return number / 1e6  # microseconds
+    elif number > 1e11:
+        return number / 1e3  # milliseconds
+    return number
+
+
+def encode_response(response):
+    """Encode the given response object to a triple of
+    ``(status_code, headers, content)``, which can be shared or stored.
+
+    """
+    if response.direct_passthrough or response.is_streamed:
+        # E.g., file-like results of BinaryResponses, which can't be shared
+        # or stored as they are.
+        try:
+            content = b''.join(response.iter_encoded())
+        finally:
+            response.close()
+    else:
+        content = response.get_data()
+    return response.status_code, list(response.headers), content
+
+
+class IdempotencyStore(object):
+    """The abstract base of storages of responses for
+    :class:`IdempotencyPolicy`.
+
+    :param max_size: The maximum number of stored responses.  The oldest
+                     ones are evicted when it's exceeded.
+    :type max_size: :class:`int`
+    :param ttl: Seconds to keep a stored response.
+    :type ttl: :class:`numbers.Real`
+
+    """
+
+    def __init__(self, max_size=1024, ttl=86400):
+        self.max_size = max_size
+        self.ttl = ttl
+
+    def get(self, key):
+        """Get the response stored with the given ``key``.
+
+        :param key: The key of the response.
+        :type key: :class:`str`
+        :return: The stored response, or :const:`None` if there's no
+                 such response or it has expired.
+        :rtype: :class:`StoredResponse`
+
+        """
+        raise NotImplementedError('get() method has to be implemented')
+
+    def set(self, key, response):
+        """Store the given ``response`` with the ``key``.
+
+        :param key: The key of the response.
+        :type key: :class:`str`
+        :param response: The response to store.
+        :type response: :class:`StoredResponse`
+
+        """
+        raise NotImplementedError('set() method has to be implemented')
+
+
+class MemoryIdempotencyStore(IdempotencyStore):
+    """Store responses in the memory of the process."""
+
+    def __init__(self, max_size=1024, ttl=86400):
+        super(MemoryIdempotencyStore, self).__init__(max_size, ttl)
+        self._lock = threading.Lock()
+        self._responses = collections.OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                expires_at, response = self._responses[key]
+            except KeyError:
+                return None
+            if expires_at <= time.time():
+                del self._responses[key]
+                return None
+            return response
+
+    def set(self, key, response):
+        with self._lock:
+            self._responses.pop(key, None)
+            self._responses[key] = time.time() + self.ttl, response
+            while len(self._responses) > self.max_size:
+                self._responses.popitem(last=False)
+
+
+class FileIdempotencyStore(IdempotencyStore):
+    """Store responses in files of the local ``directory``, so that they
+    survive restarts and are shared by processes on the same host.
+
+    :param directory: The path of the directory to store files.
+                      It's created if it doesn't exist.
+    :type directory: :class:`str`
+    :param evict_interval: The minimum seconds between evictions of
+                           the oldest files, since they need to list
+                           the directory.  The directory can have more
+                           than ``max_size`` files meanwhile.
+    :type evict_interval: :class:`numbers.Real`
+
+    """
+
+    def __init__(self, directory, max_size=1024, ttl=86400,
+                 evict_interval=1.0):
+        super(FileIdempotencyStore, self).__init__(max_size, ttl)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.evict_interval = evict_interval
+        self._evicted_at = None
+
+    def _path(self, key):
+        filename = hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json'
+        return os.path.join(self.directory, filename)
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                record = json.loads(f.read().decode('utf-8'))
+            if record['key'] != key:
+                return None
+            elif record['expires_at'] > time.time():
+                return StoredResponse(
+                    fingerprint=record['fingerprint'],
+                    status_code=record['status_code'],
+                    headers=[tuple(h) for h in record['headers']],
+                    content=base64.b64decode(
+                        record['content'].encode('ascii')
+                    ),
+                )
+        except (IOError, OSError, ValueError, KeyError, TypeError,
+                AttributeError):
+            # Files which are corrupted or written by others are missing.
+            return None
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return None
+
+    def set(self, key, response):
+        record = {
+            'key': key,
+            'expires_at': time.time() + self.ttl,
+            'fingerprint': response.fingerprint,
+            'status_code': response.status_code,
+            'headers': response.headers,
+            'content': base64.b64encode(response.content).decode('ascii'),
+        }
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(json.dumps(record).encode('utf-8'))
+        # Renaming is atomic so that readers never see a partial file.
+        os.rename(temp_path, self._path(key))
+        self._evict()
+
+    def _evict(self):
+        now = time.time()
+        if self._evicted_at is not None and \
+           now - self._evicted_at < self.evict_interval:
+            return
+        self._evicted_at = now
+        paths = [
+            os.path.join(self.directory, name)
+            for name in os.listdir(self.directory)
+            if name.endswith('.json')
+        ]
+        if len(paths) <= self.max_size:
+            return
+        mtimes = []
+        for path in paths:
+            try:
+                mtimes.append((os.path.getmtime(path), path))
+            except OSError:
+                continue
+        mtimes.sort()
+        for _, path in mtimes[:len(mtimes) - self.max_size]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+class IdempotencyPolicy(object):
+    """Make non-``GET`` calls idempotent through the ``Idempotency-Key``
+    header.
+
+    The response of a call having the header is stored per the key and
+    the method, and retries with the same key are responded with the stored
+    response (having ``Idempotent-Replayed: true`` header) instead of calling
+    the method again.  Concurrent duplicates wait for the in-flight call.
+    Reusing a key for different arguments is responded with
+    ``422 Unprocessable Entity``.
+
+    :param store: The storage of responses.
+                  :class:`MemoryIdempotencyStore` by default.
+    :type store: :class:`IdempotencyStore`
+    :param header: The request header which contains the idempotency key.
+    :type header: :class:`str`
+    :param timeout: The maximum seconds that a concurrent duplicate waits
+                    for the in-flight call.  If it's exceeded the duplicate
+                    is responded with ``409 Conflict``.
+    :type timeout: :class:`numbers.Real`
+
+    """
+
+    def __init__(self, store=None, header='Idempotency-Key', timeout=None):
+        if store is None:
+            store = MemoryIdempotencyStore()
+        elif not isinstance(store, IdempotencyStore):
+            raise TypeError('store must be an instance of {0.__name__}, not '
+                            '{1!r}'.format(IdempotencyStore, store))
+        self.store = store
+        self.header = header
+        self.single_flight = SingleFlight(timeout)
+
+
+class _TruncatedRepr(reprlib.Repr):
+
+    def __init__(self):
+        reprlib.Repr.__init__(self)
+        self.maxlevel = 3
+        self.maxstring = 200
+        self.maxlong = 100
+        self.maxother = 200
+
+    def repr1(self, x, level):
+        # Nirum records, unions, and unboxed types, and its immutable
+        # collections are not known by reprlib, so that it would format
+        # them in full through repr().
+        cls = type(x)
+        slots = getattr(cls, '__slots__', None)
+        if isinstance(slots, string_types):
+            slots = slots,
+        if slots and hasattr(x, '__nirum_serialize__'):
+            if level <= 0:
+                return typing._type_repr(cls) + '(...)'
+            fields = [
+                '{0}={1}'.format(name, self.repr1(getattr(x, name, None),
+                                                  level - 1))
+                for name in slots[:self.maxdict]
+            ]
+            if len(slots) > self.maxdict:
+                fields.append('...')
+            return '{0}({1})'.format(typing._type_repr(cls), ', '.join(fields))
+        elif isinstance(x, (List, collections.Set)) and \
+                not isinstance(x, (set, frozenset)):
+            return self.repr_list(
+                list(itertools.islice(x, self.maxlist + 1)), level
+            )
+        elif isinstance(x, collections.Mapping) and not isinstance(x, dict):
+            return self.repr_dict(
+                dict(itertools.islice(x.items(), self.maxdict + 1)), level
+            )
+        return reprlib.Repr.repr1(self, x, level)
+
+
+_truncated_repr = _TruncatedRepr()
+
+
+def truncated_repr(value, limit=1024):
+    """Get the :func:`repr()` of the given ``value``, but truncated so that
+    it takes only bounded time even if the value is huge.
+
+    :param value: A value to represent.
+    :param limit: The maximum length of the result.
+    :type limit: :class:`int`
+    :return: The truncated representation of the ``value``.
+    :rtype: :class:`str`
+
+    """
+    r = _truncated_repr.repr(value)
+    if len(r) > limit:
+        return r[:limit - 3] + '...'
+    return r
+
+
+class AccessLog(object):
+    """Emit a structured log record per request.
+
+    Besides the message, each log record has the following attributes,
+    so that formatters and handlers can use them: ``http_method``, ``path``,
+    ``service_method``, ``routed``, ``status_code``, ``duration`` (seconds),
+    ``request_size``, and ``response_size`` (bytes).
+
+    As log records are emitted on request threads, it's recommended to
+    attach a :class:`QueueLogHandler` to the ``logger`` so that disk or
+    socket I/O is done off the request threads.
+
+    :param logger: The logger to emit records to.
+                   ``nirum_wsgi.access`` logger by default.
+    :type logger: :class:`logging.Logger`
+    :param sample_rate: The ratio of requests to log, from 0 to 1.
+                        Server errors (5xx) are always logged.
+    :type sample_rate: :class:`float`
+    :param level: The level of log records.
+    :type level: :class:`int`
+
+    """
+
+    def __init__(self, logger=None, sample_rate=1.0, level=logging.INFO):
+        if logger is None:
+            logger = logging.getLogger('nirum_wsgi.access')
+        self.logger = logger
+        self.sample_rate = sample_rate
+        self.level = level
+
+    def observe(self, application, environ, start_response):
+        """Call the given WSGI ``application`` and log its response.
+
+        :param application: A WSGI application to call.
+        :param environ: WSGI environment dictionary.
+        :param start_response: A WSGI `start_response` callable.
+        :return: The WSGI response iterable of the ``application``.
+
+        """
+        started_at = time.time()
+        response_status = ['500 Internal Server Error']
+        response_headers = [[]]
+
+        def start_response_(status, headers, exc_info=None):
+            response_status[0] = status
+            response_headers[0] = headers
+            return start_response(status, headers, exc_info)
+        try:
+            return application(environ, start_response_)
+        finally:
+            status_code = int(response_status[0].split(None, 1)[0])
+            if status_code >= 500 or random.random() < self.sample_rate:
+                # Malformed lengths must not mask the response or its
+                # exception.
+                response_size = 0
+                for name, value in response_headers[0]:
+                    if name.lower() == 'content-length':
+                        try:
+                            response_size = int(value)
+                        except ValueError:
+                            pass
+                        break
+                try:
+                    request_size = int(environ.get('CONTENT_LENGTH') or 0)
+                except ValueError:
+                    request_size = 0
+                self.log(environ, status_code, time.time() - started_at,
+                         request_size, response_size)
+
+    def log(self, environ, status_code, duration, request_size,
+            response_size):
+        """Emit a log record of a request.
+
+        :param environ: WSGI environment dictionary.
+        :param status_code: The HTTP status code of the response.
+        :type status_code: :class:`int`
+        :param duration: Seconds taken to respond.
+        :type duration: :class:`float`
+        :param request_size: The size of the request body in bytes.
+        :type request_size: :class:`int`
+        :param response_size: The size of the response body in bytes.
+        :type response_size: :class:`int`
+
+        """
+        context = environ.get(REQUEST_CONTEXT_ENVIRON_KEY)
+        service_method = context and context.service_method
+        fields = {
+            'http_method': environ.get('REQUEST_METHOD'),
+            'path': environ.get('PATH_INFO'),
+            'service_method': service_method,
+            'routed': context and context.routed,
+            'status_code': status_code,
+            'duration': duration,
+            'request_size': request_size,
+            'response_size': response_size,
+        }
+        self.logger.log(
+            self.level, '%s %s %s() %d %.2fms',
+            fields['http_method'], fields['path'], service_method,
+            status_code, duration * 1000,
+            extra=fields
+        )
+
+
+class TrafficCapture(object):
+    """Record sampled requests and their responses to a local JSONL file,
+    so that they can be replayed through :func:`replay_traffic()` (or
+    ``nirum-server replay``) later, e.g., to compare two versions of
+    a service on identical traffic.
+
+    Each line is a JSON object which has ``time``, ``method``, ``path``,
+    ``query``, ``headers``, ``body`` (or ``body_base64`` if it's not UTF-8),
+    ``status``, ``response``, and ``duration`` (seconds) fields.
+
+    The file is rotated when it grows larger than ``max_bytes``, in the same
+    way as :class:`logging.handlers.RotatingFileHandler`: ``path`` is
+    renamed to ``path.1``, ``path.1`` to ``path.2``, and so on.
+
+    As sampled requests are written on request threads, keep
+    the ``sample_rate`` low in production.
+
+    :param path: The path of the file to write.
+    :type path: :class:`str`
+    :param sample_rate: The ratio of requests to capture, from 0 to 1.
+    :type sample_rate: :class:`float`
+    :param max_bytes: The size in bytes to rotate the file at.
+    :type max_bytes: :class:`int`
+    :param backup_count: The number of rotated files to keep.
+    :type backup_count: :class:`int`
+    :param max_body_size: Requests having larger bodies than this are not
+                          captured.  Neither are requests having bodies of
+                          unknown length, since they can't be read ahead
+                          without altering them.
+    :type max_body_size: :class:`int`
+    :param excluded_headers: Headers not to capture, e.g., credentials.
+    :type excluded_headers: :class:`~typing.AbstractSet`\\ [:class:`str`]
+    :param max_response_size: Requests having larger responses than this
+                               are not captured, and their responses are
+                               passed through as they are.  Neither are
+                               requests having responses of unknown length,
+                               e.g., streamed ones (see also
+                               :class:`BulkCalls`).
+    :type max_response_size: :class:`int`
+
+    """
+
+    def __init__(self, path, sample_rate=0.01, max_bytes=64 * 1024 * 1024,
+                 backup_count=5, max_body_size=1024 * 1024,
+                 excluded_headers=frozenset(['Authorization', 'Cookie',
+                                             'Proxy-Authorization']),
+                 max_response_size=1024 * 1024):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.max_body_size = max_body_size
+        self.max_response_size = max_response_size
+        self.excluded_headers = frozenset(h.lower() for h in excluded_headers)
+        self._file = None
+        self._lock = threading.Lock()
+
+    def observe(self, application, environ, start_response):
+        """Call the given WSGI ``application``, and capture the request
+        and its response if it's sampled.
+
+        :param application: A WSGI application to call.
+        :param environ: WSGI environment dictionary.
+        :param start_response: A WSGI `start_response` callable.
+        :return: The WSGI response iterable of the ``application``.
+
+        """
+        if random.random() >= self.sample_rate:
+            return application(environ, start_response)
+        length = environ.get('CONTENT_LENGTH')
+        if length:
+            try:
+                size = int(length)
+            except ValueError:
+                return application(environ, start_response)
+        elif environ.get('wsgi.input_terminated') or \
+                environ.get('HTTP_TRANSFER_ENCODING'):
+            # A body of unknown length can't be read ahead without
+            # altering the input.
+            return application(environ, start_response)
+        else:
+            size = 0
+        if size > self.max_body_size:
+            return application(environ, start_response)
+        if size > 0:
+            # The body is read ahead, so the application reads it from
+            # memory.
+            body = environ['wsgi.input'].read(size)
+            environ['wsgi.input'] = io.BytesIO(body)
+        else:
+            body = b''
+        started_at = time.time()
+        response_status = ['500 Internal Server Error']
+        response_size = [None]
+
+        def start_response_(status, headers, exc_info=None):
+            response_status[0] = status
+            for name, value in headers:
+                if name.lower() == 'content-length':
+                    try:
+                        response_size[0] = int(value)
+                    except ValueError:
+                        pass
+                    break
+            return start_response(status, headers, exc_info)
+
+        def write(response):
+            self.write(self.make_record(
+                environ, body, int(response_status[0].split(None, 1)[0]),
+                response, time.time() - started_at
+            ))
+        try:
+            response = application(environ, start_response_)
+        except Exception:
+            write(b'')
+            raise
+        if response_size[0] is None or \
+           response_size[0] > self.max_response_size:
+            # Streamed (e.g., BulkCalls) and large (e.g., files of
+            # BinaryResponses) responses are passed through uncaptured,
+            # so that memory usage stays bounded.
+            return response
+        chunks = []
+        try:
+            chunks.extend(response)
+        finally:
+            if hasattr(response, 'close'):
+                response.close()
+            write(b''.join(chunks))
+        return chunks
+
+    def make_record(self, environ, body, status_code, response, duration):
+        """Make a JSON-serializable record of a request.
+
+        :param environ: WSGI environment dictionary.
+        :param body: The request body.
+        :type body: :class:`bytes`
+        :param status_code: The HTTP status code of the response.
+        :type status_code: :class:`int`
+        :param response: The response body.
+        :type response: :class:`bytes`
+        :param duration: Seconds taken to respond.
+        :type duration: :class:`float`
+        :rtype: :class:`dict`
+
+        """
+        headers = {}
+        for key, value in environ.items():
+            if key == 'CONTENT_TYPE':
+                name = 'Content-Type'
+            elif key.startswith('HTTP_') and key != 'HTTP_CONTENT_LENGTH':
+                name = key[5:].replace('_', '-').title()
+            else:
+                # Content-Length is determined by the body when replayed.
+                continue
+            if value and name.lower() not in self.excluded_headers:
+                headers[name] = value
+        record = {
+            'time': time.time(),
+            'method': environ.get('REQUEST_METHOD'),
+            'path': environ.get('PATH_INFO'),
+            'query': environ.get('QUERY_STRING', ''),
+            'headers': headers,
+            'status': status_code,
+            'response': response.decode('utf-8', 'replace'),
+            'duration': duration,
+        }
+        try:
+            record['body'] = body.decode('utf-8')
+        except UnicodeDecodeError:
+            record['body_base64'] = base64.b64encode(body).decode('ascii')
+        return record
+
+    def write(self, record):
+        """Write a record to the file, rotating it if needed.
+
+        :param record: A record made by :meth:`make_record()`.
+        :type record: :class:`dict`
+
+        """
+        line = (json.dumps(record, sort_keys=True) + '\n').encode('utf-8')
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, 'ab')
+            position = self._file.tell()
+            if position and position + len(line) > self.max_bytes:
+                self._rotate()
+            self._file.write(line)
+            self._file.flush()
+
+    def _rotate(self):
+        self._file.close()
+        for i in range(self.backup_count - 1, 0, -1):
+            source = '{0}.{1}'.format(self.path, i)
+            if os.path.exists(source):
+                os.rename(source, '{0}.{1}'.format(self.path, i + 1))
+        if self.backup_count > 0:
+            os.rename(self.path, self.path + '.1')
+        else:
+            os.remove(self.path)
+        self._file = open(self.path, 'ab')
+
+    def close(self):
+        """Close the file."""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def load_traffic(paths):
+    """Load records captured by :class:`TrafficCapture` from the given
+    files, in order.  Give rotated files from the oldest, e.g.,
+    ``['capture.jsonl.2', 'capture.jsonl.1', 'capture.jsonl']``.
+
+    :param paths: The paths of captured files.
+    :type paths: :class:`~typing.Sequence`\\ [:class:`str`]
+    :return: Captured records.
+    :rtype: :class:`~typing.Iterator`\\ [:class:`dict`]
+
+    """
+    for path in paths:
+        with io.open(path, encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # E.g., the last line truncated by a crash while writing.
+                    continue
+
+
+class TrafficReplayResult(object):
+    """The result of :func:`replay_traffic()`.
+
+    .. attribute:: latencies
+
+       (:class:`~typing.Sequence`\\ [:class:`float`]) The sorted seconds
+       taken by replayed requests.
+
+    .. attribute:: captured_latencies
+
+       (:class:`~typing.Sequence`\\ [:class:`float`]) The sorted seconds
+       taken by the requests when they were captured.
+
+    .. attribute:: mismatches
+
+       (:class:`~typing.Sequence`\\ [:class:`~typing.Tuple`\\
+       [:class:`dict`, :class:`int`, :class:`bytes`]]) Captured records whose
+       replayed response differs, along with the status code and the body of
+       the replayed response.
+
+    """
+
+    #: (:class:`~typing.Sequence`\\ [:class:`float`]) Percentiles to
+    #: report.
+    percentiles = 50, 90, 99, 99.9
+
+    def __init__(self, latencies, captured_latencies, mismatches):
+        self.latencies = sorted(latencies)
+        self.captured_latencies = sorted(captured_latencies)
+        self.mismatches = mismatches
+
+    def report(self):
+        """Format the result for humans.
+
+        :rtype: :class:`str`
+
+        """
+        status_mismatches = sum(
+            record['status'] != status_code
+            for record, status_code, _ in self.mismatches
+        )
+        lines = [
+            'Requests:    {0}'.format(len(self.latencies)),
+            'Mismatches:  {0} statuses, {1} bodies'.format(
+                status_mismatches, len(self.mismatches) - status_mismatches
+            ),
+        ]
+        for label, latencies in [('Replayed:', self.latencies),
+                                 ('Captured:', self.captured_latencies)]:
+            if latencies:
+                lines.append('{0:<13}'.format(label) + ', '.join(
+                    'p{0:g} {1:.3f} ms'.format(
+                        p, percentile(latencies, p) * 1000
+                    )
+                    for p in self.percentiles
+                ))
+        for record, status_code, _ in self.mismatches:
+            lines.append('  {0} {1}{2}: {3} -> {4}'.format(
+                record['method'], record['path'],
+                '?' + record['query'] if record['query'] else '',
+                record['status'], status_code
+            ))
+        return '\n'.join(lines)
+
+
+def _same_response_body(expected, actual):
+    try:
+        return json.loads(expected) == json.loads(actual.decode('utf-8'))
+    except ValueError:
+        return expected.encode('utf-8') == actual
+
+
+def replay_traffic(app, records):
+    """Feed requests captured by :class:`TrafficCapture` into the given
+    WSGI ``app``, and compare its responses with the captured ones.
+    JSON bodies are compared by their values, regardless of the order of
+    object keys and whitespaces.
+
+    :param app: A WSGI application to replay requests on.
+    :param records: Captured records, e.g., :func:`load_traffic()`.
+    :type records: :class:`~typing.Iterable`\\ [:class:`dict`]
+    :return: The result.
+    :rtype: :class:`TrafficReplayResult`
+
+    """
+    clock = getattr(time, 'perf_counter', time.time)
+    latencies = []
+    captured_latencies = []
+    mismatches = []
+    status = []
+
+    def start_response(status_, headers, exc_info=None):
+        status.append(status_)
+    for record in records:
+        if 'body_base64' in record:
+            body = base64.b64decode(record['body_base64'])
+        else:
+            body = record.get('body', u'').encode('utf-8')
+        environ = create_environ(
+            record['path'], method=record['method'],
+            query_string=record['query'], headers=record['headers'],
+            data=body
+        )
+        del status[:]
+        started_at = clock()
+        try:
+            content = b''.join(app(environ, start_response))
+        except Exception:
+            # Servers respond to unhandled exceptions with 500.
+            status[:] = ['500 Internal Server Error']
+            content = b''
+        latencies.append(clock() - started_at)
+        captured_latencies.append(record['duration'])
+        status_code = int(status[-1].split(None, 1)[0])
+        if status_code != record['status'] or \
+           not _same_response_body(record['response'], content):
+            mismatches.append((record, status_code, content))
+    return TrafficReplayResult(latencies, captured_latencies, mismatches)
+
+
+class QueueLogHandler(logging.Handler):
+    """A logging handler which passes log records to the given ``handlers``
+    on a background thread, so that the threads emitting log records don't
+    wait for disk or socket I/O.
+
+    Like :class:`logging.handlers.QueueHandler`, messages and tracebacks
+    of log records are rendered when they're emitted, so that they don't
+    show arguments mutated later nor keep them alive while queued; only
+    the ``handlers`` format them on the background thread.  If the queue is
+    full log records are dropped rather than blocking, and the number of
+    dropped records is counted by :attr:`dropped`.
+
+    The background thread is started on the first use in each process,
+    so that it works in workers forked by :class:`WorkerSupervisor` too.
+
+    :param handlers: The handlers to pass log records to.
+    :type handlers: :class:`~typing.Sequence`
+    :param capacity: The maximum number of log records in the queue.
+    :type capacity: :class:`int`
+
+    """
+
+    def __init__(self, handlers, capacity=10000):
+        logging.Handler.__init__(self)
+        self.handlers = list(handlers)
+        self.capacity = capacity
+        self.queue = None
+        self.dropped = 0
+        self._thread = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def _start(self):
+        pid = os.getpid()
+        if self._pid == pid:
+            return self.queue
+        with self._start_lock:
+            if self._pid != pid:
+                # A forked worker doesn't have the thread of its parent,
+                # and the queue it inherited may never be drained.
+                self.queue = queue.Queue(self.capacity)
+                self._thread = threading.Thread(
+                    target=self._consume, args=(self.queue,),
+                    name='nirum_wsgi.QueueLogHandler'
+                )
+                self._thread.daemon = True
+                self._thread.start()
+                self._pid = pid
+        return self.queue
+
+    def prepare(self, record):
+        """Render the message of the given ``record`` before it's queued.
+
+        :param record: The log record to queue.
+        :type record: :class:`logging.LogRecord`
+        :return: A copy of the ``record`` whose ``msg`` is rendered, and
+                 which has no ``args`` and ``exc_info``.
+        :rtype: :class:`logging.LogRecord`
+
+        """
+        message = self.format(record)
+        record = copy.copy(record)
+        record.message = message
+        record.msg = message
+        record.args = None
+        record.exc_info = None
+        record.exc_text = None
+        return record
+
+    def emit(self, record):
+        queue_ = self._start()
+        try:
+            record = self.prepare(record)
+        except Exception:
+            self.handleError(record)
+            return
+        try:
+            queue_.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _consume(self, queue_):
+        while True:
+            record = queue_.get()
+            try:
+                if record is None:
+                    break
+                for handler in self.handlers:
+                    if record.levelno >= handler.level:
+                        try:
+                            handler.handle(record)
+                        except Exception:
+                            # A handler which raises must not stop
+                            # the thread, or flush() would never return.
+                            handler.handleError(record)
+            finally:
+                queue_.task_done()
+
+    def flush(self):
+        """Wait until all queued log records are handled."""
+        self._start().join()
+        for handler in self.handlers:
+            handler.flush()
+
+    def close(self):
+        if self._pid == os.getpid() and self._thread.is_alive():
+            self.queue.put(None)
+            self._thread.join()
+        for handler in self.handlers:
+            handler.close()
+        logging.Handler.close(self)
+
+
+def _authorize_admin(environ, allowed_addresses, token):
+    # Whether the request to an admin endpoint is from the allowed_addresses
+    # (any address if None) and has the token (if not None).
+    if allowed_addresses is not None and \
+       environ.get('REMOTE_ADDR') not in allowed_addresses:
+        return False
+    elif token is None:
+        return True
+    expected = 'Bearer ' + token
+    if isinstance(expected, text_type):
+        expected = expected.encode('utf-8')
+    authorization = environ.get('HTTP_AUTHORIZATION', '')
+    if isinstance(authorization, text_type):
+        # Native strings of PEP 3333 are decoded as ISO-8859-1.
+        authorization = authorization.encode('latin-1')
+    return hmac.compare_digest(authorization, expected)
+
+
+def _forbidden(start_response):
+    start_response('403 Forbidden', [('Content-Type', 'text/plain')])
+    return [b'Forbidden']
+
+
+class SlowRequestTracker(object):
+    """Record requests slower than the ``threshold``, to find out which
+    calls make up the tail latency.
+
+    It keeps the ``top`` slowest requests and the ``recent`` slow requests
+    as :class:`SlowRequest` records.  They can be read through
+    :meth:`slowest()`, :meth:`latest()`, and :meth:`report()` methods, or
+    through the ``path`` of :class:`WsgiApp` as a JSON report.  The path
+    is not served unless it's configured, and is only accessible from
+    the ``allowed_addresses``, which are the loopback addresses by default.
+
+    .. warning::
+
+       Behind a reverse proxy on the same host every request comes from
+       the loopback address, so the report, which reveals paths and
+       methods of requests, would be public.  Configure the ``token``
+       (or ``allowed_addresses`` which the proxy never connects from)
+       in that case.
+
+    :param threshold: The latency in seconds to consider a request slow.
+    :type threshold: :class:`numbers.Real`
+    :param top: The number of the slowest requests to keep.
+    :type top: :class:`int`
+    :param recent: The number of the recent slow requests to keep.
+    :type recent: :class:`int`
+    :param path: The path of the local admin endpoint to respond with
+                 the report, e.g., ``'/_slow-requests'``.  Not served by
+                 default.
+    :type path: :class:`str`
+    :param allowed_addresses: The remote addresses allowed to access
+                              the ``path``.  The loopback addresses
+                              by default.  Any address if :const:`None`,
+                              which makes sense only with the ``token``.
+    :type allowed_addresses: :class:`~typing.AbstractSet`\\ [:class:`str`]
+    :param token: The secret token that requests to the ``path`` have to
+                  send as ``Authorization: Bearer <token>`` header besides.
+                  Not required by default.
+    :type token: :class:`str`
+
+    """
+
+    def __init__(self, threshold=1.0, top=25, recent=100, path=None,
+                 allowed_addresses=LOOPBACK_ADDRESSES, token=None):
+        self.threshold = threshold
+        self.top = top
+        self.path = path
+        self.allowed_addresses = None if allowed_addresses is None \
+            else frozenset(allowed_addresses)
+        self.token = token
+        self._lock = threading.Lock()
+        self._slowest = []  # min-heap of (duration, sequence, request)
+        self._latest = collections.deque(maxlen=recent)
+        self._sequence = itertools.count()
+
+    def observe(self, context, duration):
+        """Record the request of the given ``context`` if it's slow.
+
+        :param context: The context of the request.
+        :type context: :class:`RequestContext`
+        :param duration: Seconds taken to respond.
+        :type duration: :class:`float`
+
+        """
+        if duration < self.threshold:
+            return
+        environ = context.environ
+        try:
+            argument_size = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            argument_size = 0
+        argument_size += len(environ.get('QUERY_STRING', ''))
+        request = SlowRequest(
+            started_at=context.started_at,
+            duration=duration,
+            http_method=environ.get('REQUEST_METHOD'),
+            path=environ.get('PATH_INFO'),
+            service_method=context.service_method,
+            route=context.route,
+            status_code=context.status_code or 500,
+            argument_size=argument_size,
+            phases=tuple(
+                (name, ended_at - started_at)
+                for name, started_at, ended_at in context.phases
+            ),
+        )
+        entry = duration, next(self._sequence), request
+        with self._lock:
+            self._latest.append(request)
+            if len(self._slowest) < self.top:
+                heapq.heappush(self._slowest, entry)
+            elif self._slowest and entry > self._slowest[0]:
+                heapq.heapreplace(self._slowest, entry)
+
+    def slowest(self):
+        """Get the slowest requests, from the slowest one.
+
+        :rtype: :class:`~typing.Sequence`\\ [:class:`SlowRequest`]
+
+        """
+        with self._lock:
+            entries = list(self._slowest)
+        return [request for _, _, request in sorted(entries, reverse=True)]
+
+    def latest(self):
+        """Get the recent slow requests, from the latest one.
+
+        :rtype: :class:`~typing.Sequence`\\ [:class:`SlowRequest`]
+
+        """
+        with self._lock:
+            return list(reversed(self._latest))
+
+    def reset(self):
+        """Forget all recorded requests."""
+        with self._lock:
+            del self._slowest[:]
+            self._latest.clear()
+
+    def report(self):
+        """Make a JSON-serializable report of the slow requests.
+
+        :return: A dictionary which has ``threshold``, ``slowest``,
+                 and ``latest`` keys.
+        :rtype: :class:`~typing.Mapping`
+
+        """
+        def serialize(request):
+            d = request._asdict()
+            d['phases'] = [
+                {'name': name, 'duration': duration}
+                for name, duration in request.phases
+            ]
+            return d
+        return {
+            'threshold': self.threshold,
+            'slowest': [serialize(r) for r in self.slowest()],
+            'latest': [serialize(r) for r in self.latest()],
+        }
+
+    def authorize(self, environ):
+        """Determine whether the request is allowed to read the report.
+
+        :param environ: The WSGI environment of the request.
+        :type environ: :class:`~typing.Mapping`
+        :return: :const:`True` if it's from the ``allowed_addresses`` and
+                 has the ``token`` if configured.
+        :rtype: :class:`bool`
+
+        """
+        return _authorize_admin(environ, self.allowed_addresses, self.token)
+
+    def __call__(self, environ, start_response):
+        """Respond with the :meth:`report()` as JSON, only to the requests
+        allowed by :meth:`authorize()`.
+
+        """
+        if not self.authorize(environ):
+            return _forbidden(start_response)
+        content = json.dumps(self.report()).encode('utf-8')
+        start_response('200 OK', [
+            ('Content-Type', 'application/json'),
+            ('Content-Length', str(len(content))),
+        ])
+        return [content]
+
+
+class HealthCheck(object):
+    """Answer liveness and readiness probes of load balancers before
+    constructing requests and routing, with pre-encoded responses.
+
+    The liveness path always responds with ``200 OK`` as long as the process
+    can respond.  The readiness path responds with ``503 Service
+    Unavailable`` when the worker should not get traffic: it's draining
+    (see :meth:`drain()`), it hasn't been warmed up yet (see
+    :meth:`WsgiApp.warm_up()`), it has too many requests in flight,
+    or the ``readiness_check`` callback says so.  Otherwise it responds with
+    ``200 OK``.
+
+    :param liveness_path: The path of the liveness probe.
+    :type liveness_path: :class:`str`
+    :param readiness_path: The path of the readiness probe.
+    :type readiness_path: :class:`str`
+    :param readiness_check: An optional callable which takes no arguments
+                            and returns whether the service is ready,
+                            e.g., whether its database is reachable.
+                            Exceptions it raises are considered not ready.
+    :type readiness_check: :class:`~typing.Callable`\\ [[], :class:`bool`]
+    :param require_warm_up: Not ready until the application is warmed up.
+    :type require_warm_up: :class:`bool`
+    :param max_in_flight: Not ready while this number of requests or more
+                          are in flight.  Not limited by default.
+    :type max_in_flight: :class:`int`
+
+    """
+
+    LIVE_CONTENT = b'{"status": "live"}'
+    READY_CONTENT = b'{"status": "ready"}'
+    UNAVAILABLE_CONTENT = b'{"status": "unavailable"}'
+
+    def __init__(self, liveness_path='/_health', readiness_path='/_ready',
+                 readiness_check=None, require_warm_up=False,
+                 max_in_flight=None):
+        if not (readiness_check is None or callable(readiness_check)):
+            raise TypeError('readiness_check must be callable, not ' +
+                            repr(readiness_check))
+        self.liveness_path = liveness_path
+        self.readiness_path = readiness_path
+        self.paths = frozenset([liveness_path, readiness_path])
+        self.readiness_check = readiness_check
+        self.require_warm_up = require_warm_up
+        self.max_in_flight = max_in_flight
+        self.draining = False
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    def drain(self):
+        """Make the readiness probe fail from now on so that the load
+        balancer stops sending requests, e.g., before the worker exits.
+
+        """
+        self.draining = True
+
+    def enter(self):
+        """Count a request in flight.  :class:`WsgiApp` calls it only if
+        ``max_in_flight`` is set.
+
+        """
+        with self._lock:
+            self.in_flight += 1
+
+    def leave(self):
+        """Count a request out of flight."""
+        with self._lock:
+            self.in_flight -= 1
+
+    def ready(self, app):
+        """Determine whether the given ``app`` is ready to get traffic.
+
+        :param app: The application to check.
+        :type app: :class:`WsgiApp`
+        :rtype: :class:`bool`
+
+        """
+        if self.draining:
+            return False
+        elif self.require_warm_up and app.warm_up_duration is None:
+            return False
+        elif self.max_in_flight is not None and \
+                self.in_flight >= self.max_in_flight:
+            return False
+        elif self.readiness_check is not None:
+            try:
+                return bool(self.readiness_check())
+            except Exception:
+                logging.getLogger(__name__).exception(
+                    'The readiness check has failed.'
+                )
+                return False
+        return True
+
+    def respond(self, app, environ, start_response):
+        """Respond to the probe of the given WSGI environment, which has to
+        be one of the :attr:`paths`.
+
+        """
+        if environ['PATH_INFO'] == self.liveness_path:
+            status, content = '200 OK', self.LIVE_CONTENT
+        elif self.ready(app):
+            status, content = '200 OK', self.READY_CONTENT
+        else:
+            status = '503 Service Unavailable'
+            content = self.UNAVAILABLE_CONTENT
+        start_response(status, [
+            ('Content-Type', 'application/json'),
+            ('Content-Length', str(len(content))),
+            ('Cache-Control', 'no-store'),
+        ])
+        if environ['REQUEST_METHOD'] == 'HEAD':
+            return []
+        return [content]
+
+
+class LoadShedder(object):
+    """Reject low-priority requests with fast ``503 Service Unavailable``
+    responses while the server is overloaded, so that the rest of requests
+    keep meeting their latency targets rather than every request queueing
+    up until it times out.
+
+    It adapts a limit of requests in flight in the manner of AIMD,
+    detecting overload in the manner of CoDel: at the end of every
+    ``interval``, if even the least delayed request during the interval
+    was delayed more than ``target``, i.e., there is a standing queue,
+    the limit is cut down to the number of requests in flight multiplied by
+    ``backoff``.  Otherwise, the limit is increased by one up to
+    ``max_limit``.  Low-priority requests arriving beyond the limit are
+    shed, whereas high-priority ones are always admitted.
+
+    The delay is the queueing delay before the application if a proxy or
+    load balancer in front stamps arrival times of requests through
+    the ``start_header`` (e.g., ``X-Request-Start``).  Otherwise, it's
+    the whole latency of requests, so that ``target`` has to be longer than
+    the latency of the fastest method in normal times.
+
+    A request is high-priority if its method is one of ``priority_methods``,
+    or if the ``priority_header`` is configured and says ``high``.
+
+    .. warning::
+
+       Both headers are trusted as is.  Configure them only if a trusted
+       proxy in front sets them, or strips them from client requests;
+       otherwise any client can avoid being shed by claiming to be
+       high-priority, or push the shedder into overload for everyone by
+       sending an old arrival time.
+
+    :param target: The acceptable delay in seconds.
+    :type target: :class:`float`
+    :param interval: The interval in seconds to adapt the limit in.
+    :type interval: :class:`float`
+    :param priority_methods: The behind names of methods never shed.
+    :type priority_methods: :class:`~typing.AbstractSet`\\ [:class:`str`]
+    :param priority_header: The request header which tells the priority of
+                            the request, either ``high`` or ``low``.
+                            It cannot demote ``priority_methods``.
+                            Ignored if :const:`None` (default).
+    :type priority_header: :class:`str`
+    :param start_header: The request header which contains the Unix
+                         timestamp of when the request arrived at the proxy
+                         in seconds, milliseconds, or microseconds.
+                         Ignored if :const:`None` (default).
+    :type start_header: :class:`str`
+    :param max_limit: The maximum number of requests in flight to admit
+                      low-priority requests up to.
+    :type max_limit: :class:`int`
+    :param min_limit: The number of requests in flight that low-priority
+                      requests are admitted up to even under overload.
+    :type min_limit: :class:`int`
+    :param backoff: The factor to cut the limit by under overload.
+    :type backoff: :class:`float`
+    :param retry_after: The seconds to tell shed clients to retry after.
+    :type retry_after: :class:`int`
+
+    """
+
+    MESSAGE = 'The service is overloaded; retry later.'
+
+    def __init__(self, target=0.1, interval=1.0,
+                 priority_methods=frozenset(), priority_header=None,
+                 start_header=None, max_limit=1000, min_limit=1,
+                 backoff=0.9, retry_after=1):
+        if not 0 < backoff < 1:
+            raise ValueError('backoff must be greater than 0 and less than '
+                             '1, not ' + repr(backoff))
+        elif not 0 < min_limit <= max_limit:
+            raise ValueError('min_limit must be positive and not greater '
+                             'than max_limit ({0!r}), not {1!r}'.format(
+                                 max_limit, min_limit))
+        self.target = target
+        self.interval = interval
+        self.priority_methods = frozenset(priority_methods)
+        self.priority_header = priority_header
+        self.start_header = start_header
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.backoff = backoff
+        self.retry_after = retry_after
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        self.shed = 0
+        self.overloaded = False
+        self._priority_header_key = priority_header and \
+            environ_header_key(priority_header)
+        self._start_header_key = start_header and \
+            environ_header_key(start_header)
+        self._lock = threading.Lock()
+        self._minimum_delay = None
+        self._interval_ends_at = time.time() + interval
+
+    def prioritizes(self, app, environ):
+        """Determine whether the given request is high-priority.
+
+        :param app: The application which got the request.
+        :type app: :class:`WsgiApp`
+        :param environ: WSGI environment dictionary.
+        :rtype: :class:`bool`
+
+        """
+        if self._priority_header_key in environ and \
+           environ[self._priority_header_key].strip().lower() == 'high':
+            return True
+        elif self.priority_methods:
+            return app._requested_method(environ) in self.priority_methods
+        return False
+
+    def admit(self, app, environ):
+        """Determine whether to admit the given request.  An admitted
+        request is counted in flight until :meth:`leave()` is called.
+
+        :param app: The application which got the request.
+        :type app: :class:`WsgiApp`
+        :param environ: WSGI environment dictionary.
+        :return: :const:`False` if the request should be shed.
+        :rtype: :class:`bool`
+
+        """
+        if self._start_header_key in environ:
+            try:
+                started_at = parse_timestamp(environ[self._start_header_key])
+            except ValueError:
+                pass
+            else:
+                self.observe(max(0.0, time.time() - started_at))
+        with self._lock:
+            if self.in_flight < self.limit:
+                self.in_flight += 1
+                return True
+        # Priorities are determined only under overload, since it might
+        # need to match the path against routing rules.
+        if self.prioritizes(app, environ):
+            with self._lock:
+                self.in_flight += 1
+            return True
+        with self._lock:
+            self.shed += 1
+        return False
+
+    def leave(self, latency):
+        """Count an admitted request out of flight.
+
+        :param latency: The seconds the request took.
+        :type latency: :class:`float`
+
+        """
+        with self._lock:
+            self.in_flight -= 1
+        if self.start_header is None:
+            self.observe(latency)
+
+    def observe(self, delay):
+        """Adapt the limit to the given delay of a request.
+
+        :param delay: The delay of a request in seconds.
+        :type delay: :class:`float`
+
+        """
+        now = time.time()
+        with self._lock:
+            if self._minimum_delay is None or delay < self._minimum_delay:
+                self._minimum_delay = delay
+            if now < self._interval_ends_at:
+                return
+            self.overloaded = self._minimum_delay > self.target
+            if self.overloaded:
+                self.limit = max(
+                    self.min_limit,
+                    min(self.limit, self.in_flight) * self.backoff
+                )
+            else:
+                self.limit = min(self.max_limit, self.limit + 1)
+            self._minimum_delay = None
+            self._interval_ends_at = now + self.interval
+
+
+METRICS_HEADER = struct.Struct('<Q')
+METRICS_KEY_LENGTH = struct.Struct('<I')
+METRICS_VALUE = struct.Struct('<d')
+
+
+class _MetricsFile(object):
+    # A memory-mapped file of named float slots.  The file begins with
+    # the number of used bytes, followed by entries of a key length, a UTF-8
+    # key, and an 8-byte aligned value.  Only allocations take the lock;
+    # a slot is written by only a thread (see Metrics).
+
+    initial_size = 64 * 1024
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, self.initial_size)
+            self._mmap = mmap.mmap(fd, self.initial_size)
+        finally:
+            os.close(fd)
+        self._used = METRICS_HEADER.size
+        METRICS_HEADER.pack_into(self._mmap, 0, self._used)
+
+    def allocate(self, key):
+        encoded = key.encode('utf-8')
+        with self._lock:
+            start = self._used
+            value_offset = (start + METRICS_KEY_LENGTH.size + len(encoded) +
+                            7) & ~7
+            used = value_offset + METRICS_VALUE.size
+            if used > len(self._mmap):
+                self._mmap.resize(max(len(self._mmap) * 2, used))
+            METRICS_KEY_LENGTH.pack_into(self._mmap, start, len(encoded))
+            key_offset = start + METRICS_KEY_LENGTH.size
+            self._mmap[key_offset:key_offset + len(encoded)] = encoded
+            METRICS_VALUE.pack_into(self._mmap, value_offset, 0.0)
+            # Readers see the entry only after it's completely written.
+            METRICS_HEADER.pack_into(self._mmap, 0, used)
+            self._used = used
+        return value_offset
+
+    def add(self, offset, amount):
+        mmap_ = self._mmap
+        METRICS_VALUE.pack_into(
+            mmap_, offset, METRICS_VALUE.unpack_from(mmap_, offset)[0] + amount
+        )
+
+    def close(self):
+        self._mmap.close()
+
+    @staticmethod
+    def read(path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        if len(data) < METRICS_HEADER.size:
+            return
+        used = min(METRICS_HEADER.unpack_from(data, 0)[0], len(data))
+        position = METRICS_HEADER.size
+        while position + METRICS_KEY_LENGTH.size <= used:
+            length, = METRICS_KEY_LENGTH.unpack_from(data, position)
+            key_offset = position + METRICS_KEY_LENGTH.size
+            value_offset = (key_offset + length + 7) & ~7
+            if value_offset + METRICS_VALUE.size > used:
+                break
+            yield (data[key_offset:key_offset + length].decode('utf-8'),
+                   METRICS_VALUE.unpack_from(data, value_offset)[0])
+            position = value_offset + METRICS_VALUE.size
+
+
+class _MetricsShard(object):
+    # Slots of a thread.  It's returned to the free list when the thread
+    # ends, and reused by a later thread.
+
+    def __init__(self, id_):
+        self.id = id_
+        self.offsets = {}
+
+
+class _MetricsShardHolder(object):
+
+    def __init__(self, shard, pid):
+        self.shard = shard
+        self.pid = pid
+
+
+class Metrics(object):
+    """Count requests and their latencies per service method and status
+    code as a histogram, and expose it in the Prometheus text format at
+    ``path``.
+
+    Every worker process writes its values to its own memory-mapped file
+    in ``directory``, and the exposition aggregates all files in the
+    directory, so that whichever worker answers a scrape reports the
+    metrics of all workers.  Each thread writes to its own slots of
+    the file, so recording a request takes no locks.  When a worker exits,
+    its values are merged into the archive file of the directory and its
+    file is removed, so that counters don't go backwards.
+
+    The ``path`` is only accessible from the ``allowed_addresses``, which
+    are the loopback addresses by default, with the ``token`` if configured.
+    As with :class:`SlowRequestTracker`, configure the ``token`` if
+    a reverse proxy on the same host forwards requests.
+
+    :param directory: The directory shared by worker processes.  It should
+                      be emptied when the service is deployed.  A new
+                      temporary directory is made by default, which is
+                      shared only by processes forked after it.
+    :type directory: :class:`str`
+    :param path: The path to expose metrics.
+    :type path: :class:`str`
+    :param buckets: The upper bounds of histogram buckets in seconds.
+    :type buckets: :class:`~typing.Sequence`\\ [:class:`float`]
+    :param allowed_addresses: The remote addresses allowed to scrape
+                              the ``path``.  The loopback addresses
+                              by default.  Any address if :const:`None`,
+                              which makes sense only with the ``token``.
+    :type allowed_addresses: :class:`~typing.AbstractSet`\\ [:class:`str`]
+    :param token: The secret token that scrapes have to send as
+                  ``Authorization: Bearer <token>`` header besides.
+                  Not required by default.
+    :type token: :class:`str`
+
+    """
+
+    #: (:class:`str`) The name of the histogram.
+    name = 'nirum_request_duration_seconds'
+
+    #: (:class:`str`) The file name which values of exited workers are
+    #: merged into.
+    archive_name = 'archive.metrics'
+
+    def __init__(self, directory=None, path='/_metrics',
+                 buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                          5.0, 10.0),
+                 allowed_addresses=LOOPBACK_ADDRESSES, token=None):
+        if directory is None:
+            directory = tempfile.mkdtemp(prefix='nirum-metrics-')
+        self.directory = directory
+        self.path = path
+        self.buckets = tuple(sorted(buckets))
+        self.allowed_addresses = None if allowed_addresses is None \
+            else frozenset(allowed_addresses)
+        self.token = token
+        self._pid = None
+        self._file = None
+        self._lock = threading.Lock()
+        # close() does nothing in processes which haven't opened their file.
+        atexit.register(self.close)
+
+    def observe_request(self, service_method, status_code, duration):
+        """Record a request.
+
+        :param service_method: The behind name of the requested method, or
+                               an empty string.
+        :type service_method: :class:`str`
+        :param status_code: The HTTP status code of the response.
+        :type status_code: :class:`int`
+        :param duration: Seconds taken to respond.
+        :type duration: :class:`float`
+
+        """
+        holder = getattr(self._local, 'holder', None) \
+            if self._file is not None else None
+        if holder is None or holder.pid != os.getpid():
+            holder = self._hold_shard()
+        key = service_method, status_code
+        try:
+            bucket_offsets, sum_offset = holder.shard.offsets[key]
+        except KeyError:
+            bucket_offsets, sum_offset = self._allocate(holder.shard, key)
+        metrics_file = self._file
+        metrics_file.add(
+            bucket_offsets[bisect.bisect_left(self.buckets, duration)], 1.0
+        )
+        metrics_file.add(sum_offset, duration)
+
+    def _hold_shard(self):
+        pid = os.getpid()
+        with self._lock:
+            if self._pid != pid:
+                # The first use in this process, which can be forked from
+                # the process that used the parent's file.
+                self._open(pid)
+            try:
+                shard = self._free_shards.pop()
+            except IndexError:
+                shard = _MetricsShard(len(self._shards))
+            holder = _MetricsShardHolder(shard, pid)
+            # The shard is freed when the thread ends and its holder is gone.
+            self._shards[shard.id] = weakref.ref(
+                holder,
+                lambda ref, shard=shard, free_shards=self._free_shards:
+                free_shards.append(shard)
+            )
+        self._local.holder = holder
+        return holder
+
+    def _open(self, pid):
+        path = os.path.join(self.directory, '{0}.metrics'.format(pid))
+        if os.path.exists(path):
+            # Left by a previous process of the same pid which crashed.
+            self._archive(path)
+        self._file = _MetricsFile(path)
+        self._pid = pid
+        self._local = threading.local()
+        self._shards = {}
+        self._free_shards = []
+
+    def _allocate(self, shard, key):
+        service_method, status_code = key
+        prefix = [shard.id, service_method, status_code]
+        allocate = self._file.allocate
+        offsets = (
+            [
+                allocate(json.dumps(prefix + [i]))
+                for i in range(len(self.buckets) + 1)
+            ],
+            allocate(json.dumps(prefix + ['sum'])),
+        )
+        shard.offsets[key] = offsets
+        return offsets
+
+    def _flock(self, operation):
+        lock_file = open(os.path.join(self.directory, 'archive.lock'), 'a')
+        if fcntl is not None:
+            fcntl.flock(lock_file.fileno(), operation)
+        return lock_file
+
+    def collect(self):
+        """Aggregate values of all workers.
+
+        :return: A mapping of pairs of a service method and a status code
+                 to pairs of the counts of each bucket (not cumulative) and
+                 the sum of latencies.
+        :rtype: :class:`~typing.Mapping`\\ [:class:`~typing.Tuple`\\
+                [:class:`str`, :class:`int`], :class:`~typing.Tuple`\\
+                [:class:`~typing.Sequence`\\ [:class:`float`],
+                :class:`float`]]
+
+        """
+        lock_file = self._flock(getattr(fcntl, 'LOCK_SH', None))
+        try:
+            paths = [
+                os.path.join(self.directory, name)
+                for name in os.listdir(self.directory)
+                if name.endswith('.metrics')
+            ]
+            return self._aggregate(paths)
+        finally:
+            lock_file.close()
+
+    def _aggregate(self, paths):
+        aggregated = {}
+        for path in paths:
+            try:
+                entries = list(_MetricsFile.read(path))
+            except (IOError, OSError):
+                continue  # Removed by an exiting worker
+            for key, value in entries:
+                _, service_method, status_code, slot = json.loads(key)
+                try:
+                    buckets, sum_ = aggregated[service_method, status_code]
+                except KeyError:
+                    buckets = [0.0] * (len(self.buckets) + 1)
+                    sum_ = 0.0
+                if slot == 'sum':
+                    sum_ += value
+                else:
+                    buckets[slot] += value
+                aggregated[service_method, status_code] = buckets, sum_
+        return aggregated
+
+    def close(self):
+        """Merge values of the current process into the archive file,
+        and remove its file.  It's called when the process exits."""
+        with self._lock:
+            if self._file is None or self._pid != os.getpid():
+                return
+            self._file.close()
+            self._archive(self._file.path)
+            self._file = None
+            self._pid = None
+
+    def _archive(self, path):
+        archive_path = os.path.join(self.directory, self.archive_name)
+        lock_file = self._flock(getattr(fcntl, 'LOCK_EX', None))
+        try:
+            aggregated = self._aggregate([archive_path, path])
+            temp_path = archive_path + '.tmp'
+            archive = _MetricsFile(temp_path)
+            try:
+                for (service_method, status_code), (buckets, sum_) in \
+                        aggregated.items():
+                    prefix = [0, service_method, status_code]
+                    for i, count in enumerate(buckets):
+                        archive.add(archive.allocate(json.dumps(prefix + [i])),
+                                    count)
+                    archive.add(archive.allocate(json.dumps(prefix + ['sum'])),
+                                sum_)
+            finally:
+                archive.close()
+            os.rename(temp_path, archive_path)
+            os.remove(path)
+        finally:
+            lock_file.close()
+
+    def exposition(self):
+        """Render aggregated metrics in the Prometheus text format.
+
+        :rtype: :class:`str`
+
+        """
+        lines = [
+            '# HELP {0} Latencies of requests.'.format(self.name),
+            '# TYPE {0} histogram'.format(self.name),
+        ]
+        bounds = [repr(float(b)) for b in self.buckets] + ['+Inf']
+        for (service_method, status_code), (buckets, sum_) in \
+                sorted(self.collect().items()):
+            labels = 'method="{0}",status="{1}"'.format(
+                service_method.replace('\\', '\\\\').replace('"', '\\"'),
+                status_code
+            )
+            count = 0.0
+            for bound, bucket in zip(bounds, buckets):
+                count += bucket
+                lines.append('{0}_bucket{{{1},le="{2}"}} {3!r}'.format(
+                    self.name, labels, bound, count
+                ))
+            lines.append('{0}_sum{{{1}}} {2!r}'.format(
+                self.name, labels, sum_
+            ))
+            lines.append('{0}_count{{{1}}} {2!r}'.format(
+                self.name, labels, count
+            ))
+        return '\n'.join(lines) + '\n'
+
+    def authorize(self, environ):
+        """Determine whether the request is allowed to scrape metrics.
+
+        :param environ: The WSGI environment of the request.
+        :type environ: :class:`~typing.Mapping`
+        :return: :const:`True` if it's from the ``allowed_addresses`` and
+                 has the ``token`` if configured.
+        :rtype: :class:`bool`
+
+        """
+        return _authorize_admin(environ, self.allowed_addresses, self.token)
+
+    def respond(self, environ, start_response):
+        """Respond to a scrape, only if :meth:`authorize()` allows it."""
+        if not self.authorize(environ):
+            return _forbidden(start_response)
+        content = self.exposition().encode('utf-8')
+        start_response('200 OK', [
+            ('Content-Type', 'text/plain; version=0.0.4; charset=utf-8'),
+            ('Content-Length', str(len(content))),
+            ('Cache-Control', 'no-store'),
+        ])
+        if environ['REQUEST_METHOD'] == 'HEAD':
+            return []
+        return [content]
+
+
+class TraceContext(object):
+    """The W3C Trace Context of a request, which service methods can get
+    through :attr:`RequestContext.trace` to propagate it to their own
+    downstream calls, e.g.:
+
+    .. code-block:: python
+
+       trace = current_request_context().trace
+       headers = {'traceparent': trace.traceparent} if trace else {}
+
+    :param trace_id: The 32 lowercase hexadecimal digits of the trace ID.
+    :type trace_id: :class:`str`
+    :param span_id: The 16 lowercase hexadecimal digits of the span of
+                    the request.
+    :type span_id: :class:`str`
+    :param parent_id: The span ID of the caller taken from the incoming
+                      ``traceparent``, or :const:`None` if the request
+                      has started the trace.
+    :type parent_id: :class:`str`
+    :param sampled: Whether the spans of the trace are recorded.
+    :type sampled: :class:`bool`
+
+    """
+
+    __slots__ = 'trace_id', 'span_id', 'parent_id', 'sampled'
+
+    def __init__(self, trace_id, span_id, parent_id=None, sampled=True):
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.sampled = sampled
+
+    @property
+    def traceparent(self):
+        """(:class:`str`) The ``traceparent`` header value to send to
+        downstream services, whose parent is the span of the request.
+
+        """
+        return '00-{0}-{1}-{2}'.format(self.trace_id, self.span_id,
+                                       '01' if self.sampled else '00')
+
+    def __repr__(self):
+        return '<{0.__module__}.{0.__name__} {1}>'.format(type(self),
+                                                          self.traceparent)
+
+
+#: A finished span of a request or a phase of it.  Timestamps are in Unix
+#: time, and ``parent_id`` is :const:`None` for the root span.
+Span = collections.namedtuple('Span', [
+    'trace_id', 'span_id', 'parent_id', 'name', 'started_at', 'ended_at',
+    'attributes'
+])
+TRACEPARENT_RE = re.compile(
+    r'^([0-9a-f]{2})-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})(?:-.*)?$'
+)
+
+
+def parse_traceparent(value):
+    """Parse a ``traceparent`` header value of the W3C Trace Context.
+
+    :param value: The header value.
+    :type value: :class:`str`
+    :return: A triple of ``(trace_id, parent_id, sampled)``, or
+             :const:`None` if the value is invalid.
+    :rtype: :class:`tuple`
+
+    """
+    match = TRACEPARENT_RE.match(value.strip())
+    if not match:
+        return None
+    version, trace_id, parent_id, flags = match.groups()
+    if version == 'ff' or (version == '00' and len(value.strip()) != 55) or \
+       trace_id == '0' * 32 or parent_id == '0' * 16:
+        return None
+    return trace_id, parent_id, bool(int(flags, 16) & 1)
+
+
+class Tracing(object):
+    """Record the spans of requests and their phases (``dispatch``
+    including ``parse`` of the body, ``decode``, ``call``, and ``encode``;
+    see also :attr:`RequestContext.phases`), and hand them to
+    the ``exporter`` after each request.
+
+    The incoming ``traceparent`` header is respected, so that the spans
+    join the trace of the caller.  The trace context of the request is
+    exposed to service methods through :attr:`RequestContext.trace`.
+
+    :param exporter: The exporter of finished spans, e.g.,
+                     :class:`FileSpanExporter` or
+                     :class:`OpenTelemetrySpanExporter`.
+    :type exporter: :class:`SpanExporter`
+    :param sample_rate: The probability to record a trace started by
+                        the request.
+    :type sample_rate: :class:`float`
+    :param respect_parent: Follow the sampling decision of the caller
+                           given through ``traceparent`` instead of
+                           ``sample_rate``.
+    :type respect_parent: :class:`bool`
+
+    """
+
+    def __init__(self, exporter, sample_rate=1.0, respect_parent=True):
+        if not isinstance(exporter, SpanExporter):
+            raise TypeError('exporter must be an instance of {0.__name__}, '
+                            'not {1!r}'.format(SpanExporter, exporter))
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+        self.respect_parent = respect_parent
+
+    def start(self, environ):
+        """Determine the trace context of a request.
+
+        :param environ: WSGI environment dictionary.
+        :return: The trace context.
+        :rtype: :class:`TraceContext`
+
+        """
+        parent = environ.get('HTTP_TRACEPARENT')
+        if parent is not None:
+            parent = parse_traceparent(parent)
+        if parent is None:
+            return TraceContext('{0:032x}'.format(random.getrandbits(128)),
+                                '{0:016x}'.format(random.getrandbits(64)),
+                                sampled=random.random() < self.sample_rate)
+        trace_id, parent_id, sampled = parent
+        if not self.respect_parent:
+            sampled = random.random() < self.sample_rate
+        return TraceContext(trace_id,
+                            '{0:016x}'.format(random.getrandbits(64)),
+                            parent_id, sampled)
+
+    def finish(self, context, ended_at=None):
+        """Export the spans of a finished request if it's sampled.
+
+        :param context: The context of the finished request.
+        :type context: :class:`RequestContext`
+        :param ended_at: The Unix timestamp when the request has finished.
+                         Now by default.
+        :type ended_at: :class:`float`
+
+        """
+        trace = context.trace
+        if trace is None or not trace.sampled:
+            return
+        environ = context.environ
+        attributes = {
+            'http.method': environ.get('REQUEST_METHOD'),
+            'http.target': environ.get('PATH_INFO'),
+            'http.status_code': context.status_code,
+        }
+        if context.service_method is not None:
+            attributes['nirum.service_method'] = context.service_method
+        if context.route is not None:
+            attributes['http.route'] = context.route
+        spans = [
+            Span(trace.trace_id, trace.span_id, trace.parent_id,
+                 context.service_method or environ.get('REQUEST_METHOD'),
+                 context.started_at,
+                 time.time() if ended_at is None else ended_at,
+                 attributes)
+        ]
+        for name, started_at, phase_ended_at in context.phases:
+            spans.append(Span(trace.trace_id,
+                              '{0:016x}'.format(random.getrandbits(64)),
+                              trace.span_id, name, started_at, phase_ended_at,
+                              {}))
+        try:
+            self.exporter.export(spans)
+        except Exception:
+            # Tracing must not break requests.
+            logging.getLogger(__name__).exception('Failed to export spans.')
+
+    def close(self):
+        """Close the ``exporter``."""
+        self.exporter.close()
+
+
+class SpanExporter(object):
+    """The abstract base of exporters of finished spans.
+    See also :class:`Tracing`.
+
+    """
+
+    def export(self, spans):
+        """Export the spans of a request.
+
+        :param spans: The spans of a request; the first one is the root.
+        :type spans: :class:`~typing.Sequence`\\ [:class:`Span`]
+
+        """
+        raise NotImplementedError('export() has to be implemented')
+
+    def close(self):
+        """Release the resources of the exporter.  It does nothing by
+        default.
+
+        """
+
+
+class FileSpanExporter(SpanExporter):
+    """Append spans to a local JSONL file for offline analysis, a span
+    per line.
+
+    :param path: The path of the file.
+    :type path: :class:`str`
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = io.open(path, 'ab')
+
+    def export(self, spans):
+        lines = b''.join(
+            json.dumps(span._asdict(), sort_keys=True).encode('utf-8') + b'\n'
+            for span in spans
+        )
+        with self._lock:
+            self._file.write(lines)
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class OpenTelemetryIdGenerator(object):
+    """An ID generator for the OpenTelemetry SDK's tracer provider, which
+    lets :class:`OpenTelemetrySpanExporter` re-create spans with their
+    original trace and span IDs.  It generates random IDs as usual unless
+    the exporter has seeded them on the current thread:
+
+    .. code-block:: python
+
+       from opentelemetry.sdk.trace import TracerProvider
 
+       id_generator = OpenTelemetryIdGenerator()
+       provider = TracerProvider(id_generator=id_generator)
+       exporter = OpenTelemetrySpanExporter(
+           provider.get_tracer('nirum_wsgi'), id_generator
+       )
 
-def parse_json_payload(request):
-    payload = request.get_data(as_text=True)
-    if payload:
-        try:
-            json_payload = json.loads(payload)
-        except (TypeError, ValueError):
-            raise InvalidJsonError(payload)
-        else:
-            return json_payload
-    else:
-        return {}
+    """
 
+    def __init__(self):
+        self._seeds = threading.local()
 
-class InvalidJsonError(ValueError):
-    """Exception raised when a payload is not a valid JSON."""
+    def seed(self, trace_id, span_id):
+        """Make the next IDs generated on the current thread the given ones.
 
+        :param trace_id: The trace ID to generate for a new trace, or
+                         :const:`None` to generate a random one.
+        :type trace_id: :class:`int`
+        :param span_id: The span ID to generate once, or :const:`None` to
+                        generate a random one.
+        :type span_id: :class:`int`
 
-class AnnotationError(ValueError):
-    """Exception raised when the given Nirum annotation is invalid."""
+        """
+        self._seeds.trace_id = trace_id
+        self._seeds.span_id = span_id
 
+    def generate_trace_id(self):
+        trace_id = getattr(self._seeds, 'trace_id', None)
+        if trace_id is None:
+            return random.getrandbits(128)
+        return trace_id
 
-class ServiceMethodError(LookupError):
-    """Exception raised when a method is not found."""
+    def generate_span_id(self):
+        span_id = getattr(self._seeds, 'span_id', None)
+        if span_id is None:
+            return random.getrandbits(64)
+        self._seeds.span_id = None
+        return span_id
 
 
-class MethodDispatchError(ValueError):
-    """Exception raised when failed to dispatch method."""
+class OpenTelemetrySpanExporter(SpanExporter):
+    """Re-create spans through an OpenTelemetry tracer with their
+    original timestamps, so that they are exported by the exporters
+    configured for OpenTelemetry.  Spans of requests which have
+    ``traceparent`` join the trace of the caller.  It requires
+    :mod:`opentelemetry` package.
 
-    def __init__(self, request, status_code, message=None,
-                 *args, **kwargs):
-        self.request = request
-        self.status_code = status_code
-        self.message = message
-        super(MethodDispatchError, self).__init__(*args, **kwargs)
+    The re-created spans keep their original trace and span IDs, which
+    service methods propagate through :attr:`RequestContext.trace`, only if
+    the ``tracer`` is made by a tracer provider configured with
+    the ``id_generator``.  Otherwise new IDs are assigned, and a warning
+    is logged.
 
+    :param tracer: The OpenTelemetry tracer.  The tracer named
+                   ``'nirum_wsgi'`` of the global tracer provider is used
+                   by default.
+    :param id_generator: The ID generator which the tracer provider of
+                         the ``tracer`` is configured with.
+    :type id_generator: :class:`OpenTelemetryIdGenerator`
 
-class MethodArgumentError(ValueError):
-    """An exception type raised when the given method arguments are invalid."""
+    """
 
-    def __init__(self):
-        self.errors = set()
-        super(MethodArgumentError, self).__init__('')
+    def __init__(self, tracer=None, id_generator=None):
+        if opentelemetry_trace is None:
+            raise RuntimeError('OpenTelemetrySpanExporter requires '
+                               'opentelemetry package')
+        elif not (id_generator is None or
+                  isinstance(id_generator, OpenTelemetryIdGenerator)):
+            raise TypeError(
+                'id_generator must be an instance of {0.__name__}, not '
+                '{1!r}'.format(OpenTelemetryIdGenerator, id_generator)
+            )
+        if tracer is None:
+            tracer = opentelemetry_trace.get_tracer(__name__)
+        self.tracer = tracer
+        self.id_generator = id_generator
+        self._warned = False
+        if id_generator is None:
+            self._warn('no id_generator is given')
 
-    def on_error(self, field, message):
-        self.errors.add((field, message))
-        line = '{0}: {1}'.format(field, message)
-        if self.args[0]:
-            line = '{0}\n{1}'.format(self.args[0], line)
-        self.args = (line,)
+    def _warn(self, reason):
+        if not self._warned:
+            self._warned = True
+            logging.getLogger(__name__).warning(
+                'Spans are re-created through OpenTelemetry with new trace '
+                'and span IDs, which differ from the ones propagated to '
+                'service methods, since %s; see also %s.',
+                reason, OpenTelemetryIdGenerator.__name__
+            )
 
-    def raise_if_errored(self):
-        if self.errors:
-            raise self
+    def export(self, spans):
+        root = spans[0]
+        context = None
+        if root.parent_id is not None:
+            context = opentelemetry_trace.set_span_in_context(
+                opentelemetry_trace.NonRecordingSpan(
+                    opentelemetry_trace.SpanContext(
+                        trace_id=int(root.trace_id, 16),
+                        span_id=int(root.parent_id, 16),
+                        is_remote=True,
+                        trace_flags=opentelemetry_trace.TraceFlags(1)
+                    )
+                )
+            )
+        request_span = self._start(root, context,
+                                   opentelemetry_trace.SpanKind.SERVER)
+        context = opentelemetry_trace.set_span_in_context(request_span)
+        for span in spans[1:]:
+            self._start(
+                span, context, opentelemetry_trace.SpanKind.INTERNAL
+            ).end(int(span.ended_at * 1e9))
+        request_span.end(int(root.ended_at * 1e9))
+
+    def _start(self, span, context, kind):
+        id_generator = self.id_generator
+        span_id = int(span.span_id, 16)
+        if id_generator is not None:
+            id_generator.seed(int(span.trace_id, 16), span_id)
+        try:
+            # OpenTelemetry timestamps are in nanoseconds.
+            otel_span = self.tracer.start_span(
+                span.name, context=context, kind=kind,
+                attributes={k: v for k, v in span.attributes.items()
+                            if v is not None},
+                start_time=int(span.started_at * 1e9)
+            )
+        finally:
+            if id_generator is not None:
+                id_generator.seed(None, None)
+        if id_generator is not None and not self._warned and \
+           otel_span.get_span_context().span_id != span_id:
+            self._warn('the tracer provider is not configured with '
+                       'the id_generator')
+        return otel_span
 
 
 class WsgiApp(object):
@@ -144,6 +3777,63 @@ class WsgiApp(object):
     :param allowed_headers: A set of allowed headers to request headers.
                             See also CORS_.
     :type allowed_headers: :class:`~typing.AbstractSet`\ [:class:`str`]
+    :param single_flight: Coalesce concurrent identical ``GET`` calls
+                          (i.e., the same method with the same arguments)
+                          into a single execution of the service method.
+                          Opted out by default.
+    :type single_flight: :class:`SingleFlight`
+    :param deadline_policy: Determine deadlines of requests from the time
+                            budgets sent by clients and default timeouts
+                            of methods.  Requests whose deadline has already
+                            passed are dropped with ``504 Gateway Timeout``
+                            without calling service methods.  Service methods
+                            can get the remaining time through
+                            :func:`current_request_context()`.
+    :type deadline_policy: :class:`DeadlinePolicy`
+    :param idempotency_policy: Make non-``GET`` calls having
+                               ``Idempotency-Key`` header idempotent by
+                               replaying stored responses.
+    :type idempotency_policy: :class:`IdempotencyPolicy`
+    :param access_log: Emit a structured log record per request.
+    :type access_log: :class:`AccessLog`
+    :param slow_request_tracker: Record requests slower than a threshold
+                                 with their phase timings.
+    :type slow_request_tracker: :class:`SlowRequestTracker`
+    :param health_check: Answer liveness and readiness probes cheaply.
+    :type health_check: :class:`HealthCheck`
+    :param payload_limits: Limit the complexity of JSON payloads.
+    :type payload_limits: :class:`PayloadLimits`
+    :param argument_streaming: Pass the list argument of the given methods
+                               as a lazy iterator decoded incrementally
+                               from the request body.
+    :type argument_streaming: :class:`ArgumentStreaming`
+    :param traffic_capture: Record sampled requests and their responses
+                            to replay them later.
+    :type traffic_capture: :class:`TrafficCapture`
+    :param metrics: Count requests and their latencies, aggregated across
+                    worker processes.
+    :type metrics: :class:`Metrics`
+    :param coroutine_runner: Run awaitables returned by service methods
+                             (e.g., ``async def`` methods).  The process-wide
+                             :meth:`CoroutineRunner.shared()` runner is used
+                             by default.  Python 3.5 or later only.
+    :type coroutine_runner: :class:`CoroutineRunner`
+    :param binary_responses: Respond with results of methods returning
+                             ``binary`` as raw bytes rather than JSON.
+    :type binary_responses: :class:`BinaryResponses`
+    :param binary_uploads: Bind ``application/octet-stream`` request bodies
+                           to the ``binary`` parameter of the given methods
+                           rather than parsing JSON.
+    :type binary_uploads: :class:`BinaryUploads`
+    :param tracing: Record spans of requests and their phases, joining
+                    the traces of callers through ``traceparent``.
+    :type tracing: :class:`Tracing`
+    :param load_shedder: Shed low-priority requests with fast ``503``
+                         responses under overload.
+    :type load_shedder: :class:`LoadShedder`
+    :param bulk_calls: Call the given methods with each of newline-delimited
+                       JSON objects of arguments, and stream their results.
+    :type bulk_calls: :class:`BulkCalls`
 
     .. _CORS: https://www.w3.org/TR/cors/
 
@@ -166,7 +3856,23 @@ class WsgiApp(object):
 
     def __init__(self, service,
                  allowed_origins=frozenset(),
-                 allowed_headers=frozenset()):
+                 allowed_headers=frozenset(),
+                 single_flight=None,
+                 deadline_policy=None,
+                 idempotency_policy=None,
+                 access_log=None,
+                 slow_request_tracker=None,
+                 health_check=None,
+                 payload_limits=None,
+                 argument_streaming=None,
+                 traffic_capture=None,
+                 metrics=None,
+                 coroutine_runner=None,
+                 binary_responses=None,
+                 binary_uploads=None,
+                 tracing=None,
+                 load_shedder=None,
+                 bulk_calls=None):
         if not isinstance(service, Service):
             raise TypeError(
                 'expected an instance of {0.__module__}.{0.__name__}, not '
@@ -175,7 +3881,156 @@ class WsgiApp(object):
         elif not isinstance(allowed_origins, collections.Set):
             raise TypeError('allowed_origins must be a set, not ' +
                             repr(allowed_origins))
+        elif not (single_flight is None or
+                  isinstance(single_flight, SingleFlight)):
+            raise TypeError('single_flight must be an instance of {0.__name__}'
+                            ', not {1!r}'.format(SingleFlight, single_flight))
+        elif not (deadline_policy is None or
+                  isinstance(deadline_policy, DeadlinePolicy)):
+            raise TypeError(
+                'deadline_policy must be an instance of {0.__name__}, not '
+                '{1!r}'.format(DeadlinePolicy, deadline_policy)
+            )
+        elif not (idempotency_policy is None or
+                  isinstance(idempotency_policy, IdempotencyPolicy)):
+            raise TypeError(
+                'idempotency_policy must be an instance of {0.__name__}, not '
+                '{1!r}'.format(IdempotencyPolicy, idempotency_policy)
+            )
+        elif not (access_log is None or isinstance(access_log, AccessLog)):
+            raise TypeError('access_log must be an instance of {0.__name__}, '
+                            'not {1!r}'.format(AccessLog, access_log))
+        elif not (slow_request_tracker is None or
+                  isinstance(slow_request_tracker, SlowRequestTracker)):
+            raise TypeError(
+                'slow_request_tracker must be an instance of {0.__name__}, '
+                'not {1!r}'.format(SlowRequestTracker, slow_request_tracker)
+            )
+        elif not (health_check is None or
+                  isinstance(health_check, HealthCheck)):
+            raise TypeError(
+                'health_check must be an instance of {0.__name__}, not '
+                '{1!r}'.format(HealthCheck, health_check)
+            )
+        elif not (payload_limits is None or
+                  isinstance(payload_limits, PayloadLimits)):
+            raise TypeError(
+                'payload_limits must be an instance of {0.__name__}, not '
+                '{1!r}'.format(PayloadLimits, payload_limits)
+            )
+        elif not (argument_streaming is None or
+                  isinstance(argument_streaming, ArgumentStreaming)):
+            raise TypeError(
+                'argument_streaming must be an instance of {0.__name__}, not '
+                '{1!r}'.format(ArgumentStreaming, argument_streaming)
+            )
+        elif not (traffic_capture is None or
+                  isinstance(traffic_capture, TrafficCapture)):
+            raise TypeError(
+                'traffic_capture must be an instance of {0.__name__}, not '
+                '{1!r}'.format(TrafficCapture, traffic_capture)
+            )
+        elif not (metrics is None or isinstance(metrics, Metrics)):
+            raise TypeError('metrics must be an instance of {0.__name__}, '
+                            'not {1!r}'.format(Metrics, metrics))
+        elif not (coroutine_runner is None or
+                  isinstance(coroutine_runner, CoroutineRunner)):
+            raise TypeError(
+                'coroutine_runner must be an instance of {0.__name__}, not '
+                '{1!r}'.format(CoroutineRunner, coroutine_runner)
+            )
+        elif not (binary_responses is None or
+                  isinstance(binary_responses, BinaryResponses)):
+            raise TypeError(
+                'binary_responses must be an instance of {0.__name__}, not '
+                '{1!r}'.format(BinaryResponses, binary_responses)
+            )
+        elif not (binary_uploads is None or
+                  isinstance(binary_uploads, BinaryUploads)):
+            raise TypeError(
+                'binary_uploads must be an instance of {0.__name__}, not '
+                '{1!r}'.format(BinaryUploads, binary_uploads)
+            )
+        elif not (tracing is None or isinstance(tracing, Tracing)):
+            raise TypeError('tracing must be an instance of {0.__name__}, '
+                            'not {1!r}'.format(Tracing, tracing))
+        elif not (load_shedder is None or
+                  isinstance(load_shedder, LoadShedder)):
+            raise TypeError(
+                'load_shedder must be an instance of {0.__name__}, not '
+                '{1!r}'.format(LoadShedder, load_shedder)
+            )
+        elif not (bulk_calls is None or isinstance(bulk_calls, BulkCalls)):
+            raise TypeError('bulk_calls must be an instance of {0.__name__}, '
+                            'not {1!r}'.format(BulkCalls, bulk_calls))
         self.service = service
+        self.single_flight = single_flight
+        self.deadline_policy = deadline_policy
+        self.idempotency_policy = idempotency_policy
+        self.access_log = access_log
+        self.slow_request_tracker = slow_request_tracker
+        self.health_check = health_check
+        self.payload_limits = payload_limits
+        self.argument_streaming = argument_streaming
+        self.traffic_capture = traffic_capture
+        self.metrics = metrics
+        self.coroutine_runner = coroutine_runner
+        self.binary_responses = binary_responses
+        self.binary_uploads = binary_uploads
+        self.tracing = tracing
+        self.load_shedder = load_shedder
+        self.bulk_calls = bulk_calls
+        # Requests to unknown methods are counted without their names so
+        # that they can't blow up the metrics.
+        self._behind_method_names = frozenset(
+            service.__nirum_method_names__.behind_names
+        )
+        self._method_loggers = {}
+        self._static_errors = {}
+        self._type_hints = {}
+        self._binary_results = {}
+        if binary_responses is not None:
+            for method_facial_name in binary_responses.methods:
+                if not self._returns_binary(method_facial_name):
+                    raise TypeError(
+                        'cannot respond with raw binary for {0}() method; it '
+                        'has to return binary'.format(method_facial_name)
+                    )
+        self._argument_streams = {}
+        if argument_streaming is not None:
+            for method_facial_name in argument_streaming.methods:
+                self._compile_argument_stream(method_facial_name)
+        # Behind names of the methods, which requests refer to.
+        self._streamed_methods = frozenset(
+            service.__nirum_method_names__[name]
+            for name in self._argument_streams
+        )
+        self._binary_uploads = {}
+        if binary_uploads is not None:
+            for method_facial_name in binary_uploads.methods:
+                self._compile_binary_upload(method_facial_name)
+        # Behind names of the methods, which requests refer to.
+        self._uploaded_methods = frozenset(
+            service.__nirum_method_names__[name]
+            for name in self._binary_uploads
+        )
+        if bulk_calls is not None:
+            for method_facial_name in bulk_calls.methods:
+                if method_facial_name not in service.__nirum_method_names__:
+                    raise TypeError(
+                        'cannot call {0}() method in bulk; it is not a method '
+                        'of the service'.format(method_facial_name)
+                    )
+        # Behind names of the methods, which requests refer to.
+        self._bulk_methods = frozenset(
+            service.__nirum_method_names__[name]
+            for name in (() if bulk_calls is None else bulk_calls.methods)
+        )
+        #: (:class:`float`) The seconds :meth:`warm_up()` took, or
+        #: :const:`None` if it hasn't been warmed up.
+        self.warm_up_duration = None
+        self._custom_make_response = \
+            type(self).make_response != WsgiApp.make_response
         self.allowed_origins = frozenset(d.strip().lower()
                                          for d in allowed_origins
                                          if '*' not in d)
@@ -230,6 +4085,27 @@ class WsgiApp(object):
             ))
         rules.sort(key=lambda rule: rule.uri_template, reverse=True)
         self.rules = List(rules)
+        self._sorted_rules = tuple(sort_rules(rules))
+        self._uri_templates = {
+            rule.name: rule.uri_template for rule in rules
+        }
+        self._method_parameters = {
+            method_name: tuple(
+                (p.rstrip('_'), p) for p in parameters if p[:1] != '_'
+            )
+            for method_name, parameters in service_methods.items()
+        }
+        if self.allowed_headers:
+            self._allow_headers = ((
+                'Access-Control-Allow-Headers',
+                ', '.join(sorted(self.allowed_headers))
+            ),)
+        else:
+            self._allow_headers = ()
+        self._rpc_cors_headers = (
+            ('Vary', 'Origin'),
+            ('Access-Control-Allow-Methods', 'POST, OPTIONS'),
+        ) + self._allow_headers
 
     def __call__(self, environ, start_response):
         """WSGI interface has to be callable."""
@@ -247,66 +4123,134 @@ class WsgiApp(object):
                 return True
         return False
 
+    def warm_up(self):
+        """Warm up the application so that the first requests to each
+        method are not slower than later ones.  It resolves the lazy type
+        hints of all methods, and exercises routing, argument decoding,
+        and result serialization of each method, without calling any
+        service method.
+
+        Call it before accepting traffic, e.g., ``nirum-server --warm-up``.
+
+        :return: The seconds taken to warm up, which is also stored in
+                 :attr:`warm_up_duration`.
+        :rtype: :class:`float`
+
+        """
+        started_at = time.time()
+        service_methods = self.service.__nirum_service_methods__
+        behind_names = self.service.__nirum_method_names__
+        for method_facial_name in service_methods:
+            try:
+                self._warm_up_method(method_facial_name,
+                                     behind_names[method_facial_name])
+            except Exception:
+                self._get_method_logger(method_facial_name).exception(
+                    'Failed to warm up %s() method.', method_facial_name
+                )
+        for rule in self._sorted_rules:
+            path, _, querystring = UriTemplateMatcher.VARIABLE_PATTERN.sub(
+                u'0', rule.uri_template
+            ).partition(u'?')
+            self.dispatch_method(
+                create_environ(path, method='OPTIONS',
+                               query_string=querystring)
+            )
+        # Responses are exercised as well, without being sent anywhere.
+        response = self._raw_response(200, None)
+        for _ in response(create_environ('/'), lambda *args: None):
+            pass
+        self.warm_up_duration = time.time() - started_at
+        logging.getLogger(__name__).info(
+            'Warmed up %d methods in %.3f seconds.',
+            len(service_methods), self.warm_up_duration
+        )
+        return self.warm_up_duration
+
+    def close(self):
+        """Release the resources of the options which outlive requests:
+        merge the values of :attr:`metrics` into its archive, and close
+        :attr:`tracing` and :attr:`traffic_capture`.  Call it when
+        the process is about to exit without running :mod:`atexit`
+        handlers, e.g., a worker of :class:`WorkerSupervisor` does.
+
+        """
+        if self.metrics is not None:
+            self.metrics.close()
+        if self.tracing is not None:
+            self.tracing.close()
+        if self.traffic_capture is not None:
+            self.traffic_capture.close()
+
+    def _warm_up_method(self, method_facial_name, service_method):
+        type_hints = self._method_type_hints(method_facial_name)
+        self.dispatch_method(
+            create_environ('/', method='OPTIONS',
+                           query_string='method=' + service_method)
+        )
+        # Nulls for every argument go through the decoders without calling
+        # the method; they are either decoded or reported as errors.
+        try:
+            self._parse_procedure_arguments(
+                method_facial_name,
+                dict.fromkeys(type_hints['_names'].values())
+            )
+        except MethodArgumentError:
+            pass
+        try:
+            self._respond_with_result(method_facial_name, None)
+        except Exception:
+            # Serializers of methods which never return null may fail in
+            # any way with it; they are exercised anyway.
+            pass
+
+    def _method_type_hints(self, method_facial_name):
+        # Type hints of the schema version 2 or later are lazily evaluated
+        # functions which return types.  They are resolved only once.
+        try:
+            return self._type_hints[method_facial_name]
+        except KeyError:
+            pass
+        type_hints = self.service.__nirum_service_methods__[method_facial_name]
+        if type_hints.get('_v', 1) >= 2:
+            type_hints = {
+                k: v() if k == '_return' or not k.startswith('_') else v
+                for k, v in type_hints.items()
+            }
+        self._type_hints[method_facial_name] = type_hints
+        return type_hints
+
     def dispatch_method(self, environ):
         payload = None
         request = Request(environ)
-        service_methods = self.service.__nirum_service_methods__
-        # CORS
-        cors_headers = [('Vary', 'Origin')]
         request_match, matched_verb = match_request(
-            self.rules, environ['REQUEST_METHOD'],
-            environ['PATH_INFO'], environ['QUERY_STRING']
+            self._sorted_rules, environ['REQUEST_METHOD'],
+            environ['PATH_INFO'], environ['QUERY_STRING'],
+            presorted=True
         )
+        # CORS
         if request_match:
             service_method = request_match.method_name
-            cors_headers.append(
-                (
-                    'Access-Control-Allow-Methods',
-                    ', '.join(matched_verb + ['OPTIONS'])
-                )
-            )
-            method_parameters = {
-                k: v
-                for k, v in service_methods[request_match.method_name].items()
-                if not k.startswith('_')
-            }
+            matched_verb.append('OPTIONS')
+            cors_headers = [
+                ('Vary', 'Origin'),
+                ('Access-Control-Allow-Methods', ', '.join(matched_verb)),
+            ]
+            cors_headers.extend(self._allow_headers)
+            get_variable = request_match.match_group.get_variable
             payload = {
-                p.rstrip('_'): request_match.match_group.get_variable(p)
-                for p in method_parameters
+                name: get_variable(p)
+                for name, p in self._method_parameters[service_method]
             }
             # TODO Parsing query string
             if request_match.verb not in ('GET', 'DELETE'):
-                try:
-                    json_payload = parse_json_payload(request)
-                except InvalidJsonError as e:
-                    raise MethodDispatchError(
-                        request, 400,
-                        "Invalid JSON payload: '{!s}'.".format(e)
-                    )
-                else:
-                    payload.update(**json_payload)
+                payload.update(**self._parse_payload(request, service_method))
         else:
             if request.method not in ('POST', 'OPTIONS'):
                 raise MethodDispatchError(request, 405)
-            cors_headers.append(
-                ('Access-Control-Allow-Methods', 'POST, OPTIONS')
-            )
+            cors_headers = list(self._rpc_cors_headers)
             service_method = request.args.get('method')
-            try:
-                payload = parse_json_payload(request)
-            except InvalidJsonError as e:
-                raise MethodDispatchError(
-                    request,
-                    400,
-                    "Invalid JSON payload: '{!s}'.".format(e)
-                )
-        if self.allowed_headers:
-            cors_headers.append(
-                (
-                    'Access-Control-Allow-Headers',
-                    ', '.join(sorted(self.allowed_headers))
-                )
-            )
+            payload = self._parse_payload(request, service_method)
         try:
             origin = request.headers['Origin']
         except KeyError:
@@ -316,13 +4260,41 @@ class WsgiApp(object):
                 cors_headers.append(
                     ('Access-Control-Allow-Origin', origin)
                 )
-        return MethodDispatch(
-            request=request,
-            routed=bool(request_match),
-            service_method=service_method,
-            payload=payload,
-            cors_headers=cors_headers
+        return MethodDispatch(request, request_match is not None,
+                              service_method, payload, cors_headers)
+
+    def _requested_method(self, environ):
+        request_match, _ = match_request(
+            self._sorted_rules, environ['REQUEST_METHOD'],
+            environ['PATH_INFO'], environ['QUERY_STRING'],
+            presorted=True
         )
+        if request_match:
+            return request_match.method_name
+        query = urlparse.parse_qs(environ['QUERY_STRING'])
+        return query.get('method', [None])[0]
+
+    def _parse_payload(self, request, service_method):
+        if service_method in self._streamed_methods or \
+           self._accepts_bulk_calls(request, service_method):
+            return {}
+        started_at = time.time()
+        try:
+            if self._accepts_binary_upload(request, service_method):
+                check_payload_length(request, self.payload_limits)
+                return {}
+            return parse_json_payload(request, self.payload_limits)
+        except InvalidJsonError as e:
+            raise MethodDispatchError(
+                request, 400, "Invalid JSON payload: '{!s}'.".format(e)
+            )
+        except PayloadLimitError as e:
+            raise MethodDispatchError(
+                request, e.status_code, 'The payload is too complex.',
+                errors=e.errors
+            )
+        finally:
+            record_phase('parse', started_at)
 
     def route(self, environ, start_response):
         """Route an HTTP request to a corresponding service method,
@@ -332,12 +4304,143 @@ class WsgiApp(object):
         :param start_response: A WSGI `start_response` callable.
 
         """
+        metrics = self.metrics
+        if metrics is not None and environ['PATH_INFO'] == metrics.path:
+            return metrics.respond(environ, start_response)
+        health_check = self.health_check
+        if health_check is not None:
+            if environ['PATH_INFO'] in health_check.paths:
+                return health_check.respond(self, environ, start_response)
+            elif health_check.max_in_flight is not None:
+                health_check.enter()
+                try:
+                    app_iter = self._observe(environ, start_response)
+                except BaseException:
+                    health_check.leave()
+                    raise
+                context = environ.get(REQUEST_CONTEXT_ENVIRON_KEY)
+                if context is not None and context.streamed:
+                    return ClosingIterator(app_iter, health_check.leave)
+                health_check.leave()
+                return app_iter
+        return self._observe(environ, start_response)
+
+    def _observe(self, environ, start_response):
+        tracker = self.slow_request_tracker
+        if tracker is not None and tracker.path and \
+           environ['PATH_INFO'] == tracker.path:
+            return tracker(environ, start_response)
+        if self.traffic_capture is not None:
+            return self.traffic_capture.observe(self._log_access, environ,
+                                                start_response)
+        return self._log_access(environ, start_response)
+
+    def _log_access(self, environ, start_response):
+        if self.access_log is not None:
+            return self.access_log.observe(self._handle, environ,
+                                           start_response)
+        return self._handle(environ, start_response)
+
+    def _handle(self, environ, start_response):
+        arrived_at = time.time()
+        if self.deadline_policy is None:
+            context = RequestContext(environ)
+        else:
+            try:
+                context = self.deadline_policy.request_context(environ)
+            except ValueError as e:
+                response = self.error(400, Request(environ), message=str(e))
+                return response(environ, start_response)
+            if context.expired:
+                response = self.static_error(504, DEADLINE_EXPIRED_MESSAGE)
+                return response(environ, start_response)
+        load_shedder = self.load_shedder
+        if load_shedder is not None and \
+           not load_shedder.admit(self, environ):
+            response = self.static_error(503, LoadShedder.MESSAGE)
+            response.headers['Retry-After'] = str(load_shedder.retry_after)
+            if self.metrics is not None:
+                # Shed requests are counted so that shedding shows up in
+                # the histogram.
+                context.service_method = self._requested_method(environ)
+                context.status_code = 503
+                self._observe_metrics(context, arrived_at)
+            return response(environ, start_response)
+        tracing = self.tracing
+        if tracing is not None:
+            context.trace = tracing.start(environ)
+        environ[REQUEST_CONTEXT_ENVIRON_KEY] = context
+        previous_context = current_request_context()
+        _request_context.context = context
+        try:
+            app_iter = self._route(environ, start_response)
+        except BaseException:
+            self._finish(context, arrived_at)
+            raise
+        finally:
+            _request_context.context = previous_context
+        if context.streamed:
+            # The work of streamed responses (e.g., bulk calls) is done
+            # while their body is iterated, so the request is finished
+            # when the body is closed.
+            return ClosingIterator(
+                app_iter, functools.partial(self._finish, context, arrived_at)
+            )
+        self._finish(context, arrived_at)
+        return app_iter
+
+    def _finish(self, context, arrived_at):
+        if self.load_shedder is not None:
+            self.load_shedder.leave(time.time() - arrived_at)
+        if self.tracing is not None:
+            self.tracing.finish(context)
+        if self.slow_request_tracker is not None:
+            self.slow_request_tracker.observe(
+                context, time.time() - arrived_at
+            )
+        if self.metrics is not None:
+            self._observe_metrics(context, arrived_at)
+
+    def _observe_metrics(self, context, arrived_at):
+        service_method = context.service_method
+        self.metrics.observe_request(
+            service_method
+            if service_method in self._behind_method_names else '',
+            context.status_code or 500,
+            time.time() - arrived_at
+        )
+
+    def _route(self, environ, start_response):
+        context = environ[REQUEST_CONTEXT_ENVIRON_KEY]
+        started_at = time.time()
         try:
             match = self.dispatch_method(environ)
         except MethodDispatchError as e:
-            response = self.error(e.status_code, e.request, e.message)
+            context.record_phase('dispatch', started_at)
+            if e.errors:
+                # Errors of payload limits can be 413 as well as 400,
+                # which error() doesn't give the errors for.
+                response = self._raw_response(
+                    e.status_code,
+                    self.make_error_response(
+                        ERROR_TAGS.get(e.status_code, 'http_error'),
+                        e.message,
+                        errors=[
+                            {'path': path, 'message': msg}
+                            for path, msg in sorted(e.errors)
+                        ]
+                    )
+                )
+            else:
+                response = self.error(e.status_code, e.request, e.message)
         else:
+            context.record_phase('dispatch', started_at)
+            context.service_method = match.service_method
+            context.routed = match.routed
+            if match.routed:
+                context.route = self._uri_templates[match.service_method]
             if environ['REQUEST_METHOD'] == 'OPTIONS':
+                context.status_code = 200
                 start_response('200 OK', match.cors_headers)
                 return []
             if match.service_method:
@@ -361,10 +4464,8 @@ class WsgiApp(object):
                         else:
                             response.headers[k] = v
             else:
-                response = self.error(
-                    400, match.request,
-                    message="`method` is missing."
-                )
+                response = self.static_error(400, "`method` is missing.")
+        context.status_code = response.status_code
         return response(environ, start_response)
 
     def rpc(self, request, service_method, request_json):
@@ -388,49 +4489,278 @@ class WsgiApp(object):
                     service_method
                 )
             )
+        if self._accepts_bulk_calls(request, service_method):
+            return self._call_in_bulk(request, service_method,
+                                      method_facial_name, func, request_json)
+        started_at = time.time()
+        streamed = method_facial_name in self._argument_streams
+        uploaded = not streamed and \
+            self._accepts_binary_upload(request, service_method)
         try:
-            arguments = self._parse_procedure_arguments(
-                method_facial_name,
-                request_json
-            )
+            if streamed:
+                arguments = self._open_argument_stream(request,
+                                                       method_facial_name)
+            elif uploaded:
+                arguments = {
+                    self._binary_uploads[method_facial_name]:
+                    self.binary_uploads.read(request.stream,
+                                             request.content_length)
+                }
+            else:
+                arguments = self._parse_procedure_arguments(
+                    method_facial_name,
+                    request_json
+                )
         except MethodArgumentError as e:
+            record_phase('decode', started_at)
+            return self._respond_with_argument_errors(request, e)
+        record_phase('decode', started_at)
+        if self.deadline_policy is not None:
+            context = current_request_context()
+            self.deadline_policy.restrict(context, method_facial_name)
+            if context.expired:
+                return self.static_error(504, DEADLINE_EXPIRED_MESSAGE)
+        call = functools.partial(
+            self._call_service_method,
+            request, service_method, method_facial_name, func, arguments
+        )
+        if uploaded:
+            # Uploads are neither coalesced nor fingerprinted for idempotency,
+            # since that requires the whole body in memory.
+            try:
+                return call()
+            finally:
+                for argument in arguments.values():
+                    if not isinstance(argument, bytes):
+                        argument.close()
+        elif request.method == 'GET':
+            if self.single_flight is not None:
+                return self._call_coalesced(
+                    request, service_method, method_facial_name, arguments,
+                    call
+                )
+        elif self.idempotency_policy is not None and not streamed:
+            # Streamed arguments can't be fingerprinted without reading
+            # the whole payload.
+            idempotency_key = request.headers.get(
+                self.idempotency_policy.header
+            )
+            if idempotency_key:
+                return self._call_idempotently(
+                    request, method_facial_name, request_json,
+                    idempotency_key, call
+                )
+        return call()
+
+    def _call_coalesced(self, request, service_method, method_facial_name,
+                        arguments, call):
+        # Raw binary and JSON responses of the same call differ.
+        key = (method_facial_name, frozenset(arguments.items()),
+               self._responds_with_binary(request, method_facial_name))
+        try:
+            hash(key)
+        except TypeError:
+            # Calls with unhashable arguments can't be coalesced.
+            return call()
+        try:
+            # Share the encoded response rather than the response object,
+            # since every caller mutates its own response (e.g., CORS).
+            # Waits are bounded by the deadline of each request, rather than
+            # only the one running the call.
+            context = current_request_context()
+            status_code, headers, content = self.single_flight.call(
+                key, lambda: encode_response(call()),
+                None if context is None else context.remaining_time()
+            )
+        except SingleFlightTimeoutError:
+            if context is not None and context.expired:
+                return self.static_error(504, DEADLINE_EXPIRED_MESSAGE)
             return self.error(
-                400,
-                request,
-                message='There are invalid arguments.',
-                errors=[
-                    {'path': path, 'message': msg}
-                    for path, msg in sorted(e.errors)
-                ],
+                504, request,
+                message='Timed out while waiting for the identical call of '
+                        'the {0}() method in flight.'.format(
+                            service_method.replace('_', '-')
+                        )
+            )
+        return Response(content, status_code, headers)
+
+    def _call_idempotently(self, request, method_facial_name, request_json,
+                           idempotency_key, call):
+        policy = self.idempotency_policy
+        key = u'{0}:{1}'.format(method_facial_name, idempotency_key)
+        if self._responds_with_binary(request, method_facial_name):
+            # Raw binary and JSON responses of the same call differ.
+            key += u':binary'
+        fingerprint = hashlib.sha1(
+            json.dumps(request_json, sort_keys=True).encode('utf-8')
+        ).hexdigest()
+        called = []
+
+        def call_and_store():
+            stored = policy.store.get(key)
+            if stored is None:
+                called.append(True)
+                status_code, headers, content = encode_response(call())
+                stored = StoredResponse(fingerprint, status_code, headers,
+                                        content)
+                # Server-side errors are not stored so that clients can
+                # retry them.
+                if status_code < 500:
+                    policy.store.set(key, stored)
+            return stored
+        stored = policy.store.get(key)
+        if stored is None:
+            try:
+                stored = policy.single_flight.call(key, call_and_store)
+            except SingleFlightTimeoutError:
+                return self.error(
+                    409, request,
+                    message='A request with the same idempotency key is '
+                            'still in progress.'
+                )
+        if stored.fingerprint != fingerprint:
+            return self.error(
+                422, request,
+                message='The idempotency key has already been used for '
+                        'a request with different arguments.'
             )
+        response = Response(stored.content, stored.status_code,
+                            stored.headers)
+        if not called:
+            response.headers['Idempotent-Replayed'] = 'true'
+        return response
+
+    def _call_service_method(self, request, service_method,
+                             method_facial_name, func, arguments):
+        started_at = time.time()
         try:
             result = func(**arguments)
+            if _isawaitable is not None and _isawaitable(result):
+                result = self._await(result)
+        except ArgumentStreamError as e:
+            record_phase('call', started_at)
+            return self._respond_with_argument_errors(request, e)
+        except CoroutineTimeoutError:
+            record_phase('call', started_at)
+            return self.error(
+                504, request,
+                message='The {0}() method did not complete in time.'.format(
+                    service_method.replace('_', '-')
+                )
+            )
         except Exception as e:
+            started_at = record_phase('call', started_at)
             catched, resp = self._catch_exception(method_facial_name, e)
             if catched:
-                return self._raw_response(400, resp)
+                response = self._raw_response(400, resp)
+                record_phase('encode', started_at)
+                return response
             raise
+        started_at = record_phase('call', started_at)
+        if method_facial_name in self._argument_streams:
+            for argument in arguments.values():
+                if argument.error is not None:
+                    return self._respond_with_argument_errors(
+                        request, argument.error
+                    )
+        response = None
+        if self._responds_with_binary(request, method_facial_name):
+            response = self._respond_with_binary(request, result)
+        if response is None:
+            response = self._respond_with_method_result(
+                request, service_method, method_facial_name, result
+            )
+        if self._negotiates_binary(method_facial_name):
+            response.headers.add('Vary', 'Accept')
+        record_phase('encode', started_at)
+        return response
+
+    def _returns_binary(self, method_facial_name):
+        try:
+            return self._binary_results[method_facial_name]
+        except KeyError:
+            pass
+        if method_facial_name in self.service.__nirum_service_methods__:
+            return_type = \
+                self._method_type_hints(method_facial_name)['_return']
+            if is_optional_type(return_type):
+                none_type = type(None)
+                return_type, = [t for t in get_union_types(return_type)
+                                if t is not none_type]
+            binary = return_type is bytes
+        else:
+            binary = False
+        self._binary_results[method_facial_name] = binary
+        return binary
+
+    def _negotiates_binary(self, method_facial_name):
+        binary_responses = self.binary_responses
+        return binary_responses is not None and \
+            binary_responses.negotiate and \
+            method_facial_name not in binary_responses.methods and \
+            self._returns_binary(method_facial_name)
+
+    def _responds_with_binary(self, request, method_facial_name):
+        binary_responses = self.binary_responses
+        if binary_responses is None:
+            return False
+        elif method_facial_name in binary_responses.methods:
+            return True
+        # Accept: */* prefers JSON, the first one.
+        return self._negotiates_binary(method_facial_name) and \
+            request.accept_mimetypes.best_match(
+                ['application/json', 'application/octet-stream']
+            ) == 'application/octet-stream'
+
+    def _respond_with_binary(self, request, result):
+        # Other than bytes and file-like objects (e.g., None for optional
+        # binary) are left to the JSON response.
+        if isinstance(result, bytes):
+            return Response(result, 200, BINARY_RESPONSE_HEADERS)
+        elif not callable(getattr(result, 'read', None)):
+            return None
+        headers = list(BINARY_RESPONSE_HEADERS)
+        size = remaining_file_size(result)
+        if size is not None:
+            headers.append(('Content-Length', str(size)))
+        body = wrap_file(request.environ, result,
+                         self.binary_responses.block_size)
+        return Response(body, 200, headers, direct_passthrough=True)
+
+    def _await(self, awaitable):
+        runner = self.coroutine_runner
+        if runner is None:
+            runner = CoroutineRunner.shared()
+        context = current_request_context()
+        if context is None:
+            return runner.run(awaitable)
+        return runner.run(ContextualAwaitable(awaitable, context),
+                          context.remaining_time())
+
+    def _respond_with_method_result(self, request, service_method,
+                                    method_facial_name, result):
         success, resp = self._respond_with_result(
             method_facial_name,
             result
         )
         if not success:
             service_class = type(self.service)
-            logger = logging.getLogger(typing._type_repr(service_class)) \
-                            .getChild(str(method_facial_name))
+            logger = self._get_method_logger(method_facial_name)
+            # The result can be huge, so its repr is truncated rather than
+            # formatted in full on the request thread.
             if resp is None:
                 logger.error(
-                    '%s.%s() method must not return any value, but %r is '
+                    '%s.%s() method must not return any value, but %s is '
                     'returned.',
                     typing._type_repr(service_class),
                     method_facial_name,
-                    result
+                    truncated_repr(result)
                 )
             else:
                 logger.error(
-                    '%r is an invalid return value for the return type of '
+                    '%s is an invalid return value for the return type of '
                     '%s.%s() method.',
-                    result,
+                    truncated_repr(result),
                     typing._type_repr(service_class),
                     method_facial_name
                 )
@@ -449,6 +4779,197 @@ error and should be fixed by server-side.'''.format(hyphened_service_method)
         else:
             return self._raw_response(200, resp)
 
+    def _respond_with_argument_errors(self, request, error):
+        return self.error(
+            400,
+            request,
+            message='There are invalid arguments.',
+            errors=[
+                {'path': path, 'message': msg}
+                for path, msg in sorted(error.errors)
+            ],
+        )
+
+    def _compile_argument_stream(self, method_facial_name):
+        type_hints = self._method_type_hints(method_facial_name)
+        parameters = [
+            (name, type_) for name, type_ in type_hints.items()
+            if not name.startswith('_')
+        ]
+        if len(parameters) == 1:
+            argument_name, type_ = parameters[0]
+            origin = getattr(type_, '__origin__', None)
+            type_params = getattr(type_, '__args__', None)
+        else:
+            origin = None
+        if origin not in (typing.Sequence, typing.List) or \
+           not isinstance(type_params, tuple) or len(type_params) != 1:
+            raise TypeError(
+                'cannot stream the argument of {0}() method; it has to take '
+                'only a parameter of a list type'.format(method_facial_name)
+            )
+        element_type, = type_params
+        compiled = (
+            argument_name,
+            type_hints['_names'][argument_name],
+            typing._type_repr(element_type),
+            compile_deserializer(element_type),
+        )
+        self._argument_streams[method_facial_name] = compiled
+        return compiled
+
+    def _compile_binary_upload(self, method_facial_name):
+        if method_facial_name in self.service.__nirum_service_methods__:
+            type_hints = self._method_type_hints(method_facial_name)
+            parameters = [
+                (name, type_) for name, type_ in type_hints.items()
+                if not name.startswith('_')
+            ]
+        else:
+            parameters = []
+        if len(parameters) != 1 or parameters[0][1] is not bytes:
+            raise TypeError(
+                'cannot bind raw binary uploads to {0}() method; it has to '
+                'take only a parameter of binary'.format(method_facial_name)
+            )
+        argument_name = parameters[0][0]
+        self._binary_uploads[method_facial_name] = argument_name
+        return argument_name
+
+    def _accepts_binary_upload(self, request, service_method):
+        return service_method in self._uploaded_methods and \
+            request.mimetype == 'application/octet-stream'
+
+    def _accepts_bulk_calls(self, request, service_method):
+        return service_method in self._bulk_methods and \
+            request.mimetype == BulkCalls.MIMETYPE
+
+    def _call_in_bulk(self, request, service_method, method_facial_name,
+                      func, request_json):
+        lines = self.bulk_calls.lines(request.stream)
+        context = current_request_context()
+        if context is not None:
+            context.streamed = True
+
+        def stream():
+            # The body is iterated after the request is handled, so that
+            # the request context has to be restored for each call.
+            for line in lines:
+                previous_context = current_request_context()
+                _request_context.context = context
+                try:
+                    outcome = self._call_line(
+                        service_method, method_facial_name, func,
+                        request_json, line
+                    )
+                finally:
+                    _request_context.context = previous_context
+                yield json.dumps(outcome).encode('utf-8') + b'\n'
+        return Response(stream(), 200, BULK_RESPONSE_HEADERS)
+
+    def _call_line(self, service_method, method_facial_name, func,
+                   request_json, line):
+        if line is None:
+            return self._line_error(413, 'The line is too long.')
+        try:
+            arguments_json = json.loads(line.decode('utf-8'))
+        except ValueError as e:
+            return self._line_error(
+                400, "Invalid JSON payload: '{!s}'.".format(e)
+            )
+        if not isinstance(arguments_json, dict):
+            return self._line_error(
+                400, 'A line has to be a JSON object of arguments.'
+            )
+        try:
+            if self.payload_limits is not None:
+                self.payload_limits.check(arguments_json)
+            if request_json:
+                # Variables of the routed path are shared by every call.
+                arguments_json = dict(request_json, **arguments_json)
+            arguments = self._parse_procedure_arguments(method_facial_name,
+                                                        arguments_json)
+        except PayloadLimitError as e:
+            return self._line_error(e.status_code,
+                                    'The payload is too complex.', e.errors)
+        except MethodArgumentError as e:
+            return self._line_error(400, 'There are invalid arguments.',
+                                    e.errors)
+        context = current_request_context()
+        if context is not None and context.expired:
+            return self._line_error(504, DEADLINE_EXPIRED_MESSAGE)
+        try:
+            result = func(**arguments)
+            if _isawaitable is not None and _isawaitable(result):
+                result = self._await(result)
+        except CoroutineTimeoutError:
+            return self._line_error(
+                504, 'The {0}() method did not complete in time.'.format(
+                    service_method.replace('_', '-')
+                )
+            )
+        except Exception as e:
+            catched, error = self._catch_exception(method_facial_name, e)
+            if catched:
+                return {'status': 400, 'error': error}
+            # A call failing must not abort the rest of the stream.
+            self._get_method_logger(method_facial_name).exception(
+                'An unexpected exception is raised from %s() method in bulk.',
+                method_facial_name
+            )
+            return self._line_error(500)
+        success, serialized = self._respond_with_result(method_facial_name,
+                                                        result)
+        if not success:
+            self._get_method_logger(method_facial_name).error(
+                '%s is an invalid return value for the return type of '
+                '%s() method.',
+                truncated_repr(result), method_facial_name
+            )
+            return self._line_error(
+                500, 'The server-side implementation of the {0}() method has '
+                     'tried to return a value of an invalid type.'.format(
+                         service_method.replace('_', '-')
+                     )
+            )
+        return {'status': 200, 'result': serialized}
+
+    def _line_error(self, status_code, message=None, errors=None):
+        kwargs = {}
+        if errors:
+            kwargs['errors'] = [
+                {'path': path, 'message': msg} for path, msg in sorted(errors)
+            ]
+        return {
+            'status': status_code,
+            'error': self.make_error_response(
+                ERROR_TAGS.get(status_code, 'http_error'),
+                message or HTTP_STATUS_CODES.get(status_code, 'http error'),
+                **kwargs
+            ),
+        }
+
+    def _open_argument_stream(self, request, method_facial_name):
+        argument_name, behind_name, type_name, deserialize = \
+            self._argument_streams[method_facial_name]
+        stream = ArgumentStream(
+            request.stream, behind_name, type_name, deserialize,
+            chunk_size=self.argument_streaming.chunk_size,
+            max_element_size=self.argument_streaming.max_element_size
+        )
+        stream.start()
+        return {argument_name: stream}
+
+    def _get_method_logger(self, method_facial_name):
+        try:
+            return self._method_loggers[method_facial_name]
+        except KeyError:
+            logger = logging.getLogger(
+                typing._type_repr(type(self.service))
+            ).getChild(str(method_facial_name))
+            self._method_loggers[method_facial_name] = logger
+            return logger
+
     def _parse_procedure_arguments(self, method_facial_name, request_json):
         for cls in type(self.service).__mro__:
             if not hasattr(cls, method_facial_name):
@@ -525,42 +5046,60 @@ error and should be fixed by server-side.'''.format(hyphened_service_method)
         :return:
 
         """
-        status_code_text = HTTP_STATUS_CODES.get(status_code, 'http error')
-        status_error_tag = status_code_text.lower().replace(' ', '_')
-        custom_response_map = {
-            404: self.make_error_response(
-                status_error_tag,
-                'The requested URL {} was not found on this service.'.format(
-                    request.path
-                ),
-                **kwargs
-            ),
-            400: self.make_error_response(status_error_tag, message, **kwargs),
-            405: self.make_error_response(
-                status_error_tag,
-                'The requested URL {} was not allowed HTTP method {}.'.format(
-                    request.path, request.method
-                ),
-                **kwargs
-            ),
-        }
+        status_error_tag = ERROR_TAGS.get(status_code, 'http_error')
+        # Build only the error object to respond, since error responses are
+        # the hot path when scanners hit the service.
+        if status_code == 404:
+            message = 'The requested URL {} was not found on this ' \
+                      'service.'.format(request.path)
+        elif status_code == 405:
+            message = 'The requested URL {} was not allowed HTTP method ' \
+                      '{}.'.format(request.path, request.method)
+        elif status_code != 400:
+            message = message or HTTP_STATUS_CODES.get(status_code,
+                                                       'http error')
+            kwargs = {}
         return self._raw_response(
             status_code,
-            custom_response_map.get(
-                status_code,
-                self.make_error_response(
-                    status_error_tag, message or status_code_text
-                )
-            )
+            self.make_error_response(status_error_tag, message, **kwargs)
         )
 
+    def static_error(self, status_code, message=None):
+        """Handle error response whose content is the same for every request.
+        The content is encoded only once and then reused.
+
+        :param int status_code: Neither 404 nor 405, since their messages
+                                vary by requests.
+        :param str message: A constant message.  Do not pass messages
+                            varying by requests, since the content is cached
+                            per message.
+        :return:
+
+        """
+        if self._custom_make_response:
+            return self.error(status_code, None, message)
+        try:
+            content = self._static_errors[status_code, message]
+        except KeyError:
+            content = json.dumps(self.make_error_response(
+                ERROR_TAGS.get(status_code, 'http_error'),
+                message or HTTP_STATUS_CODES.get(status_code, 'http error')
+            )).encode('utf-8')
+            self._static_errors[status_code, message] = content
+        return Response(content, status_code, JSON_RESPONSE_HEADERS)
+
     def make_response(self, status_code, headers, content):
         return status_code, headers, content
 
     def _raw_response(self, status_code, response_json, **kwargs):
+        content = json.dumps(response_json).encode('utf-8')
+        if not self._custom_make_response:
+            # The triple made by the default make_response() is always valid.
+            return Response(content, status_code, JSON_RESPONSE_HEADERS,
+                            **kwargs)
         response_tuple = self.make_response(
             status_code, headers=[('Content-type', 'application/json')],
-            content=json.dumps(response_json).encode('utf-8')
+            content=content
         )
         if not (isinstance(response_tuple, collections.Sequence) and
                 len(response_tuple) == 3):
@@ -591,49 +5130,120 @@ error and should be fixed by server-side.'''.format(hyphened_service_method)
 
 
 class LegacyWsgiApp(WsgiApp):
+    """Create a WSGI application which adapts the given Nirum service
+    generated by the old compilers.  It takes the same parameters as
+    :class:`WsgiApp` does, and the following:
+
+    :param validate_results: Check whether return values of methods are
+                             valid for their return types.  Turned on by
+                             default.
+    :type validate_results: :class:`bool`
+
+    """
 
     def __init__(self, service,
                  allowed_origins=frozenset(),
-                 allowed_headers=frozenset()):
+                 allowed_headers=frozenset(),
+                 single_flight=None,
+                 deadline_policy=None,
+                 idempotency_policy=None,
+                 access_log=None,
+                 slow_request_tracker=None,
+                 health_check=None,
+                 payload_limits=None,
+                 argument_streaming=None,
+                 traffic_capture=None,
+                 metrics=None,
+                 coroutine_runner=None,
+                 binary_responses=None,
+                 binary_uploads=None,
+                 tracing=None,
+                 load_shedder=None,
+                 bulk_calls=None,
+                 validate_results=True):
         super(LegacyWsgiApp, self).__init__(
             service=service,
             allowed_origins=allowed_origins,
-            allowed_headers=allowed_headers
+            allowed_headers=allowed_headers,
+            single_flight=single_flight,
+            deadline_policy=deadline_policy,
+            idempotency_policy=idempotency_policy,
+            access_log=access_log,
+            slow_request_tracker=slow_request_tracker,
+            health_check=health_check,
+            payload_limits=payload_limits,
+            argument_streaming=argument_streaming,
+            traffic_capture=traffic_capture,
+            metrics=metrics,
+            coroutine_runner=coroutine_runner,
+            binary_responses=binary_responses,
+            binary_uploads=binary_uploads,
+            tracing=tracing,
+            load_shedder=load_shedder,
+            bulk_calls=bulk_calls
         )
+        self.validate_results = validate_results
+        self._deserializers = {}
+        self._serializers = {}
+        self._parameters = {}
+        self._results = {}
+        for method_facial_name in service.__nirum_service_methods__:
+            self._compile_parameters(method_facial_name)
+            self._compile_result(method_facial_name)
 
     def _parse_procedure_arguments(self, method_facial_name, request_json):
-        type_hints = self.service.__nirum_service_methods__[method_facial_name]
+        try:
+            parameters = self._parameters[method_facial_name]
+        except KeyError:
+            parameters = self._compile_parameters(method_facial_name)
         arguments = {}
-        version = type_hints.get('_v', 1)
-        name_map = type_hints['_names']
-        errors = MethodArgumentError()
-        for argument_name, type_ in type_hints.items():
-            if argument_name.startswith('_'):
-                continue
-            if version >= 2:
-                type_ = type_()
-            behind_name = name_map[argument_name]
+        errors = None
+        for argument_name, behind_name, path, type_name, optional, \
+                deserialize in parameters:
             try:
                 data = request_json[behind_name]
             except KeyError:
-                if is_optional_type(type_):
+                if optional:
                     arguments[argument_name] = None
-                else:
-                    errors.on_error('.' + behind_name, 'Expected to exist.')
+                    continue
+                if errors is None:
+                    errors = MethodArgumentError()
+                errors.on_error(path, 'Expected to exist.')
                 continue
             try:
-                arguments[argument_name] = deserialize_meta(type_, data)
+                arguments[argument_name] = deserialize(data)
             except ValueError:
+                if errors is None:
+                    errors = MethodArgumentError()
                 errors.on_error(
-                    '.' + behind_name,
+                    path,
                     'Expected {0}, but {1} was given.'.format(
-                        typing._type_repr(type_),
-                        typing._type_repr(type(data))
+                        type_name, typing._type_repr(type(data))
                     )
                 )
-        errors.raise_if_errored()
+        if errors is not None:
+            errors.raise_if_errored()
         return arguments
 
+    def _compile_parameters(self, method_facial_name):
+        # Everything about parameters but arguments is figured out only
+        # once: names, types, optionality, and deserializers.
+        type_hints = self._method_type_hints(method_facial_name)
+        name_map = type_hints['_names']
+        parameters = []
+        for argument_name, type_ in type_hints.items():
+            if argument_name.startswith('_'):
+                continue
+            behind_name = name_map[argument_name]
+            parameters.append((
+                argument_name, behind_name, '.' + behind_name,
+                typing._type_repr(type_), is_optional_type(type_),
+                compile_deserializer(type_, self._deserializers),
+            ))
+        parameters = tuple(parameters)
+        self._parameters[method_facial_name] = parameters
+        return parameters
+
     def _catch_exception(self, method_facial_name, exception):
         method_error_types = self.service.__nirum_method_error_types__
         if not callable(method_error_types):
@@ -645,44 +5255,187 @@ class LegacyWsgiApp(WsgiApp):
         return False, None
 
     def _respond_with_result(self, method_facial_name, result):
-        type_hints = self.service.__nirum_service_methods__[method_facial_name]
-        return_type = type_hints['_return']
-        if type_hints.get('_v', 1) >= 2:
-            return_type = return_type()
-        none_type = type(None)
-        if return_type is none_type or is_optional_type(return_type):
+        try:
+            nullable, serialize, validate = self._results[method_facial_name]
+        except KeyError:
+            nullable, serialize, validate = self._compile_result(
+                method_facial_name
+            )
+        if nullable:
             if result is None:
                 return True, None
             return False, None
         if result is None:
             return False, TypeError('the return type cannot be None')
         try:
-            serialized = serialize_meta(result)
-            deserialize_meta(return_type, serialized)
+            serialized = serialize(result)
+            if validate is not None:
+                validate(serialized)
         except ValueError as e:
             return False, e
         else:
             return True, serialized
 
+    def _compile_result(self, method_facial_name):
+        return_type = self._method_type_hints(method_facial_name)['_return']
+        none_type = type(None)
+        if return_type is none_type or is_optional_type(return_type):
+            compiled = True, None, None
+        else:
+            compiled = (
+                False,
+                compile_serializer(return_type, self._serializers),
+                compile_deserializer(return_type, self._deserializers)
+                if self.validate_results else None
+            )
+        self._results[method_facial_name] = compiled
+        return compiled
+
+
+class CompositeWsgiApp(object):
+    """Create a WSGI application which mounts several :class:`WsgiApp`\\ s
+    so that a single process can serve many services.
+
+    A mounted application is reachable in two ways:
+
+    - Under its path prefix, e.g., ``/music/?method=get_music`` and
+      ``/music/artists/damien/`` for the ``music`` mount.
+    - Through the root path with the ``service.method`` name, e.g.,
+      ``/?method=music.get_music``.
+
+    Either way, the mount is looked up in a single table at once regardless
+    of the number of mounts.  Every mount keeps its own settings, e.g., CORS,
+    since they are :class:`WsgiApp` instances.
+
+    :param mounts: The mapping of mount names to applications.  Names must
+                   not contain slashes or periods.
+    :type mounts: :class:`~typing.Mapping`\\ [:class:`str`, :class:`WsgiApp`]
+
+    """
+
+    def __init__(self, mounts):
+        for name, app in mounts.items():
+            if not isinstance(app, WsgiApp):
+                raise TypeError(
+                    'expected an instance of {0.__name__}, not {1!r}'.format(
+                        WsgiApp, app
+                    )
+                )
+            elif not name or '/' in name or '.' in name:
+                raise ValueError(
+                    'mount names must be nonempty and must not contain '
+                    'slashes or periods: ' + repr(name)
+                )
+        self.mounts = dict(mounts)
+        self._static_errors = {}
+
+    def __call__(self, environ, start_response):
+        """WSGI interface has to be callable."""
+        return self.route(environ, start_response)
+
+    def route(self, environ, start_response):
+        """Route an HTTP request to a corresponding mount, or respond with
+        an error status code if it found nothing.
+
+        :param environ: WSGI environment dictionary.
+        :param start_response: A WSGI `start_response` callable.
+
+        """
+        path_info = environ['PATH_INFO']
+        if path_info == '/':
+            querystring = environ['QUERY_STRING']
+            query = urlparse.parse_qsl(querystring, keep_blank_values=True)
+            for i, (key, value) in enumerate(query):
+                if key == 'method':
+                    name, _, service_method = value.partition('.')
+                    break
+            else:
+                return self._error(
+                    400, "`method` is missing.", environ, start_response
+                )
+            try:
+                app = self.mounts[name]
+            except KeyError:
+                return self._error(
+                    400, 'No service method `{}` found.'.format(value),
+                    environ, start_response
+                )
+            query[i] = 'method', service_method
+            environ['QUERY_STRING'] = urlparse.urlencode(query)
+            return app(environ, start_response)
+        name, slash, rest = path_info[1:].partition('/')
+        try:
+            app = self.mounts[name]
+        except KeyError:
+            return self._error(
+                404,
+                'The requested URL {} was not found on this '
+                'service.'.format(path_info),
+                environ, start_response
+            )
+        environ['SCRIPT_NAME'] = environ.get('SCRIPT_NAME', '') + '/' + name
+        environ['PATH_INFO'] = slash + rest or '/'
+        return app(environ, start_response)
+
+    def warm_up(self):
+        """Warm up all mounted applications.  See also
+        :meth:`WsgiApp.warm_up()`.
+
+        :return: The seconds taken to warm up.
+        :rtype: :class:`float`
+
+        """
+        return sum(app.warm_up() for app in self.mounts.values())
+
+    def close(self):
+        """Close all mounted applications.  See also
+        :meth:`WsgiApp.close()`.
+
+        """
+        for app in self.mounts.values():
+            app.close()
+
+    def _error(self, status_code, message, environ, start_response):
+        try:
+            content = self._static_errors[message]
+        except KeyError:
+            content = json.dumps({
+                '_type': 'error',
+                '_tag': ERROR_TAGS[status_code],
+                'message': message,
+            }).encode('utf-8')
+            if status_code != 404:
+                self._static_errors[message] = content
+        start_response(
+            '{0} {1}'.format(status_code, HTTP_STATUS_CODES[status_code]),
+            [('Content-Type', 'application/json'),
+             ('Content-Length', str(len(content)))]
+        )
+        return [content]
+
 
 class UriTemplateMatchResult(object):
 
+    __slots__ = 'result', '_variables'
+
     def __init__(self, result):
-        if result is not None:
-            self.result = List(result)
-        else:
-            self.result = None
+        self.result = None if result is None else list(result)
+        self._variables = None
 
     def __bool__(self):
         return self.result is not None
 
     __nonzero__ = __bool__
 
+    def __repr__(self):
+        return '{0.__module__}.{0.__name__}({1!r})'.format(
+            type(self), self.result
+        )
+
     def update(self, match_result):
         if self.result or match_result:
-            self.result = List(
-                itertools.chain(self.result or [], match_result.result or [])
-            )
+            self.result = (self.result or []) + (match_result.result or [])
+            self._variables = None
 
     def get_variable(self, variable_name):
         # Nirum compiler appends an underscore to the end of the given
@@ -690,16 +5443,23 @@ class UriTemplateMatchResult(object):
         # (e.g. `from` → `from_`, `def` → `def_`).
         # So we need to remove a trailing underscore from the
         # `variable_name` (if it has one) before looking up match results.
-        variable_name = variable_name.rstrip('_')
-        values = [
-            value
-            for name, value in self.result
-            if name == variable_name
-        ]
-        if values:
-            return values if len(values) > 1 else values[0]
-        else:
-            return None
+        variables = self._variables
+        if variables is None:
+            variables = {}
+            for name, value in self.result or ():
+                try:
+                    values = variables[name]
+                except KeyError:
+                    variables[name] = value
+                else:
+                    # Matched values are strings, so a list means that
+                    # the variable occurs more than once.
+                    if isinstance(values, list):
+                        values.append(value)
+                    else:
+                        variables[name] = [values, value]
+            self._variables = variables
+        return variables.get(variable_name.rstrip('_'))
 
 
 class UriTemplateMatcher(object):
@@ -716,6 +5476,7 @@ class UriTemplateMatcher(object):
             path_template = uri_template
             querystring_template = None
         self._names = []
+        self._name_set = None
         self.path_pattern = self.parse_path_template(path_template)
         self.querystring_pattern = self.parse_querystring_template(
             querystring_template
@@ -723,13 +5484,17 @@ class UriTemplateMatcher(object):
 
     @property
     def names(self):
-        return frozenset(self._names)
+        names = self._name_set
+        if names is None:
+            names = self._name_set = frozenset(self._names)
+        return names
 
     def add_variable(self, name):
-        if name in self.names:
+        if name in self._names:
             raise AnnotationError('every variable must not be duplicated: ' +
                                   name)
         self._names.append(name)
+        self._name_set = None
 
     def parse_path_template(self, template):
         result = []
@@ -767,25 +5532,822 @@ class UriTemplateMatcher(object):
         return name.replace(u'-', u'_')
 
     def match_path(self, path):
+        # Every named group of the patterns is a variable; see also
+        # parse_path_template() and parse_querystring_template().
         match = self.path_pattern.match(path)
-        r = None
         if match:
-            r = []
-            if self.names:
-                for name in self.names & set(match.groupdict().keys()):
-                    r.append((name, match.group(name)))
-        return UriTemplateMatchResult(r)
+            return UriTemplateMatchResult(match.groupdict().items())
+        return UriTemplateMatchResult(None)
 
     def match_querystring(self, querystring):
         variables = []
-        match_result = None
+        matched = 0
         for pattern in self.querystring_pattern:
+            found = False
             for match in pattern.finditer(querystring):
-                for name in self.names & set(match.groupdict().keys()):
-                    variables.append((name, match.group(name)))
-        if len(set(n for n, _ in variables)) == len(self.querystring_pattern):
-            match_result = UriTemplateMatchResult(variables)
-        return match_result
+                variables.extend(match.groupdict().items())
+                found = True
+            matched += found
+        if matched == len(self.querystring_pattern):
+            return UriTemplateMatchResult(variables)
+        return None
+
+
+class KeepAliveRequestHandler(WSGIRequestHandler):
+    """A request handler which keeps HTTP/1.1 connections alive until
+    they are idle for :attr:`ThreadPoolServer.keep_alive_timeout`.
+
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    #: (:class:`int`) The maximum number of unread bytes of a request body
+    #: to skip in order to keep the connection alive.  The connection is
+    #: closed instead if more bytes are left.
+    max_unread_size = 65536
+
+    def setup(self):
+        self.timeout = self.server.keep_alive_timeout
+        WSGIRequestHandler.setup(self)
+
+    def make_environ(self):
+        environ = WSGIRequestHandler.make_environ(self)
+        if environ.get('wsgi.input_terminated'):
+            # The rest of a chunked body can't be skipped cheaply.
+            self.close_connection = True
+        else:
+            environ['wsgi.input'] = LimitedStream(
+                environ['wsgi.input'],
+                int(environ.get('CONTENT_LENGTH') or 0)
+            )
+        return environ
+
+    def run_wsgi(self):
+        try:
+            int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            # Where the body ends is unknown, so the connection can't be
+            # kept alive either.
+            self.close_connection = True
+            self.send_error(400, 'Malformed Content-Length')
+            return
+        WSGIRequestHandler.run_wsgi(self)
+        # The next request on the connection follows the body, so the body
+        # has to be read to the end even if the application didn't.
+        stream = self.environ['wsgi.input']
+        if not isinstance(stream, LimitedStream) or self.close_connection:
+            return
+        if stream.limit - stream.tell() > self.max_unread_size:
+            self.close_connection = True
+            return
+        try:
+            stream.exhaust()
+        except (socket.error, socket.timeout):
+            self.close_connection = True
+
+
+class ThreadPoolServer(BaseWSGIServer):
+    """A WSGI server which handles connections on a fixed number of
+    threads, unlike :func:`werkzeug.serving.run_simple()` which spawns
+    a thread per connection.  Accepted connections wait for a thread in
+    a bounded queue, and connections beyond that wait in the listen
+    backlog of the kernel, so that memory usage and latency stay
+    predictable under connection storms.
+
+    :param host: The host to listen.
+    :type host: :class:`str`
+    :param port: The port number to listen.
+    :type port: :class:`int`
+    :param app: The WSGI application to serve.
+    :param threads: The number of threads to handle connections.
+    :type threads: :class:`int`
+    :param backlog: The maximum number of connections waiting for a thread,
+                    which is also the listen backlog.
+    :type backlog: :class:`int`
+    :param keep_alive_timeout: The seconds to keep an idle connection alive.
+    :type keep_alive_timeout: :class:`float`
+    :param send_buffer_size: The size of the send buffer of sockets in
+                             bytes.  The system default is used if omitted.
+    :type send_buffer_size: :class:`int`
+    :param receive_buffer_size: The size of the receive buffer of sockets
+                                in bytes.  The system default is used if
+                                omitted.
+    :type receive_buffer_size: :class:`int`
+    :param fd: The file descriptor of an already listening socket to serve
+               on, e.g., the one shared by :class:`WorkerSupervisor`.
+    :type fd: :class:`int`
+
+    """
+
+    multithread = True
+
+    def __init__(self, host, port, app, threads=8, backlog=128,
+                 keep_alive_timeout=5.0, send_buffer_size=None,
+                 receive_buffer_size=None, passthrough_errors=False,
+                 fd=None):
+        if threads < 1:
+            raise ValueError('threads must be greater than zero, not ' +
+                             repr(threads))
+        self.threads = threads
+        self.request_queue_size = backlog
+        self.keep_alive_timeout = keep_alive_timeout
+        self.send_buffer_size = send_buffer_size
+        self.receive_buffer_size = receive_buffer_size
+        self._connections = queue.Queue(backlog)
+        self._workers = []
+        BaseWSGIServer.__init__(self, host, port, app,
+                                handler=KeepAliveRequestHandler,
+                                passthrough_errors=passthrough_errors,
+                                fd=fd)
+        if fd is not None:
+            # server_bind() was called for a placeholder socket instead.
+            self._set_buffer_sizes()
+        for i in range(threads):
+            worker = threading.Thread(
+                target=self._work,
+                name='{0}-{1}'.format(type(self).__name__, i)
+            )
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def server_bind(self):
+        self._set_buffer_sizes()
+        BaseWSGIServer.server_bind(self)
+
+    def _set_buffer_sizes(self):
+        # Accepted sockets inherit the buffer sizes of the listening socket.
+        for option, size in [(socket.SO_SNDBUF, self.send_buffer_size),
+                             (socket.SO_RCVBUF, self.receive_buffer_size)]:
+            if size is not None:
+                self.socket.setsockopt(socket.SOL_SOCKET, option, size)
+
+    def process_request(self, request, client_address):
+        # It blocks accepting connections while the queue is full.
+        self._connections.put((request, client_address))
+
+    def _work(self):
+        while True:
+            request, client_address = self._connections.get()
+            if request is None:
+                break
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def server_close(self):
+        for _ in self._workers:
+            self._connections.put((None, None))
+        for worker in self._workers:
+            worker.join()
+        del self._workers[:]
+        BaseWSGIServer.server_close(self)
+
+
+def resident_set_size(pid):
+    """Get the resident set size (RSS) of a process from :file:`/proc`.
+
+    :param pid: The process ID.
+    :type pid: :class:`int`
+    :return: The resident set size in bytes, or :const:`None` if it can't
+             be read (e.g., the process has exited or the system has no
+             :file:`/proc`).
+    :rtype: :class:`int`
+
+    """
+    try:
+        with open('/proc/{0}/statm'.format(pid)) as f:
+            return int(f.read().split()[1]) * mmap.PAGESIZE
+    except (EnvironmentError, IndexError, ValueError):
+        return None
+
+
+class WorkerSupervisor(object):
+    """Serve on a listening socket shared by forked worker processes, and
+    recycle workers which have grown too large or served too many requests.
+
+    Slow leaks of service implementations and heap fragmentation make
+    the memory of long-running workers grow.  The supervisor checks
+    the resident set size (RSS) of each worker from :file:`/proc` and
+    the number of requests it has served.  A worker crossing a threshold
+    is sent :const:`~signal.SIGTERM`, and then it stops accepting
+    connections and exits after finishing its in-flight requests, while
+    a replacement is spawned right away.  Workers are recycled one at
+    a time, at least ``stagger`` seconds apart, and ``max_requests`` is
+    jittered per worker, so that workers don't restart all at once.
+
+    Since workers exit without running :mod:`atexit` handlers, a worker
+    calls the ``close()`` method of the application of its server
+    (e.g., :meth:`WsgiApp.close()`) if any, and flushes and closes logging
+    handlers (see also :func:`logging.shutdown()`) before it exits.
+
+    It's available on POSIX systems only, since it forks.
+
+    :param make_server: A callable which takes the file descriptor of
+                        the listening socket and returns a server to run in
+                        a worker, e.g., :class:`ThreadPoolServer`.
+    :param host: The host to listen.
+    :type host: :class:`str`
+    :param port: The port number to listen.
+    :type port: :class:`int`
+    :param workers: The number of worker processes.
+    :type workers: :class:`int`
+    :param max_rss: Recycle a worker when its RSS exceeds this bytes.
+                    :const:`None` means no limit.
+    :type max_rss: :class:`int`
+    :param max_requests: Recycle a worker when it has served this number
+                         of requests.  :const:`None` means no limit.
+    :type max_requests: :class:`int`
+    :param max_requests_jitter: The maximum random number added to
+                                ``max_requests`` of each worker.
+    :type max_requests_jitter: :class:`int`
+    :param stagger: The minimum seconds between recycling workers.
+    :type stagger: :class:`float`
+    :param graceful_timeout: The seconds to wait for a stopping worker to
+                             finish its in-flight requests before killing it.
+    :type graceful_timeout: :class:`float`
+    :param check_interval: The seconds between checks of workers.
+    :type check_interval: :class:`float`
+    :param backlog: The listen backlog of the shared socket.
+    :type backlog: :class:`int`
+
+    """
+
+    def __init__(self, make_server, host, port, workers=2,
+                 max_rss=None, max_requests=None, max_requests_jitter=0,
+                 stagger=5.0, graceful_timeout=30.0, check_interval=1.0,
+                 backlog=128):
+        if workers < 1:
+            raise ValueError('workers must be greater than zero, not ' +
+                             repr(workers))
+        self.make_server = make_server
+        self.workers = workers
+        self.max_rss = max_rss
+        self.max_requests = max_requests
+        self.max_requests_jitter = max_requests_jitter
+        self.stagger = stagger
+        self.graceful_timeout = graceful_timeout
+        self.check_interval = check_interval
+        family = socket.AF_INET6 if ':' in host else socket.AF_INET
+        self.socket = socket.socket(family, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((host, port))
+        self.socket.listen(backlog)
+        self.port = self.socket.getsockname()[1]
+        self._workers = {}
+        self._recycled_at = None
+
+    @property
+    def pids(self):
+        """The process IDs of the workers which are serving, excluding
+        the stopping ones.
+
+        """
+        return frozenset(pid for pid, worker in self._workers.items()
+                         if worker.stopping_at is None)
+
+    def run(self):
+        """Spawn workers and supervise them until the supervisor receives
+        :const:`~signal.SIGINT` or :const:`~signal.SIGTERM`.
+
+        """
+        received = []
+
+        def receive(signum, frame):
+            received.append(signum)
+        handlers = {
+            signum: signal.signal(signum, receive)
+            for signum in (signal.SIGINT, signal.SIGTERM)
+        }
+        try:
+            while not received:
+                self.supervise()
+                time.sleep(self.check_interval)
+        finally:
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+            self.stop()
+
+    def supervise(self):
+        """Check workers once: reap exited ones, spawn missing ones, kill
+        ones which don't stop in time, and recycle at most one worker
+        crossing the thresholds.
+
+        """
+        self._reap()
+        now = time.time()
+        serving = []
+        for worker in self._workers.values():
+            if worker.stopping_at is None:
+                serving.append(worker)
+            elif now - worker.stopping_at > self.graceful_timeout:
+                self._kill(worker.pid, signal.SIGKILL)
+        for _ in range(self.workers - len(serving)):
+            self._spawn()
+        if self._recycled_at is not None and \
+           now - self._recycled_at < self.stagger:
+            return
+        for worker in serving:
+            reason = self._recycle_reason(worker)
+            if reason is not None:
+                logging.getLogger(__name__).info(
+                    'Recycling the worker %d: %s.', worker.pid, reason
+                )
+                worker.stopping_at = self._recycled_at = now
+                self._kill(worker.pid, signal.SIGTERM)
+                self._spawn()
+                break
+
+    def _recycle_reason(self, worker):
+        if worker.max_requests is not None and \
+           worker.requests.value >= worker.max_requests:
+            return 'served {0} requests'.format(worker.requests.value)
+        if self.max_rss is not None:
+            rss = resident_set_size(worker.pid)
+            if rss is not None and rss > self.max_rss:
+                return 'its RSS is {0} bytes'.format(rss)
+        return None
+
+    def _spawn(self):
+        requests = multiprocessing.RawValue('L', 0)
+        max_requests = self.max_requests
+        if max_requests is not None and self.max_requests_jitter:
+            max_requests += random.randint(0, self.max_requests_jitter)
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                self._serve(requests)
+                status = 0
+            except BaseException:
+                logging.getLogger(__name__).exception('The worker crashed.')
+            finally:
+                os._exit(status)
+        self._workers[pid] = _Worker(pid, requests, max_requests)
+        return pid
+
+    def _serve(self, requests):
+        # Runs in a worker.  The supervisor decides when to stop workers.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        server = self.make_server(self.socket.fileno())
+        app = server.app
+
+        def counting_app(environ, start_response):
+            requests.value += 1
+            return app(environ, start_response)
+        server.app = counting_app
+
+        def stop(signum, frame):
+            # shutdown() waits for serve_forever() to return, so it can't be
+            # called from the thread running serve_forever().
+            threading.Thread(target=server.shutdown).start()
+        signal.signal(signal.SIGTERM, stop)
+        try:
+            server.serve_forever()
+        finally:
+            try:
+                # It waits for in-flight requests.
+                server.server_close()
+                close = getattr(app, 'close', None)
+                if close is not None:
+                    close()
+            finally:
+                # The worker exits through os._exit(), which doesn't run
+                # atexit handlers including logging.shutdown().
+                logging.shutdown()
+
+    def _reap(self):
+        while self._workers:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except OSError:  # ECHILD
+                break
+            if not pid:
+                break
+            worker = self._workers.pop(pid, None)
+            if worker is not None and worker.stopping_at is None:
+                logging.getLogger(__name__).warning(
+                    'The worker %d exited unexpectedly.', pid
+                )
+
+    @staticmethod
+    def _kill(pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError:  # Already exited
+            pass
+
+    def stop(self):
+        """Stop all workers gracefully, and close the listening socket."""
+        now = time.time()
+        for worker in self._workers.values():
+            if worker.stopping_at is None:
+                worker.stopping_at = now
+                self._kill(worker.pid, signal.SIGTERM)
+        while self._workers:
+            self._reap()
+            if time.time() - now > self.graceful_timeout:
+                for pid in self._workers:
+                    self._kill(pid, signal.SIGKILL)
+            time.sleep(0.05)
+        self.socket.close()
+
+
+class _Worker(object):
+
+    __slots__ = 'pid', 'requests', 'max_requests', 'stopping_at'
+
+    def __init__(self, pid, requests, max_requests):
+        self.pid = pid
+        self.requests = requests
+        self.max_requests = max_requests
+        self.stopping_at = None
+
+
+def _sample_json(cls, depth=0):
+    # A JSON value which can be deserialized as the given type, to make
+    # requests for benchmarks.  Recursive types are cut off with nulls.
+    if depth > 8:
+        return None
+    if hasattr(cls, '__nirum_tag__') or hasattr(cls, 'Tag'):
+        if not hasattr(cls, '__nirum_tag__'):
+            variants = cls.__subclasses__()
+            if not variants:
+                return None
+            cls = variants[0]
+        tag_types = cls.__nirum_tag_types__
+        if callable(tag_types):
+            tag_types = dict(tag_types())
+        names = cls.__nirum_tag_names__
+        value = {
+            names[name]: _sample_json(type_, depth + 1)
+            for name, type_ in tag_types.items()
+        }
+        value['_type'] = cls.__nirum_union_behind_name__
+        value['_tag'] = cls.__nirum_tag__.value
+        return value
+    elif hasattr(cls, '__nirum_record_behind_name__'):
+        field_types = cls.__nirum_field_types__
+        if callable(field_types):
+            field_types = field_types()
+        names = cls.__nirum_field_names__
+        value = {
+            names[name]: _sample_json(type_, depth + 1)
+            for name, type_ in field_types.items()
+        }
+        value['_type'] = cls.__nirum_record_behind_name__
+        return value
+    elif (hasattr(cls, '__nirum_get_inner_type__') or
+          hasattr(cls, '__nirum_inner_type__')):
+        try:
+            inner_type = cls.__nirum_get_inner_type__()
+        except AttributeError:
+            inner_type = cls.__nirum_inner_type__
+        return _sample_json(inner_type, depth + 1)
+    elif is_optional_type(cls):
+        return None
+    elif is_support_abstract_type(cls):
+        return {} if (cls.__origin__ or cls) is typing.Dict else []
+    elif isinstance(cls, enum.EnumMeta):
+        return next(iter(cls)).value
+    elif cls is datetime.datetime:
+        return u'2018-01-01T00:00:00Z'
+    elif cls is datetime.date:
+        return u'2018-01-01'
+    elif cls is uuid.UUID:
+        return text_type(uuid.UUID(int=0))
+    elif cls is decimal.Decimal:
+        return u'1'
+    elif cls is bool:
+        return True
+    elif cls is float:
+        return 1.0
+    elif cls in integer_types or cls is numbers.Integral:
+        return 1
+    elif cls in string_types or cls is text_type:
+        return u'nirum'
+    return None
+
+
+def percentile(sorted_values, p):
+    """Get the ``p``-th percentile of the given values by the nearest-rank
+    method.
+
+    :param sorted_values: Values sorted in ascending order.
+    :type sorted_values: :class:`~typing.Sequence`\\ [:class:`float`]
+    :param p: A percentile in 0--100, e.g., ``99.9``.
+    :type p: :class:`float`
+    :return: The percentile, or :const:`None` if there are no values.
+    :rtype: :class:`float`
+
+    """
+    if not sorted_values:
+        return None
+    rank = int(math.ceil(p * len(sorted_values) / 100.0))
+    return sorted_values[min(max(rank, 1), len(sorted_values)) - 1]
+
+
+class BenchmarkResult(object):
+    """The result of :meth:`Benchmark.run()`.
+
+    :param latencies: The seconds taken by each request.
+    :type latencies: :class:`~typing.Sequence`\\ [:class:`float`]
+    :param statuses: The number of responses per status code.
+    :type statuses: :class:`~typing.Mapping`\\ [:class:`int`, :class:`int`]
+    :param kinds: The number of requests per kind.
+    :type kinds: :class:`~typing.Mapping`\\ [:class:`str`, :class:`int`]
+    :param duration: The wall-clock seconds taken by the whole run.
+    :type duration: :class:`float`
+    :param workers: A description of workers, e.g., ``'4 threads'``.
+    :type workers: :class:`str`
+
+    """
+
+    #: (:class:`~typing.Sequence`\\ [:class:`float`]) Percentiles to
+    #: report.
+    percentiles = 50, 90, 99, 99.9
+
+    def __init__(self, latencies, statuses, kinds, duration, workers):
+        self.latencies = sorted(latencies)
+        self.statuses = dict(statuses)
+        self.kinds = dict(kinds)
+        self.duration = duration
+        self.workers = workers
+
+    @property
+    def throughput(self):
+        """(:class:`float`) Requests per second."""
+        return len(self.latencies) / self.duration if self.duration else 0.0
+
+    def percentile(self, p):
+        """Get the ``p``-th percentile of latencies in seconds."""
+        return percentile(self.latencies, p)
+
+    def report(self):
+        """Format the result for humans.
+
+        :rtype: :class:`str`
+
+        """
+        lines = [
+            'Requests:    {0} ({1})'.format(
+                len(self.latencies),
+                ', '.join('{0} {1}'.format(k, n)
+                          for k, n in sorted(self.kinds.items()))
+            ),
+            'Workers:     ' + self.workers,
+            'Duration:    {0:.3f} s'.format(self.duration),
+            'Throughput:  {0:.1f} requests/s'.format(self.throughput),
+        ]
+        if self.latencies:
+            lines.append('Latency:     ' + ', '.join(
+                'p{0:g} {1:.3f} ms'.format(p, self.percentile(p) * 1000)
+                for p in self.percentiles
+            ))
+        lines.append('Statuses:    ' + ', '.join(
+            '{0} {1}'.format(code, n)
+            for code, n in sorted(self.statuses.items())
+        ))
+        return '\n'.join(lines)
+
+
+class Benchmark(object):
+    """Measure the dispatch capacity of a :class:`WsgiApp` in-process,
+    without any HTTP server or external load tools, by driving it with
+    a mix of requests:
+
+    ``routed``
+       Requests to methods routed through ``http-resource`` annotations.
+
+    ``rpc``
+       ``POST /?method=...`` calls of every method.
+
+    ``error``
+       Requests which fail to dispatch, e.g., unknown paths and methods,
+       and invalid JSON payloads.
+
+    Arguments are made up from the types of parameters, so that they can
+    be decoded.
+
+    :param app: The application to measure.
+    :type app: :class:`WsgiApp`
+    :param mix: The weights of kinds of requests.  All kinds are equally
+                weighted by default.
+    :type mix: :class:`~typing.Mapping`\\ [:class:`str`, :class:`int`]
+    :param stub: Replace service methods with stubs that immediately
+                 return made-up results, so that only the overhead of
+                 the framework is measured.
+    :type stub: :class:`bool`
+
+    """
+
+    kinds = 'error', 'routed', 'rpc'
+
+    def __init__(self, app, mix=None, stub=False):
+        if not isinstance(app, WsgiApp):
+            raise TypeError('app must be an instance of {0.__name__}, not '
+                            '{1!r}'.format(WsgiApp, app))
+        mix = dict.fromkeys(self.kinds, 1) if mix is None else dict(mix)
+        unknown_kinds = frozenset(mix) - frozenset(self.kinds)
+        if unknown_kinds:
+            raise ValueError('unknown kinds of requests: ' +
+                             ', '.join(sorted(unknown_kinds)))
+        if stub:
+            # A shallow copy, since WsgiApp.__new__() takes a service.
+            stubbed_app = object.__new__(type(app))
+            stubbed_app.__dict__.update(app.__dict__)
+            stubbed_app.service = self._stub_service(app)
+            app = stubbed_app
+        self.app = app
+        self.samples = self._make_samples()
+        # Kinds without any sample (e.g., no routed methods) are left out.
+        self.mix = {
+            kind: weight for kind, weight in mix.items()
+            if weight > 0 and self.samples[kind]
+        }
+        if not self.mix:
+            raise ValueError('there are no requests to make')
+
+    def _sample_arguments(self, method_facial_name):
+        type_hints = self.app._method_type_hints(method_facial_name)
+        names = type_hints['_names']
+        return {
+            names[name]: _sample_json(type_)
+            for name, type_ in type_hints.items()
+            if not name.startswith('_')
+        }
+
+    def _stub_service(self, app):
+        service = copy.copy(app.service)
+        for method_facial_name in service.__nirum_service_methods__:
+            return_type = app._method_type_hints(method_facial_name)['_return']
+            try:
+                result = compile_deserializer(return_type)(
+                    _sample_json(return_type)
+                )
+            except Exception:
+                result = None
+            setattr(service, method_facial_name,
+                    functools.partial(self._stub_method, result))
+        return service
+
+    @staticmethod
+    def _stub_method(result, **kwargs):
+        return result
+
+    def _make_samples(self):
+        # Samples are (HTTP method, path, query string, body) tuples.
+        service = self.app.service
+        behind_names = service.__nirum_method_names__
+        samples = {kind: [] for kind in self.kinds}
+        for method_facial_name in sorted(service.__nirum_service_methods__):
+            arguments = self._sample_arguments(method_facial_name)
+            samples['rpc'].append((
+                'POST', '/', 'method=' + behind_names[method_facial_name],
+                json.dumps(arguments)
+            ))
+        for rule in self.app.rules:
+            arguments = self._sample_arguments(rule.name)
+            path, _, querystring = UriTemplateMatcher.VARIABLE_PATTERN.sub(
+                lambda m: urlparse.quote(text_type(
+                    arguments.get(m.group(1).replace('-', '_'), u'0')
+                ).encode('utf-8')),
+                rule.uri_template
+            ).partition(u'?')
+            body = None if rule.verb in ('GET', 'DELETE') else \
+                json.dumps(arguments)
+            samples['routed'].append((rule.verb, path, querystring, body))
+        samples['error'].extend([
+            ('GET', '/no-such-path/', '', None),
+            ('POST', '/', 'method=no_such_method', '{}'),
+            ('POST', '/', '', '{}'),
+        ])
+        if samples['rpc']:
+            method, path, querystring, _ = samples['rpc'][0]
+            samples['error'].append((method, path, querystring, '{'))
+        return samples
+
+    def plan(self, requests, seed=None):
+        """Choose the given number of requests from samples along with
+        the weights of :attr:`mix`.
+
+        :return: Pairs of kinds and samples of requests.
+        :rtype: :class:`~typing.Sequence`\\ [:class:`~typing.Tuple`\\
+                [:class:`str`, :class:`~typing.Tuple`]]
+
+        """
+        rng = random.Random(seed)
+        kinds = sorted(self.mix)
+        cumulative_weights = []
+        total = 0
+        for kind in kinds:
+            total += self.mix[kind]
+            cumulative_weights.append(total)
+        plan = []
+        for _ in range(requests):
+            kind = kinds[bisect.bisect_right(cumulative_weights,
+                                             rng.random() * total)]
+            plan.append((kind, rng.choice(self.samples[kind])))
+        return plan
+
+    def run(self, requests=10000, concurrency=1, processes=False, seed=None):
+        """Make the given number of requests across ``concurrency``
+        threads, or forked processes if ``processes`` is :const:`True`.
+
+        :param requests: The total number of requests to make.
+        :type requests: :class:`int`
+        :param concurrency: The number of threads or processes.
+        :type concurrency: :class:`int`
+        :param processes: Use processes instead of threads.
+        :type processes: :class:`bool`
+        :param seed: The seed to choose requests.
+        :return: The result.
+        :rtype: :class:`BenchmarkResult`
+
+        """
+        if concurrency < 1:
+            raise ValueError('concurrency must be greater than zero, not ' +
+                             repr(concurrency))
+        plan = self.plan(requests, seed)
+        shares = [plan[i::concurrency] for i in range(concurrency)]
+        started_at = time.time()
+        if processes:
+            results = multiprocessing.Queue()
+            workers = [
+                multiprocessing.Process(target=self._drive_into,
+                                        args=(share, results))
+                for share in shares
+            ]
+        else:
+            results = queue.Queue()
+            workers = [
+                threading.Thread(target=self._drive_into,
+                                 args=(share, results))
+                for share in shares
+            ]
+        for worker in workers:
+            worker.start()
+        # Results have to be received before joining processes, or they
+        # can block on a full pipe.
+        outcomes = [results.get() for _ in workers]
+        for worker in workers:
+            worker.join()
+        duration = time.time() - started_at
+        latencies = []
+        statuses = collections.Counter()
+        for worker_latencies, worker_statuses in outcomes:
+            latencies.extend(worker_latencies)
+            statuses.update(worker_statuses)
+        return BenchmarkResult(
+            latencies, statuses,
+            collections.Counter(kind for kind, _ in plan),
+            duration,
+            '{0} {1}{2}'.format(
+                concurrency,
+                'process' if processes else 'thread',
+                ('es' if processes else 's') if concurrency > 1 else ''
+            )
+        )
+
+    def _drive_into(self, plan, results):
+        results.put(self.drive(plan))
+
+    def drive(self, plan):
+        """Make the requests of the given ``plan`` in order on the current
+        thread.
+
+        :return: The pair of latencies and the number of responses per
+                 status code.
+
+        """
+        clock = getattr(time, 'perf_counter', time.time)
+        app = self.app
+        latencies = []
+        statuses = collections.Counter()
+        status = []
+
+        def start_response(status_, headers, exc_info=None):
+            status.append(status_)
+        for _, (method, path, querystring, body) in plan:
+            # Environments are made before the clock starts, since servers
+            # make them as well.
+            environ = create_environ(path, method=method,
+                                     query_string=querystring, data=body,
+                                     content_type='application/json')
+            del status[:]
+            started_at = clock()
+            try:
+                for _ in app(environ, start_response):
+                    pass
+            except Exception:
+                # Servers respond to unhandled exceptions with 500.
+                status[:] = ['500 Internal Server Error']
+            latencies.append(clock() - started_at)
+            statuses[int(status[-1].split(None, 1)[0])] += 1
+        return latencies, dict(statuses)
 
 
 IMPORT_RE = re.compile(
@@ -801,6 +6363,10 @@ IMPORT_RE = re.compile(
     re.X
 )
 
+# NAME=IMPORT_PATH of nirum-server; the name has neither ":" nor "(" so that
+# keyword arguments of a single import path (e.g., x:y(z=1)) don't match.
+MOUNT_RE = re.compile(r'^(?P<name>[\w-]+)=(?P<import_path>.+)$')
+
 
 def import_string(imp):
     m = IMPORT_RE.match(imp)
@@ -821,21 +6387,201 @@ def import_string(imp):
         return v
 
 
-def main():
-    parser = argparse.ArgumentParser(description='Nirum service runner')
+def bench_main(args=None):
+    """The ``nirum-server bench`` command.  See also :class:`Benchmark`."""
+    parser = argparse.ArgumentParser(
+        prog='nirum-server bench',
+        description='Measure the dispatch capacity of a Nirum service '
+                    'in-process'
+    )
+    parser.add_argument('-n', '--requests', type=int, default=10000,
+                        help='the number of requests to make '
+                             '[default: %(default)s]')
+    parser.add_argument('-c', '--concurrency', type=int, default=1,
+                        help='the number of threads (or processes) to make '
+                             'requests [default: %(default)s]')
+    parser.add_argument('--processes', action='store_true', default=False,
+                        help='make requests across processes instead of '
+                             'threads')
+    parser.add_argument('--mix', default='routed=1,rpc=1,error=1',
+                        help='the weights of kinds of requests '
+                             '[default: %(default)s]')
+    parser.add_argument('--stub', action='store_true', default=False,
+                        help='replace service methods with stubs so that '
+                             'only the overhead of the framework is '
+                             'measured')
+    parser.add_argument('--seed', type=int, help='the seed to choose requests')
+    parser.add_argument('service', help='Import path to service instance')
+    args = parser.parse_args(args)
+    mix = {}
+    for pair in args.mix.split(','):
+        kind, eq, weight = pair.partition('=')
+        try:
+            mix[kind.strip()] = int(weight)
+        except ValueError:
+            parser.error('--mix has to be KIND=WEIGHT pairs separated by '
+                         'commas: ' + args.mix)
+    if not ('.' in sys.path or os.getcwd() in sys.path):
+        sys.path.insert(0, os.getcwd())
+    try:
+        benchmark = Benchmark(WsgiApp(import_string(args.service)),
+                              mix=mix, stub=args.stub)
+    except ValueError as e:
+        parser.error(str(e))
+    result = benchmark.run(args.requests, concurrency=args.concurrency,
+                           processes=args.processes, seed=args.seed)
+    sys.stdout.write(result.report() + '\n')
+
+
+def replay_main(args=None):
+    """The ``nirum-server replay`` command.  See also
+    :func:`replay_traffic()`.
+
+    """
+    parser = argparse.ArgumentParser(
+        prog='nirum-server replay',
+        description='Replay captured traffic on a Nirum service, and compare '
+                    'responses with the captured ones'
+    )
+    parser.add_argument('service', help='Import path to service instance')
+    parser.add_argument('captures', nargs='+',
+                        help='files captured by TrafficCapture; give rotated '
+                             'files from the oldest')
+    args = parser.parse_args(args)
+    if not ('.' in sys.path or os.getcwd() in sys.path):
+        sys.path.insert(0, os.getcwd())
+    try:
+        app = WsgiApp(import_string(args.service))
+    except ValueError as e:
+        parser.error(str(e))
+    result = replay_traffic(app, load_traffic(args.captures))
+    sys.stdout.write(result.report() + '\n')
+    return 1 if result.mismatches else 0
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    if args[:1] == ['bench']:
+        return bench_main(args[1:])
+    elif args[:1] == ['replay']:
+        return replay_main(args[1:])
+    parser = argparse.ArgumentParser(
+        description='Nirum service runner',
+        epilog='Run `%(prog)s bench --help` to see how to measure '
+               'the dispatch capacity of a service, and `%(prog)s replay '
+               '--help` to see how to replay captured traffic.'
+    )
     parser.add_argument('-H', '--host', help='the host to listen',
                         default='0.0.0.0')
     parser.add_argument('-p', '--port', help='the port number to listen',
                         type=int, default=9322)
     parser.add_argument('-d', '--debug', help='debug mode',
                         action='store_true', default=False)
-    parser.add_argument('service', help='Import path to service instance')
-    args = parser.parse_args()
+    parser.add_argument('--warm-up', action='store_true', default=False,
+                        help='warm up the application before accepting '
+                             'requests')
+    parser.add_argument('--threads', type=int,
+                        help='handle connections on a fixed number of '
+                             'threads with HTTP/1.1 keep-alive, instead of '
+                             'a thread per connection')
+    parser.add_argument('--backlog', type=int, default=128,
+                        help='the maximum number of connections waiting for '
+                             'a thread [default: %(default)s]')
+    parser.add_argument('--keep-alive-timeout', type=float, default=5.0,
+                        help='the seconds to keep idle connections alive '
+                             '[default: %(default)s]')
+    parser.add_argument('--send-buffer-size', type=int,
+                        help='the size of socket send buffers in bytes')
+    parser.add_argument('--receive-buffer-size', type=int,
+                        help='the size of socket receive buffers in bytes')
+    parser.add_argument('--workers', type=int,
+                        help='serve on a number of forked worker processes '
+                             'which are recycled by --max-rss and '
+                             '--max-requests')
+    parser.add_argument('--max-rss', type=float, metavar='MIB',
+                        help='recycle a worker when its resident set size '
+                             'exceeds the given mebibytes')
+    parser.add_argument('--max-requests', type=int,
+                        help='recycle a worker when it has served the given '
+                             'number of requests')
+    parser.add_argument('--max-requests-jitter', type=int, default=0,
+                        help='the maximum random number added to '
+                             '--max-requests of each worker so that workers '
+                             'are not recycled at once [default: %(default)s]')
+    parser.add_argument('--graceful-timeout', type=float, default=30.0,
+                        help='the seconds to wait for a recycled worker to '
+                             'finish its in-flight requests '
+                             '[default: %(default)s]')
+    parser.add_argument('service', nargs='+',
+                        help='Import path to service instance.  To serve '
+                             'several services, give NAME=IMPORT_PATH for '
+                             'each of them; they are mounted on /NAME/')
+    args = parser.parse_args(args)
+    if args.threads is not None and args.debug:
+        parser.error('--threads cannot be used with --debug')
+    elif args.workers is not None and args.debug:
+        parser.error('--workers cannot be used with --debug')
+    elif args.workers is None and (args.max_rss is not None or
+                                   args.max_requests is not None):
+        parser.error('--max-rss and --max-requests can be used only with '
+                     '--workers')
     if not ('.' in sys.path or os.getcwd() in sys.path):
         sys.path.insert(0, os.getcwd())
-    service = import_string(args.service)
+    if len(args.service) == 1 and not MOUNT_RE.match(args.service[0]):
+        app = WsgiApp(import_string(args.service[0]))
+    else:
+        mounts = {}
+        for service in args.service:
+            match = MOUNT_RE.match(service)
+            if not match:
+                parser.error('give NAME=IMPORT_PATH for each service to '
+                             'serve several services: ' + service)
+            mounts[match.group('name')] = WsgiApp(
+                import_string(match.group('import_path'))
+            )
+        app = CompositeWsgiApp(mounts)
+    if args.warm_up:
+        duration = app.warm_up()
+        sys.stderr.write('Warmed up in {0:.3f} seconds.\n'.format(duration))
+
+    def make_server(fd=None):
+        if args.threads is None:
+            # Workers without --threads handle a request at a time.
+            return BaseWSGIServer(args.host, args.port, app, fd=fd)
+        return ThreadPoolServer(
+            args.host, args.port, app,
+            threads=args.threads,
+            backlog=args.backlog,
+            keep_alive_timeout=args.keep_alive_timeout,
+            send_buffer_size=args.send_buffer_size,
+            receive_buffer_size=args.receive_buffer_size,
+            fd=fd
+        )
+    if args.workers is not None:
+        supervisor = WorkerSupervisor(
+            make_server, args.host, args.port,
+            workers=args.workers,
+            max_rss=None if args.max_rss is None
+            else int(args.max_rss * 1024 * 1024),
+            max_requests=args.max_requests,
+            max_requests_jitter=args.max_requests_jitter,
+            graceful_timeout=args.graceful_timeout,
+            backlog=args.backlog
+        )
+        supervisor.run()
+        return
+    if args.threads is not None:
+        server = make_server()
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        return
     run_simple(
-        args.host, args.port, WsgiApp(service),
+        args.host, args.port, app,
         use_reloader=args.debug, use_debugger=args.debug,
         use_evalex=args.debug
     )
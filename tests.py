@@ -1,22 +1,61 @@
 import collections
+import datetime
+import decimal
+import io
 import json
 import logging
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+import time
+import traceback
 import typing
-
-from fixture import (BadRequest, CorsVerbService, MusicService,
-                     NullDisallowedMethodService,
-                     SatisfiedParametersService,
-                     StatisticsService,
+import uuid
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from fixture import (BadRequest, Circle, ComplexKeyMap, CorsVerbService,
+                     Location, MusicService,
+                     NullDisallowedMethodService, Offset, Point, Rectangle,
+                     SatisfiedParametersService, Shape,
+                     StatisticsService, Token,
                      Unknown, UnsatisfiedParametersService)
+from nirum.constructs import NameDict
+from nirum.datastructures import List, Map
 from nirum.deserialize import deserialize_meta
-from pytest import fixture, mark, raises
-from six.moves import urllib
-from werkzeug.test import Client
-from werkzeug.wrappers import Response
-
-from nirum_wsgi import (AnnotationError, LegacyWsgiApp, MethodArgumentError,
-                        UriTemplateMatchResult, UriTemplateMatcher, WsgiApp,
-                        import_string)
+from nirum.serialize import serialize_meta
+from nirum.service import Service
+from pytest import approx, fixture, mark, raises, skip
+from six.moves import http_client, urllib
+from werkzeug.test import Client, create_environ
+from werkzeug.wrappers import Request, Response
+
+from nirum_wsgi import (AccessLog, AnnotationError, ArgumentStreamError,
+                        ArgumentStreaming, Benchmark, BinaryResponses,
+                        BinaryUploads, BulkCalls, CompositeWsgiApp,
+                        CoroutineRunner,
+                        DeadlinePolicy,
+                        FileIdempotencyStore, FileSpanExporter, HealthCheck,
+                        IdempotencyPolicy,
+                        LegacyWsgiApp, LoadShedder, MemoryIdempotencyStore,
+                        MethodArgumentError, Metrics,
+                        OpenTelemetryIdGenerator, OpenTelemetrySpanExporter,
+                        PayloadLimits,
+                        QueueLogHandler,
+                        SingleFlight,
+                        SlowRequestTracker, SpanExporter, StoredResponse,
+                        ThreadPoolServer,
+                        Tracing, TrafficCapture,
+                        UriTemplateMatchResult,
+                        UriTemplateMatcher, WorkerSupervisor, WsgiApp,
+                        compile_deserializer, compile_serializer,
+                        current_request_context, import_string, load_traffic,
+                        main, parse_traceparent, percentile, replay_traffic,
+                        resident_set_size, truncated_repr)
 
 
 LEGACY = hasattr(MusicService, '__nirum_schema_version__')
@@ -405,6 +444,15 @@ def test_uri_template_match_result_update(lval, rval, expected):
         assert list(lval_result.result) == expected
 
 
+def test_uri_template_match_result_get_variable():
+    result = UriTemplateMatchResult([('from', 'a'), ('to', 'b')])
+    result.update(UriTemplateMatchResult([('to', 'c'), ('to', 'd')]))
+    assert result.get_variable('from_') == 'a'
+    assert result.get_variable('to') == ['b', 'c', 'd']
+    assert result.get_variable('interval') is None
+    assert UriTemplateMatchResult(None).get_variable('from') is None
+
+
 def test_import_string():
     assert import_string('collections:OrderedDict') == collections.OrderedDict
     assert (import_string('collections:OrderedDict({"a": 1})') ==
@@ -592,6 +640,13 @@ def test_resolve_querystring(qs, expected):
     assert return_result == expected
 
 
+def test_resolve_querystring_unmatched_path():
+    client = Client(WsgiApp(StatisticsServiceImpl()), Response)
+    response = client.get('/statistics/sales/?from=2017-01-01&to=2017-01-30')
+    # Not routed to purchase_count() only because the query string matches.
+    assert response.status_code == 405
+
+
 @mark.parametrize('payload, expected', [
     ({'exclude': False}, [1, 2, 3]),
     ({'exclude': True}, [1, 2]),
@@ -659,3 +714,2201 @@ def test_method_argument_error():
     e.on_error('.bar', 'Message B.')
     assert e.errors == {('.foo', 'Message A.'), ('.bar', 'Message B.')}
     assert str(e) == '.foo: Message A.\n.bar: Message B.'
+
+
+class BlockingMusicServiceImpl(MusicServiceImpl):
+
+    def __init__(self):
+        super(BlockingMusicServiceImpl, self).__init__()
+        self.calls = 0
+        self.release = threading.Event()
+
+    def get_music_by_artist_name(self, artist_name):
+        self.calls += 1
+        self.release.wait(5)
+        return super(BlockingMusicServiceImpl, self) \
+            .get_music_by_artist_name(artist_name)
+
+
+def coalesce_requests(app, url, waiters):
+    """Make concurrent ``GET`` requests to the ``url``, and release the
+    blocked service method after ``waiters`` requests are waiting for it.
+
+    """
+    service = app.service
+    client = Client(app, Response)
+    responses = []
+    threads = [
+        threading.Thread(target=lambda: responses.append(client.get(url)))
+        for _ in range(waiters + 1)
+    ]
+    for thread in threads:
+        thread.start()
+    deadline = time.time() + 5
+    while time.time() < deadline:
+        flights = list(app.single_flight._flights.values())
+        if flights and flights[0].waiters >= waiters:
+            break
+        time.sleep(0.001)
+    service.release.set()
+    for thread in threads:
+        thread.join()
+    return responses
+
+
+def test_single_flight():
+    app = WsgiApp(BlockingMusicServiceImpl(), single_flight=SingleFlight())
+    responses = coalesce_requests(app, '/artists/damien/', 4)
+    assert app.service.calls == 1
+    assert len(responses) == 5
+    for response in responses:
+        assert_response(response, 200, [u'rice'])
+    assert not app.single_flight._flights
+    # Errors are shared as well.
+    app.service.release.clear()
+    responses = coalesce_requests(app, '/artists/error/', 2)
+    assert app.service.calls == 2
+    for response in responses:
+        assert_response(
+            response, 400, {'_type': 'hello_error', '_tag': 'unknown'}
+        )
+
+
+def test_single_flight_different_arguments():
+    app = WsgiApp(BlockingMusicServiceImpl(), single_flight=SingleFlight())
+    app.service.release.set()
+    client = Client(app, Response)
+    assert_response(client.get('/artists/damien/'), 200, [u'rice'])
+    assert_response(client.get('/artists/damien%20rice/'), 200,
+                    [u'9 crimes', u'Elephant'])
+    assert app.service.calls == 2
+
+
+def test_single_flight_propagates_exception():
+    single_flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    errors = []
+
+    def fail():
+        started.set()
+        release.wait(5)
+        raise ZeroDivisionError()
+
+    def call():
+        try:
+            single_flight.call('key', fail)
+        except ZeroDivisionError as e:
+            errors.append((e, traceback.extract_tb(sys.exc_info()[2])))
+    threads = [threading.Thread(target=call) for _ in range(3)]
+    threads[0].start()
+    started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    while single_flight._flights['key'].waiters < 2:
+        time.sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert len(errors) == 3
+    assert len(set(id(e) for e, _ in errors)) == 3
+    # Only the thread which ran the call has its traceback.
+    assert sorted(
+        any(frame[2] == 'fail' for frame in tb) for _, tb in errors
+    ) == [False, False, True]
+    assert not single_flight._flights
+
+
+def test_single_flight_timeout():
+    app = WsgiApp(BlockingMusicServiceImpl(),
+                  single_flight=SingleFlight(timeout=0.01))
+    client = Client(app, Response)
+    leader = threading.Thread(target=client.get, args=('/artists/damien/',))
+    leader.start()
+    while not app.single_flight._flights:
+        time.sleep(0.001)
+    response = client.get('/artists/damien/')
+    app.service.release.set()
+    leader.join()
+    assert response.status_code == 504
+    assert json.loads(response.get_data(as_text=True))['_tag'] == \
+        'gateway_timeout'
+    assert app.service.calls == 1
+
+
+def test_single_flight_deadline():
+    app = WsgiApp(BlockingMusicServiceImpl(), single_flight=SingleFlight(),
+                  deadline_policy=DeadlinePolicy())
+    client = Client(app, Response)
+    leader = threading.Thread(target=client.get, args=('/artists/damien/',))
+    leader.start()
+    while not app.single_flight._flights:
+        time.sleep(0.001)
+    # A follower doesn't wait past its own deadline.
+    started_at = time.time()
+    response = client.get('/artists/damien/',
+                          headers={'X-Request-Timeout': '0.05'})
+    elapsed = time.time() - started_at
+    app.service.release.set()
+    leader.join()
+    assert response.status_code == 504
+    assert json.loads(response.get_data(as_text=True))['message'] == \
+        'The deadline of the request has already passed.'
+    assert elapsed < 2
+    assert app.service.calls == 1
+
+
+class DeadlineMusicServiceImpl(MusicServiceImpl):
+
+    def __init__(self):
+        super(DeadlineMusicServiceImpl, self).__init__()
+        self.remaining_times = []
+
+    def get_music_by_artist_name(self, artist_name):
+        context = current_request_context()
+        self.remaining_times.append(context.remaining_time())
+        return super(DeadlineMusicServiceImpl, self) \
+            .get_music_by_artist_name(artist_name)
+
+
+@mark.parametrize('headers, expected_remaining_time', [
+    ({}, None),
+    ({'X-Request-Timeout': '10'}, 10),
+    ({'X-Request-Timeout': '10',
+      'X-Request-Start': 't={0:.3f}'.format(time.time() - 5)}, 5),
+    ({'X-Request-Timeout': '10',
+      'X-Request-Start': 't={0:d}'.format(int(time.time() * 1000) - 5000)},
+     5),
+])
+def test_deadline_policy(headers, expected_remaining_time):
+    app = WsgiApp(
+        DeadlineMusicServiceImpl(),
+        deadline_policy=DeadlinePolicy(start_header='X-Request-Start')
+    )
+    client = Client(app, Response)
+    assert_response(client.get('/artists/damien/', headers=headers),
+                    200, [u'rice'])
+    remaining_time, = app.service.remaining_times
+    if expected_remaining_time is None:
+        assert remaining_time is None
+    else:
+        assert expected_remaining_time - 1 < remaining_time <= \
+            expected_remaining_time
+    assert current_request_context() is None
+
+
+@mark.parametrize('headers', [
+    {'X-Request-Timeout': '0'},
+    {'X-Request-Timeout': '-1'},
+    {'X-Request-Timeout': '10',
+     'X-Request-Start': 't={0:.3f}'.format(time.time() - 15)},
+])
+def test_deadline_policy_expired(headers):
+    app = WsgiApp(
+        DeadlineMusicServiceImpl(),
+        deadline_policy=DeadlinePolicy(start_header='X-Request-Start')
+    )
+    client = Client(app, Response)
+    assert_response(
+        client.get('/artists/damien/', headers=headers),
+        504,
+        {
+            '_type': 'error',
+            '_tag': 'gateway_timeout',
+            'message': 'The deadline of the request has already passed.',
+        }
+    )
+    assert not app.service.remaining_times
+
+
+def test_deadline_policy_method_timeouts():
+    app = WsgiApp(
+        DeadlineMusicServiceImpl(),
+        deadline_policy=DeadlinePolicy(
+            timeouts={'get_music_by_artist_name': 3},
+            default_timeout=0
+        )
+    )
+    client = Client(app, Response)
+    assert_response(
+        client.get('/artists/damien/', headers={'X-Request-Timeout': '10'}),
+        200, [u'rice']
+    )
+    remaining_time, = app.service.remaining_times
+    assert 2 < remaining_time <= 3
+    response = client.post('/?method=find_artist',
+                           data=json.dumps({'norae': u'9 crimes'}))
+    assert response.status_code == 504
+
+
+def test_deadline_policy_malformed_header():
+    app = WsgiApp(MusicServiceImpl(), deadline_policy=DeadlinePolicy())
+    client = Client(app, Response)
+    assert_response(
+        client.get('/artists/damien/', headers={'X-Request-Timeout': 'soon'}),
+        400,
+        {
+            '_type': 'error',
+            '_tag': 'bad_request',
+            'message': "X-Request-Timeout header must be a number of "
+                       "seconds, not 'soon'.",
+        }
+    )
+
+
+class CountingMusicServiceImpl(MusicServiceImpl):
+
+    def __init__(self):
+        super(CountingMusicServiceImpl, self).__init__()
+        self.calls = 0
+
+    def get_artist_by_music(self, music):
+        self.calls += 1
+        return super(CountingMusicServiceImpl, self).get_artist_by_music(
+            music
+        )
+
+
+@fixture(params=['memory', 'file'])
+def fx_idempotency_store(request, tmpdir):
+    if request.param == 'memory':
+        return MemoryIdempotencyStore()
+    return FileIdempotencyStore(str(tmpdir.join('idempotency')))
+
+
+def test_idempotency_policy(fx_idempotency_store):
+    app = WsgiApp(
+        CountingMusicServiceImpl(),
+        idempotency_policy=IdempotencyPolicy(fx_idempotency_store)
+    )
+    client = Client(app, Response)
+
+    def post(key, music=u'9 crimes'):
+        return client.post(
+            '/?method=find_artist',
+            data=json.dumps({'norae': music}),
+            headers={'Idempotency-Key': key} if key else {}
+        )
+    response = post('key-a')
+    assert_response(response, 200, u'damien rice')
+    assert 'Idempotent-Replayed' not in response.headers
+    assert app.service.calls == 1
+    replayed = post('key-a')
+    assert_response(replayed, 200, u'damien rice')
+    assert replayed.headers['Idempotent-Replayed'] == 'true'
+    assert replayed.headers['Content-Type'] == response.headers['Content-Type']
+    assert app.service.calls == 1
+    assert_response(post('key-b'), 200, u'damien rice')
+    assert app.service.calls == 2
+    assert_response(post(None), 200, u'damien rice')
+    assert_response(post(None), 200, u'damien rice')
+    assert app.service.calls == 4
+    assert_response(
+        post('key-a', u'Photograph'),
+        422,
+        {
+            '_type': 'error',
+            '_tag': 'unprocessable_entity',
+            'message': 'The idempotency key has already been used for '
+                       'a request with different arguments.',
+        }
+    )
+    assert app.service.calls == 4
+
+
+def test_idempotency_policy_concurrent_duplicates():
+    app = WsgiApp(BlockingMusicServiceImpl(),
+                  idempotency_policy=IdempotencyPolicy())
+    client = Client(app, Response)
+    responses = []
+
+    def post():
+        responses.append(client.post(
+            '/?method=get_music_by_artist_name',
+            data=json.dumps({'artist_name': u'damien'}),
+            headers={'Idempotency-Key': 'key'}
+        ))
+    threads = [threading.Thread(target=post) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    flights = app.idempotency_policy.single_flight._flights
+    while not flights or list(flights.values())[0].waiters < 2:
+        time.sleep(0.001)
+    app.service.release.set()
+    for thread in threads:
+        thread.join()
+    assert app.service.calls == 1
+    for response in responses:
+        assert_response(response, 200, [u'rice'])
+    assert sorted(r.headers.get('Idempotent-Replayed') or ''
+                  for r in responses) == ['', 'true', 'true']
+
+
+def test_memory_idempotency_store():
+    store = MemoryIdempotencyStore(max_size=2, ttl=60)
+    responses = [
+        StoredResponse(str(i), 200, [], str(i).encode()) for i in range(3)
+    ]
+    for i, response in enumerate(responses):
+        store.set(str(i), response)
+    assert store.get('0') is None
+    assert store.get('1') == responses[1]
+    assert store.get('2') == responses[2]
+    store.ttl = 0
+    store.set('3', responses[0])
+    assert store.get('3') is None
+
+
+def test_file_idempotency_store(tmpdir):
+    directory = str(tmpdir.join('store'))
+    store = FileIdempotencyStore(directory, max_size=2, ttl=60,
+                                 evict_interval=0)
+    response = StoredResponse(
+        'fp', 201, [('Content-Type', 'application/json')], b'{"a": 1}'
+    )
+    store.set(u'method:key', response)
+    assert store.get(u'method:key') == response
+    assert store.get(u'method:other') is None
+    # Responses persist across store instances.
+    assert FileIdempotencyStore(directory).get(u'method:key') == response
+    store.set(u'method:key2', response)
+    store.set(u'method:key3', response)
+    assert len(tmpdir.join('store').listdir()) == 2
+    expired = FileIdempotencyStore(directory, ttl=0)
+    expired.set(u'method:key4', response)
+    assert expired.get(u'method:key4') is None
+
+
+def test_file_idempotency_store_evict_interval(tmpdir):
+    store = FileIdempotencyStore(str(tmpdir.join('store')), max_size=1)
+    response = StoredResponse('fp', 200, [], b'null')
+    store.set(u'method:key', response)
+    store.set(u'method:key2', response)
+    # The directory isn't listed again until evict_interval elapses.
+    assert len(tmpdir.join('store').listdir()) == 2
+    store._evicted_at -= store.evict_interval
+    store.set(u'method:key3', response)
+    assert len(tmpdir.join('store').listdir()) == 1
+
+
+@mark.parametrize('content', [
+    b'{"key": "method:key"}',
+    b'{"key": "method:key", "expires_at": null}',
+    b'[]',
+    b'null',
+])
+def test_file_idempotency_store_malformed(tmpdir, content):
+    store = FileIdempotencyStore(str(tmpdir.join('store')))
+    with open(store._path(u'method:key'), 'wb') as f:
+        f.write(content)
+    assert store.get(u'method:key') is None
+
+
+class ListHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+        self.threads = set()
+
+    def emit(self, record):
+        self.records.append(record)
+        self.threads.add(threading.current_thread())
+
+
+@fixture
+def fx_access_logger():
+    logger = logging.getLogger('tests.access')
+    handler = ListHandler()
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    yield logger
+    logger.setLevel(logging.NOTSET)
+    logger.removeHandler(handler)
+
+
+def test_access_log(fx_access_logger):
+    handler, = fx_access_logger.handlers
+    app = WsgiApp(MusicServiceImpl(),
+                  access_log=AccessLog(logger=fx_access_logger))
+    client = Client(app, Response)
+    client.get('/artists/damien/')
+    payload = json.dumps({'norae': u'9 crimes'})
+    client.post('/?method=find_artist', data=payload)
+    client.get('/?method=find_artist')
+    routed, rpc, error = handler.records
+    assert routed.levelno == logging.INFO
+    assert routed.http_method == 'GET'
+    assert routed.path == '/artists/damien/'
+    assert routed.service_method == 'get_music_by_artist_name'
+    assert routed.routed
+    assert routed.status_code == 200
+    assert routed.response_size == len(b'["rice"]')
+    assert routed.duration >= 0
+    assert rpc.service_method == 'find_artist'
+    assert not rpc.routed
+    assert rpc.request_size == len(payload)
+    assert rpc.getMessage().startswith('POST / find_artist() 200 ')
+    assert error.status_code == 405
+    assert error.service_method is None
+
+
+def test_access_log_malformed_lengths(fx_access_logger):
+    handler, = fx_access_logger.handlers
+    access_log = AccessLog(logger=fx_access_logger)
+
+    def application(environ, start_response):
+        start_response('200 OK', [('Content-Length', 'many')])
+        return [b'ok']
+    environ = create_environ('/', method='POST')
+    environ['CONTENT_LENGTH'] = 'few'
+    response = access_log.observe(application, environ,
+                                  lambda status, headers, exc_info=None: None)
+    assert response == [b'ok']
+    record, = handler.records
+    assert record.status_code == 200
+    assert record.request_size == 0
+    assert record.response_size == 0
+
+
+def test_access_log_sampling(fx_access_logger):
+    handler, = fx_access_logger.handlers
+    app = WsgiApp(MusicServiceImpl(),
+                  access_log=AccessLog(logger=fx_access_logger,
+                                       sample_rate=0))
+    client = Client(app, Response)
+    client.get('/artists/damien/')
+    client.post('/?method=incorrect_return')
+    record, = handler.records
+    assert record.status_code == 500
+
+
+def test_queue_log_handler():
+    target = ListHandler()
+    handler = QueueLogHandler([target])
+    logger = logging.getLogger('tests.queue_log_handler')
+    logger.addHandler(handler)
+    try:
+        for i in range(10):
+            logger.error('record %d', i)
+        handler.flush()
+    finally:
+        logger.removeHandler(handler)
+        handler.close()
+    assert [r.getMessage() for r in target.records] == [
+        'record {0}'.format(i) for i in range(10)
+    ]
+    assert target.threads and threading.current_thread() not in target.threads
+
+
+def test_queue_log_handler_prepares_records():
+    target = ListHandler()
+    handler = QueueLogHandler([target])
+    logger = logging.getLogger('tests.queue_log_handler_prepares_records')
+    logger.addHandler(handler)
+    try:
+        blocked = threading.Event()
+
+        class RaisingHandler(ListHandler):
+
+            def handle(self, record):
+                blocked.wait(5)
+                raise RuntimeError('handler failed')
+        raising = RaisingHandler()
+        raising.handleError = lambda record: None
+        handler.handlers.insert(0, raising)
+        argument = [1]
+        try:
+            raise ValueError('error')
+        except ValueError:
+            logger.exception('argument %r', argument)
+        argument.append(2)
+        blocked.set()
+        # Doesn't block even though a handler raised.
+        handler.flush()
+    finally:
+        logger.removeHandler(handler)
+        handler.close()
+    record, = target.records
+    assert record.args is None and record.exc_info is None
+    assert record.getMessage().startswith('argument [1]\nTraceback')
+    assert 'ValueError: error' in record.getMessage()
+
+
+def test_queue_log_handler_forked():
+    target = ListHandler()
+    handler = QueueLogHandler([target])
+    logger = logging.getLogger('tests.queue_log_handler_forked')
+    logger.addHandler(handler)
+    messages = multiprocessing.Queue()
+
+    def work():
+        logger.error('child')
+        handler.flush()
+        messages.put([r.getMessage() for r in target.records])
+    try:
+        logger.error('parent')
+        handler.flush()
+        worker = multiprocessing.Process(target=work)
+        worker.start()
+        assert messages.get(timeout=5) == ['parent', 'child']
+        worker.join()
+    finally:
+        logger.removeHandler(handler)
+        handler.close()
+    assert [r.getMessage() for r in target.records] == ['parent']
+
+
+def test_queue_log_handler_drops_records():
+    blocked = threading.Event()
+
+    class BlockingHandler(ListHandler):
+
+        def emit(self, record):
+            blocked.wait(5)
+            super(BlockingHandler, self).emit(record)
+    target = BlockingHandler()
+    handler = QueueLogHandler([target], capacity=2)
+    logger = logging.getLogger('tests.queue_log_handler_drops_records')
+    logger.addHandler(handler)
+    try:
+        for i in range(10):
+            logger.error('record %d', i)
+        assert handler.dropped >= 7
+    finally:
+        blocked.set()
+        logger.removeHandler(handler)
+        handler.close()
+
+
+def test_truncated_repr():
+    assert truncated_repr(1) == '1'
+    assert truncated_repr(None) == 'None'
+    r = truncated_repr(list(range(100000)))
+    assert r.startswith('[0, 1, 2') and r.endswith('...]')
+    assert len(r) < 100
+    assert len(truncated_repr(u'x' * 100000)) <= 1024
+    assert len(truncated_repr([u'x' * 1000] * 1000, limit=50)) == 50
+    assert truncated_repr(Point(left=Offset(1.5), top=Offset(2.0))) == (
+        '{0}(left={1}(value=1.5), top={1}(value=2.0))'.format(
+            typing._type_repr(Point), typing._type_repr(Offset)
+        )
+    )
+
+
+def test_static_error(fx_music_wsgi, fx_test_client):
+    for _ in range(2):
+        assert_response(
+            fx_test_client.post('/'),
+            400,
+            {
+                '_type': 'error',
+                '_tag': 'bad_request',
+                'message': u'`method` is missing.',
+            }
+        )
+    assert list(fx_music_wsgi._static_errors) == [
+        (400, '`method` is missing.'),
+    ]
+    response = fx_music_wsgi.static_error(503)
+    assert response.status_code == 503
+    assert json.loads(response.get_data(as_text=True)) == {
+        '_type': 'error',
+        '_tag': 'service_unavailable',
+        'message': 'Service Unavailable',
+    }
+
+
+def test_error_with_custom_make_response():
+    class ExtendedWsgiApp(LegacyWsgiApp if LEGACY else WsgiApp):
+        def make_response(self, status_code, headers, content):
+            return status_code, headers + [('X-Custom', 'yes')], content
+    client = Client(ExtendedWsgiApp(MusicServiceImpl()), Response)
+    for response in [client.post('/'), client.get('/?method=foo'),
+                     client.post('/?method=foo'),
+                     client.post('/?method=find_artist',
+                                 data=json.dumps({'norae': u'9 crimes'}))]:
+        assert response.headers['X-Custom'] == 'yes'
+
+
+@mark.parametrize('status_code, message, kwargs, expected', [
+    (400, u'Bad.', {'errors': []},
+     {'_tag': 'bad_request', 'message': u'Bad.', 'errors': []}),
+    (404, None, {},
+     {'_tag': 'not_found',
+      'message': 'The requested URL /foo was not found on this service.'}),
+    (405, None, {},
+     {'_tag': 'method_not_allowed',
+      'message': 'The requested URL /foo was not allowed HTTP method GET.'}),
+    (500, None, {'errors': []},
+     {'_tag': 'internal_server_error', 'message': 'Internal Server Error'}),
+    (599, u'Unknown.', {}, {'_tag': 'http_error', 'message': u'Unknown.'}),
+])
+def test_error(fx_music_wsgi, status_code, message, kwargs, expected):
+    request = Request(create_environ('/foo'))
+    response = fx_music_wsgi.error(status_code, request, message, **kwargs)
+    assert response.status_code == status_code
+    expected['_type'] = 'error'
+    assert json.loads(response.get_data(as_text=True)) == expected
+
+
+def test_slow_request_tracker():
+    tracker = SlowRequestTracker(threshold=0, top=2, recent=3,
+                                 path='/_slow-requests')
+    app = WsgiApp(MusicServiceImpl(), slow_request_tracker=tracker)
+    client = Client(app, Response)
+    client.get('/artists/damien/?x=1')
+    client.post('/?method=find_artist',
+                data=json.dumps({'norae': u'9 crimes'}))
+    client.post('/?method=foo')
+    latest = tracker.latest()
+    assert len(latest) == 3
+    error, rpc, routed = latest
+    assert routed.http_method == 'GET'
+    assert routed.path == '/artists/damien/'
+    assert routed.service_method == 'get_music_by_artist_name'
+    assert routed.route == '/artists/{artist-name}/'
+    assert routed.status_code == 200
+    assert routed.argument_size == len('x=1')
+    assert [name for name, _ in routed.phases] == [
+        'dispatch', 'decode', 'call', 'encode',
+    ]
+    assert all(duration >= 0 for _, duration in routed.phases)
+    assert rpc.route is None
+    assert rpc.service_method == 'find_artist'
+    assert rpc.argument_size == len(json.dumps({'norae': u'9 crimes'})) + \
+        len('method=find_artist')
+    assert error.status_code == 400
+    assert len(tracker.slowest()) == 2
+    durations = [r.duration for r in tracker.slowest()]
+    assert durations == sorted(durations, reverse=True)
+    assert durations[-1] >= min(r.duration for r in latest)
+    response = client.get('/_slow-requests',
+                          environ_base={'REMOTE_ADDR': '127.0.0.1'})
+    assert response.status_code == 200
+    report = json.loads(response.get_data(as_text=True))
+    assert report['threshold'] == 0
+    assert len(report['slowest']) == 2
+    assert len(report['latest']) == 3
+    assert report['latest'][-1]['phases'][0]['name'] == 'dispatch'
+    # The report itself is not tracked.
+    assert len(tracker.latest()) == 3
+    response = client.get('/_slow-requests',
+                          environ_base={'REMOTE_ADDR': '192.0.2.1'})
+    assert response.status_code == 403
+    tracker.reset()
+    assert not tracker.slowest() and not tracker.latest()
+
+
+def test_slow_request_tracker_threshold():
+    tracker = SlowRequestTracker(threshold=60)
+    app = WsgiApp(MusicServiceImpl(), slow_request_tracker=tracker)
+    client = Client(app, Response)
+    client.get('/artists/damien/')
+    assert not tracker.latest()
+    assert client.get('/_slow-requests').status_code == 405
+
+
+def test_slow_request_tracker_authorize():
+    tracker = SlowRequestTracker(path='/_slow-requests', token='s3cret',
+                                 allowed_addresses=['192.0.2.1'])
+    client = Client(WsgiApp(MusicServiceImpl(),
+                            slow_request_tracker=tracker), Response)
+
+    def get(remote_addr, authorization=None):
+        headers = {}
+        if authorization is not None:
+            headers['Authorization'] = authorization
+        return client.get('/_slow-requests', headers=headers,
+                          environ_base={'REMOTE_ADDR': remote_addr})
+    assert get('192.0.2.1', 'Bearer s3cret').status_code == 200
+    assert get('192.0.2.1').status_code == 403
+    assert get('192.0.2.1', 'Bearer wrong').status_code == 403
+    assert get('192.0.2.1', u'Bearer s\xe9cret').status_code == 403
+    # Loopback addresses aren't trusted unless they're allowed.
+    assert get('127.0.0.1', 'Bearer s3cret').status_code == 403
+
+
+@mark.skipif(tracemalloc is None, reason='tracemalloc is unavailable')
+@mark.parametrize('make_environ', [
+    lambda: create_environ('/artists/damien/', method='GET'),
+    lambda: create_environ('/?method=get_music_by_artist_name', method='POST',
+                           data=json.dumps({'artist_name': u'damien'})),
+])
+def test_allocation_budget(make_environ):
+    if tracemalloc.is_tracing():
+        skip('tracemalloc is already tracing')
+    app = WsgiApp(MusicServiceImpl())
+
+    def noop_app(environ, start_response):
+        # What any werkzeug application allocates for the same request,
+        # which varies by the versions of Python and werkzeug.
+        request = Request(environ)
+        request.args.get('method')
+        request.get_data()
+        response = Response(json.dumps([u'rice']),
+                            content_type='application/json')
+        return response(environ, start_response)
+
+    def peak(application):
+        # Warm up lazily initialized caches.
+        for _ in range(10):
+            for _ in application(make_environ(), lambda *args: None):
+                pass
+        environ = make_environ()
+        tracemalloc.start()
+        try:
+            for _ in application(environ, lambda *args: None):
+                pass
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    # The peak memory usage while a request is being handled beyond what
+    # a no-op werkzeug application takes.
+    app_peak, noop_peak = peak(app), peak(noop_app)
+    assert app_peak - noop_peak <= 8 * 1024
+    environ = make_environ()
+    tracemalloc.start()
+    try:
+        match = app.dispatch_method(environ)
+        dispatch_snapshot = tracemalloc.take_snapshot()
+        del match
+    finally:
+        tracemalloc.stop()
+    own_blocks = dispatch_snapshot.filter_traces([
+        tracemalloc.Filter(True, sys.modules[WsgiApp.__module__].__file__),
+    ]).statistics('filename')
+    # Objects which nirum_wsgi itself allocates to dispatch a request:
+    # the payload, CORS headers, and the MethodDispatch.
+    assert sum(stat.count for stat in own_blocks) <= 8
+
+
+@mark.parametrize('app_type', [WsgiApp, LegacyWsgiApp])
+def test_warm_up(app_type, caplog):
+    calls = []
+
+    class RecordingMusicServiceImpl(MusicServiceImpl):
+
+        def get_music_by_artist_name(self, artist_name):
+            calls.append(artist_name)
+            return super(RecordingMusicServiceImpl,
+                         self).get_music_by_artist_name(artist_name)
+
+    app = app_type(RecordingMusicServiceImpl())
+    assert app.warm_up_duration is None
+    duration = app.warm_up()
+    assert duration >= 0
+    assert app.warm_up_duration == duration
+    assert not calls
+    assert not [r for r in caplog.records if r.levelno >= logging.ERROR]
+    response = Client(app, Response).get('/artists/damien%20rice/')
+    assert response.status_code == 200
+    assert json.loads(response.get_data(as_text=True)) == [
+        u'9 crimes', u'Elephant',
+    ]
+    assert calls == [u'damien rice']
+
+
+def test_health_check():
+    ready = [True]
+
+    def readiness_check():
+        if ready[0] is None:
+            raise IOError('database is unreachable')
+        return ready[0]
+    health_check = HealthCheck(readiness_check=readiness_check,
+                               require_warm_up=True)
+    app = WsgiApp(MusicServiceImpl(), health_check=health_check)
+    client = Client(app, Response)
+
+    def probe(path, method='GET'):
+        response = client.open(path, method=method)
+        return (response.status_code,
+                response.get_data(as_text=True) and
+                json.loads(response.get_data(as_text=True))['status'])
+    assert probe('/_health') == (200, 'live')
+    assert probe('/_ready') == (503, 'unavailable')
+    app.warm_up()
+    assert probe('/_ready') == (200, 'ready')
+    assert probe('/_ready', 'HEAD') == (200, '')
+    ready[0] = False
+    assert probe('/_ready') == (503, 'unavailable')
+    ready[0] = None
+    assert probe('/_ready') == (503, 'unavailable')
+    ready[0] = True
+    health_check.drain()
+    assert probe('/_ready') == (503, 'unavailable')
+    assert probe('/_health') == (200, 'live')
+
+
+def test_health_check_max_in_flight():
+    health_check = HealthCheck(max_in_flight=1)
+    readiness = []
+
+    class ProbingMusicServiceImpl(MusicServiceImpl):
+
+        def get_music_by_artist_name(self, artist_name):
+            readiness.append(health_check.ready(app))
+            return super(ProbingMusicServiceImpl,
+                         self).get_music_by_artist_name(artist_name)
+
+    app = WsgiApp(ProbingMusicServiceImpl(), health_check=health_check)
+    client = Client(app, Response)
+    assert client.get('/artists/damien/').status_code == 200
+    assert readiness == [False]
+    assert health_check.in_flight == 0
+    assert client.get('/_ready').status_code == 200
+
+
+def test_load_shedder():
+    load_shedder = LoadShedder(
+        priority_methods=frozenset(['get_music_by_artist_name']),
+        priority_header='X-Priority'
+    )
+    in_flight = []
+
+    class ProbingMusicServiceImpl(MusicServiceImpl):
+
+        def get_artist_by_music(self, music):
+            in_flight.append(load_shedder.in_flight)
+            return super(ProbingMusicServiceImpl,
+                         self).get_artist_by_music(music)
+
+    app = WsgiApp(ProbingMusicServiceImpl(), load_shedder=load_shedder)
+    client = Client(app, Response)
+    payload = json.dumps({'norae': u'Elephant'})
+    assert client.post('/?method=find_artist',
+                       data=payload).status_code == 200
+    assert in_flight == [1]
+    assert load_shedder.in_flight == 0
+    # Overloaded: low-priority requests beyond the limit are shed.
+    load_shedder.limit = 1
+    load_shedder.in_flight = 1
+    response = client.post('/?method=find_artist', data=payload)
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
+    assert json.loads(response.get_data(as_text=True))['message'] == \
+        LoadShedder.MESSAGE
+    assert load_shedder.shed == 1
+    # High-priority requests are admitted by the header or methods.
+    assert client.post('/?method=find_artist', data=payload,
+                       headers={'X-Priority': 'high'}).status_code == 200
+    assert client.get('/artists/damien/').status_code == 200
+    # The header cannot demote methods on the allow-list.
+    assert client.post('/?method=get_music_by_artist_name',
+                       data=json.dumps({'artist_name': u'damien'}),
+                       headers={'X-Priority': 'low'}).status_code == 200
+    assert client.post('/?method=find_artist', data=payload,
+                       headers={'X-Priority': 'low'}).status_code == 503
+    assert load_shedder.shed == 2
+    assert load_shedder.in_flight == 1
+    # The header is not trusted unless it's configured.
+    load_shedder = LoadShedder()
+    load_shedder.limit = 0
+    client = Client(WsgiApp(MusicServiceImpl(), load_shedder=load_shedder),
+                    Response)
+    assert client.post('/?method=find_artist', data=payload,
+                       headers={'X-Priority': 'high'}).status_code == 503
+
+
+def test_load_shedder_metrics(tmpdir):
+    load_shedder = LoadShedder()
+    metrics = Metrics(str(tmpdir), buckets=[10])
+    app = WsgiApp(MusicServiceImpl(), load_shedder=load_shedder,
+                  metrics=metrics)
+    client = Client(app, Response)
+    load_shedder.limit = 0
+    try:
+        assert client.get('/artists/damien/').status_code == 503
+        assert client.post('/?method=no_such_method').status_code == 503
+        exposition = client.get(
+            '/_metrics', environ_base={'REMOTE_ADDR': '127.0.0.1'}
+        ).get_data(as_text=True)
+    finally:
+        metrics.close()
+    name = 'nirum_request_duration_seconds'
+    for labels in ['method="get_music_by_artist_name",status="503"',
+                   'method="",status="503"']:
+        assert '{0}_count{{{1}}} 1.0'.format(name, labels) in exposition
+
+
+def test_load_shedder_adapt():
+    load_shedder = LoadShedder(target=0.05, interval=0, max_limit=4)
+    load_shedder.observe(0.1)
+    assert load_shedder.overloaded
+    assert load_shedder.limit == 1
+    load_shedder.observe(0.01)
+    assert not load_shedder.overloaded
+    assert load_shedder.limit == 2
+    for _ in range(5):
+        load_shedder.observe(0.01)
+    assert load_shedder.limit == 4
+    load_shedder.in_flight = 3
+    load_shedder.observe(0.1)
+    assert load_shedder.limit == approx(2.7)
+    # The queueing delay stamped by the proxy is observed on arrival.
+    load_shedder = LoadShedder(target=0.05, interval=0,
+                               start_header='X-Request-Start')
+    app = WsgiApp(MusicServiceImpl(), load_shedder=load_shedder)
+    client = Client(app, Response)
+    response = client.get('/artists/damien/', headers={
+        'X-Request-Start': 't={0:.0f}'.format((time.time() - 1) * 1e6),
+    })
+    assert response.status_code == 200
+    assert load_shedder.overloaded
+    assert load_shedder.limit == 1
+    with raises(ValueError):
+        LoadShedder(backoff=1)
+    with raises(ValueError):
+        LoadShedder(min_limit=10, max_limit=5)
+    with raises(TypeError):
+        WsgiApp(MusicServiceImpl(), load_shedder=object())
+
+
+def test_bulk_calls():
+
+    class CrashingMusicServiceImpl(MusicServiceImpl):
+
+        def get_music_by_artist_name(self, artist_name):
+            if artist_name == 'crash':
+                raise RuntimeError('crashed')
+            return super(CrashingMusicServiceImpl,
+                         self).get_music_by_artist_name(artist_name)
+
+    app = WsgiApp(CrashingMusicServiceImpl(),
+                  bulk_calls=BulkCalls(['get_music_by_artist_name'],
+                                       max_line_size=64))
+    client = Client(app, Response)
+    lines = [
+        b'{"artist_name": "damien"}',
+        b'',
+        b'{"artist_name": "damien rice"}\r',
+        b'{"artist_name": "' + b'x' * 64 + b'"}',
+        b'{"artist_name": ',
+        b'[]',
+        b'{"artist_name": 1}',
+        b'{"artist_name": "no one"}',
+        b'{"artist_name": "error"}',
+        b'{"artist_name": "crash"}',
+        b'{"artist_name": "ed sheeran"}',
+    ]
+    response = client.post('/?method=get_music_by_artist_name',
+                           data=b'\n'.join(lines),
+                           content_type='application/x-ndjson')
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    assert response.is_streamed
+    outcomes = [json.loads(line) for line in
+                response.get_data(as_text=True).splitlines()]
+    assert [o['status'] for o in outcomes] == [
+        200, 200, 413, 400, 400, 400, 400, 400, 500, 200
+    ]
+    assert outcomes[0]['result'] == [u'rice']
+    assert outcomes[1]['result'] == [u'9 crimes', u'Elephant']
+    assert outcomes[5]['error']['errors'] == [
+        {'path': '.artist_name', 'message': 'Expected a string.'},
+    ]
+    assert outcomes[6]['error'] == {'_type': 'hello_error',
+                                    '_tag': 'bad_request'}
+    assert outcomes[8]['error']['_tag'] == 'internal_server_error'
+    assert outcomes[9]['result'] == [u'Thinking out loud', u'Photograph']
+    # Other content types are handled as usual.
+    response = client.post('/?method=get_music_by_artist_name',
+                           data=json.dumps({'artist_name': u'damien'}))
+    assert json.loads(response.get_data(as_text=True)) == [u'rice']
+    with raises(TypeError):
+        WsgiApp(MusicServiceImpl(), bulk_calls=BulkCalls(['no_such_method']))
+    with raises(TypeError):
+        WsgiApp(MusicServiceImpl(), bulk_calls=object())
+
+
+def test_bulk_calls_observed_until_closed():
+    load_shedder = LoadShedder()
+    health_check = HealthCheck(max_in_flight=10)
+    exported = []
+
+    class ListSpanExporter(SpanExporter):
+
+        def export(self, spans):
+            exported.append(spans)
+
+    app = WsgiApp(MusicServiceImpl(),
+                  bulk_calls=BulkCalls(['get_music_by_artist_name']),
+                  load_shedder=load_shedder, health_check=health_check,
+                  tracing=Tracing(ListSpanExporter()))
+    client = Client(app, Response)
+    response = client.post('/?method=get_music_by_artist_name',
+                           data=b'{"artist_name": "damien"}\n' * 3,
+                           content_type='application/x-ndjson')
+    assert len(response.get_data().splitlines()) == 3
+    assert load_shedder.in_flight == 1
+    assert health_check.in_flight == 1
+    assert not exported
+    response.close()
+    assert load_shedder.in_flight == 0
+    assert health_check.in_flight == 0
+    assert len(exported) == 1
+
+
+def test_composite_wsgi_app():
+    app = CompositeWsgiApp({
+        'music': WsgiApp(MusicServiceImpl(),
+                         allowed_origins=frozenset(['example.com'])),
+        'statistics': WsgiApp(StatisticsServiceImpl()),
+    })
+    client = Client(app, Response)
+    payload = json.dumps({'artist_name': u'damien'})
+    for url in ['/music/?method=get_music_by_artist_name',
+                '/?method=music.get_music_by_artist_name']:
+        response = client.post(url, data=payload,
+                               headers={'Origin': 'https://example.com'})
+        assert response.status_code == 200, response.get_data(as_text=True)
+        assert json.loads(response.get_data(as_text=True)) == [u'rice']
+        assert response.headers['Access-Control-Allow-Origin'] == \
+            'https://example.com'
+    response = client.get('/music/artists/damien/')
+    assert response.status_code == 200
+    response = client.get(
+        '/statistics/statistics/purchases/?from=2017-01-01&to=2017-01-30'
+    )
+    assert response.status_code == 200, response.get_data(as_text=True)
+    assert len(json.loads(response.get_data(as_text=True))) == 29
+    # CORS settings are per mount.
+    response = client.post('/?method=statistics.daily_purchase',
+                           data=json.dumps({'exclude': True}),
+                           headers={'Origin': 'https://example.com'})
+    assert response.status_code == 200, response.get_data(as_text=True)
+    assert 'Access-Control-Allow-Origin' not in response.headers
+    assert_response(client.get('/video/'), 404, {
+        '_type': 'error',
+        '_tag': 'not_found',
+        'message': 'The requested URL /video/ was not found on this '
+                   'service.',
+    })
+    assert_response(client.post('/?method=video.play'), 400, {
+        '_type': 'error',
+        '_tag': 'bad_request',
+        'message': 'No service method `video.play` found.',
+    })
+    assert_response(client.post('/'), 400, {
+        '_type': 'error',
+        '_tag': 'bad_request',
+        'message': '`method` is missing.',
+    })
+    assert app.warm_up() >= 0
+
+
+@mark.parametrize('mounts, error', [
+    ({'music': MusicServiceImpl()}, TypeError),
+    ({'music.v2': WsgiApp(MusicServiceImpl())}, ValueError),
+    ({'music/v2': WsgiApp(MusicServiceImpl())}, ValueError),
+    ({'': WsgiApp(MusicServiceImpl())}, ValueError),
+])
+def test_composite_wsgi_app_invalid_mounts(mounts, error):
+    with raises(error):
+        CompositeWsgiApp(mounts)
+
+
+POINT_JSON = {'_type': 'point', 'x': 1.5, 'top': 2}
+POINT2_JSON = {'_type': 'point', 'x': 3, 'top': 4.5}
+
+
+@mark.parametrize('type_, data', [
+    (typing.Sequence[typing.Text], [u'a', u'b']),
+    (typing.Sequence[typing.Text], [u'a', 1]),
+    (typing.AbstractSet[int], [1, 2, 2]),
+    (typing.AbstractSet[int], [1, 'x']),
+    (typing.Mapping[typing.Text, int], [{'key': u'a', 'value': 1}]),
+    (typing.Mapping[typing.Text, int], {'a': 1}),
+    (typing.Mapping[typing.Text, int], [{'key': u'a'}]),
+    (typing.Mapping[typing.Text, int], [[u'a', 1]]),
+    (typing.Optional[typing.Text], None),
+    (typing.Optional[typing.Text], u'a'),
+    (typing.Optional[typing.Text], 1),
+    (typing.Text, 1),
+    (bool, True),
+    (uuid.UUID, '8d1e2b0e-0f76-4c6b-9c15-6a4fdbde49d2'),
+    (uuid.UUID, 'not-a-uuid'),
+    (datetime.date, '2018-01-30'),
+    (datetime.date, 'yesterday'),
+    (datetime.datetime, '2018-01-30T12:34:56Z'),
+    (decimal.Decimal, '1.25'),
+    (decimal.Decimal, 'one'),
+    (Offset, 1.5),
+    (Offset, 'x'),
+    (Token, '8d1e2b0e-0f76-4c6b-9c15-6a4fdbde49d2'),
+    (Point, POINT_JSON),
+    (Point, {'_type': 'location', 'x': 1, 'top': 2}),
+    (Point, {'x': 1, 'top': 2}),
+    (Point, {'_type': 'point', 'x': 'a', 'top': 2}),
+    (Point, {'_type': 'point', 'x': 1, 'top': 2, 'z': 3}),
+    (Location, {'_type': 'location', 'name': None, 'lat': '37.5',
+                'lng': '127.0'}),
+    (Location, {'_type': 'location', 'lat': '37.5', 'lng': 127}),
+    (Shape, {'_type': 'shape', '_tag': 'circle', 'origin': POINT_JSON,
+             'radius': 3}),
+    (Shape, {'_type': 'shape', '_tag': 'rectangle',
+             'upper_left': POINT_JSON, 'lower_right': POINT2_JSON}),
+    (Shape, {'_type': 'shape', '_tag': 'triangle'}),
+    (Shape, {'_type': 'point', '_tag': 'circle'}),
+    (Shape, {'_type': 'shape'}),
+    (Circle, {'_type': 'shape', '_tag': 'rectangle'}),
+    (Rectangle, {'_type': 'shape', '_tag': 'rectangle',
+                 'upper_left': POINT_JSON, 'lower_right': POINT2_JSON}),
+    (ComplexKeyMap, {'_type': 'complex_key_map', 'value': [
+        {'key': POINT_JSON, 'value': POINT2_JSON},
+        {'key': POINT2_JSON, 'value': POINT_JSON},
+    ]}),
+    (ComplexKeyMap, {'_type': 'complex_key_map', 'value': [
+        {'key': POINT_JSON, 'value': [1, 2]},
+    ]}),
+])
+def test_compile_deserializer(type_, data):
+    def deserialize(f):
+        try:
+            return 'value', f(data)
+        except Exception as e:
+            return type(e), str(e)
+    expected = deserialize(lambda data: deserialize_meta(type_, data))
+    assert deserialize(compile_deserializer(type_)) == expected
+
+
+def test_legacy_wsgi_app_argument_errors():
+    app = LegacyWsgiApp(StatisticsServiceImpl())
+    client = Client(app, Response)
+    response = client.post('/?method=purchase_interval',
+                           data=json.dumps({'from': 'yesterday', 'to': 1}))
+    assert_response(response, 400, {
+        '_type': 'error',
+        '_tag': 'bad_request',
+        'message': 'There are invalid arguments.',
+        'errors': [
+            {'path': '.from',
+             'message': 'Expected datetime.date, but str was given.'},
+            {'path': '.interval', 'message': 'Expected to exist.'},
+            {'path': '.to',
+             'message': 'Expected datetime.date, but int was given.'},
+        ],
+    })
+    response = client.post('/?method=daily_purchase', data=json.dumps({}))
+    assert response.status_code == 200, response.get_data(as_text=True)
+
+
+POINT = Point(left=Offset(1.5), top=Offset(2.0))
+POINT2 = Point(left=Offset(3.0), top=Offset(4.5))
+TOKEN = uuid.UUID('8d1e2b0e-0f76-4c6b-9c15-6a4fdbde49d2')
+
+
+@mark.parametrize('type_, value', [
+    (typing.Sequence[typing.Text], [u'a', u'b']),
+    (typing.Sequence[typing.Text], List([u'a', u'b'])),
+    (typing.Sequence[Point], (POINT, POINT2)),
+    (typing.AbstractSet[int], {1, 2, 3}),
+    (typing.Mapping[typing.Text, int], {u'a': 1, u'b': 2}),
+    (typing.Optional[Point], None),
+    (typing.Optional[Point], POINT),
+    (typing.Text, u'a'),
+    (int, 1),
+    (float, 1.5),
+    (bool, False),
+    (datetime.date, datetime.date(2018, 5, 25)),
+    (datetime.datetime, datetime.datetime(2018, 5, 25, 12, 34, 56)),
+    (decimal.Decimal, decimal.Decimal('1.25')),
+    (uuid.UUID, TOKEN),
+    (Offset, Offset(1.5)),
+    (Token, Token(TOKEN)),
+    (Point, POINT),
+    (Location, Location(name=None, lat=decimal.Decimal('37.5'),
+                        lng=decimal.Decimal('127.0'))),
+    (Shape, Circle(origin=POINT, radius=Offset(3.0))),
+    (Shape, Rectangle(upper_left=POINT, lower_right=POINT2)),
+    (Rectangle, Rectangle(upper_left=POINT, lower_right=POINT2)),
+    (ComplexKeyMap, ComplexKeyMap(value=Map({POINT: POINT2}))),
+    # Values of unexpected types
+    (typing.Sequence[typing.Text], POINT),
+    (typing.Sequence[typing.Text], [u'a', datetime.date(2018, 5, 25)]),
+    (typing.Mapping[typing.Text, int], [1, 2]),
+    (typing.Text, datetime.date(2018, 5, 25)),
+    (Point, 1),
+    (Shape, POINT),
+])
+def test_compile_serializer(type_, value):
+    expected = json.dumps(serialize_meta(value))
+    assert json.dumps(compile_serializer(type_)(value)) == expected
+
+
+@mark.parametrize('validate_results, status_code', [
+    (True, 500),
+    (False, 200),
+])
+def test_legacy_wsgi_app_validate_results(validate_results, status_code):
+    app = LegacyWsgiApp(MusicServiceImpl(), validate_results=validate_results)
+    client = Client(app, Response)
+    response = client.post('/?method=incorrect_return')
+    assert response.status_code == status_code
+    response = client.post('/?method=get_music_by_artist_name',
+                           data=json.dumps({'artist_name': u'damien rice'}))
+    assert response.status_code == 200
+    assert json.loads(response.get_data(as_text=True)) == [
+        u'9 crimes', u'Elephant',
+    ]
+
+
+@mark.parametrize('payload, status_code, path', [
+    ({'artist_name': u'damien rice'}, 200, None),
+    ({'artist_name': [[[[1]]]]}, 400, '.artist_name[0][0][0]'),
+    ({'artist_name': list(range(100))}, 413, '.artist_name'),
+    ({'artist_name': u'x' * 65}, 413, '.artist_name'),
+    ({'artist_name': u'rice', 'x' * 65: 1}, 413, '.' + 'x' * 65),
+    ({'artist_name': [{}, {'a': u'x' * 65}]}, 413, '.artist_name[1].a'),
+])
+def test_payload_limits(payload, status_code, path):
+    limits = PayloadLimits(max_depth=4, max_elements=50, max_string_length=64)
+    app = WsgiApp(MusicServiceImpl(), payload_limits=limits)
+    client = Client(app, Response)
+    response = client.post('/?method=get_music_by_artist_name',
+                           data=json.dumps(payload))
+    assert response.status_code == status_code
+    if path is not None:
+        content = json.loads(response.get_data(as_text=True))
+        assert content['message'] == 'The payload is too complex.'
+        assert [e['path'] for e in content['errors']] == [path]
+
+
+def test_payload_limits_before_parsing():
+    limits = PayloadLimits(max_length=1024)
+    app = LegacyWsgiApp(MusicServiceImpl(), payload_limits=limits)
+    client = Client(app, Response)
+    response = client.post('/?method=get_music_by_artist_name',
+                           data='[' * 1025)
+    assert response.status_code == 413
+    # Too deep to be parsed at all
+    limits = PayloadLimits()
+    app = LegacyWsgiApp(MusicServiceImpl(), payload_limits=limits)
+    client = Client(app, Response)
+    response = client.post('/?method=get_music_by_artist_name',
+                           data='[' * 100000 + ']' * 100000)
+    assert response.status_code == 400
+    # The length is bounded by default.
+    response = client.post(
+        '/?method=get_music_by_artist_name', data='{}',
+        environ_overrides={'CONTENT_LENGTH': str(limits.max_length + 1)}
+    )
+    assert response.status_code == 413
+    with raises(TypeError):
+        WsgiApp(MusicServiceImpl(), payload_limits={'max_depth': 1})
+
+
+POINT_JSON = serialize_meta(POINT)
+
+
+class IngestionService(Service):
+
+    __nirum_service_methods__ = {
+        'ingest_points': {
+            '_v': 2,
+            '_return': lambda: int,
+            '_names': NameDict([('points', 'points')]),
+            'points': lambda: typing.Sequence[Point],
+        },
+    }
+    __nirum_method_names__ = NameDict([('ingest_points', 'ingest_points')])
+    __nirum_method_annotations__ = {'ingest_points': {}}
+    __nirum_method_error_types__ = {}
+
+    def __init__(self, skip_errors=False):
+        self.skip_errors = skip_errors
+        self.received = []
+
+    def ingest_points(self, points):
+        assert not isinstance(points, collections.Sequence)
+        while True:
+            try:
+                point = next(points)
+            except StopIteration:
+                break
+            except ArgumentStreamError:
+                if not self.skip_errors:
+                    raise
+                continue
+            self.received.append(point)
+        return len(self.received)
+
+
+@mark.parametrize('payload, skip_errors, status_code, received, errors', [
+    ('{"points": []}', False, 200, 0, None),
+    (' { "points" : [ {0} , {0} ] } '.replace('{0}', json.dumps(POINT_JSON)),
+     False, 200, 2, None),
+    ('{"points": [%s]}' % ', '.join([json.dumps(POINT_JSON)] * 1000),
+     False, 200, 1000, None),
+    ('{"points": [%s, 1, %s]}' % ((json.dumps(POINT_JSON),) * 2),
+     False, 400, 1, [('.points[1]', 'Expected fixture.Point, but int was '
+                                    'given.')]),
+    ('{"points": [%s, 1, %s]}' % ((json.dumps(POINT_JSON),) * 2),
+     True, 200, 2, None),
+    ('{"points": [%s, {]}' % json.dumps(POINT_JSON),
+     True, 400, 1, [('.points[1]', 'Invalid JSON payload.')]),
+    ('{"points": [%s' % json.dumps(POINT_JSON),
+     True, 400, 1, [('.points[1]', 'Invalid JSON payload.')]),
+    ('{}', False, 400, 0, [('.points', 'Expected to exist.')]),
+    ('', False, 400, 0, [('', 'Invalid JSON payload.')]),
+    ('{"points": null}', False, 400, 0,
+     [('.points', 'Expected fixture.Point.')]),
+    ('{"other": []}', False, 400, 0,
+     [('', 'Expected only the .points argument.')]),
+])
+def test_argument_streaming(payload, skip_errors, status_code, received,
+                            errors):
+    service = IngestionService(skip_errors)
+    app = LegacyWsgiApp(
+        service,
+        argument_streaming=ArgumentStreaming({'ingest_points'}, chunk_size=7)
+    )
+    client = Client(app, Response)
+    response = client.post('/?method=ingest_points', data=payload)
+    assert response.status_code == status_code, \
+        response.get_data(as_text=True)
+    assert len(service.received) == received
+    assert all(isinstance(p, Point) for p in service.received)
+    if errors is not None:
+        content = json.loads(response.get_data(as_text=True))
+        assert [(e['path'], e['message']) for e in content['errors']] == \
+            errors
+
+
+def test_argument_streaming_invalid_methods():
+    with raises(TypeError):
+        WsgiApp(MusicServiceImpl(),
+                argument_streaming=ArgumentStreaming({'incorrect_return'}))
+    with raises(TypeError):
+        ArgumentStreaming('ingest_points')
+
+
+class FailingAwaitable(object):
+
+    def __await__(self):
+        raise ValueError('failed')
+        yield
+
+
+class AsyncService(Service):
+
+    __nirum_service_methods__ = {
+        'sleep': {
+            '_v': 2,
+            '_return': lambda: typing.Text,
+            '_names': NameDict([('seconds', 'seconds')]),
+            'seconds': lambda: float,
+        },
+        'fail': {
+            '_v': 2,
+            '_return': lambda: typing.Text,
+            '_names': NameDict([]),
+        },
+        'probe': {
+            '_v': 2,
+            '_return': lambda: typing.Optional[typing.Text],
+            '_names': NameDict([]),
+        },
+    }
+    __nirum_method_names__ = NameDict([('sleep', 'sleep'), ('fail', 'fail'),
+                                       ('probe', 'probe')])
+    __nirum_method_annotations__ = {'sleep': {}, 'fail': {}, 'probe': {}}
+    __nirum_method_error_types__ = {}
+
+    def __init__(self):
+        self.contexts = []
+
+    def sleep(self, seconds):
+        import asyncio
+        return asyncio.sleep(seconds, u'slept')
+
+    def fail(self):
+        return FailingAwaitable()
+
+    def probe(self):
+        import types
+
+        @types.coroutine
+        def probe():
+            self.contexts.append(current_request_context())
+            yield  # Let the loop run other tasks meanwhile.
+            self.contexts.append(current_request_context())
+        return probe()
+
+
+@mark.skipif(sys.version_info < (3, 5), reason='Python 3.5+ only')
+def test_coroutine_runner():
+    runner = CoroutineRunner(max_concurrency=1, timeout=1)
+    client = Client(LegacyWsgiApp(AsyncService(), coroutine_runner=runner),
+                    Response)
+    try:
+        response = client.post('/?method=sleep', data='{"seconds": 0.01}')
+        assert response.status_code == 200
+        assert json.loads(response.get_data(as_text=True)) == u'slept'
+        with raises(ValueError):
+            client.post('/?method=fail')
+        response = client.post('/?method=sleep', data='{"seconds": 5}')
+        assert response.status_code == 504
+        # The timed out coroutine is cancelled, so that it doesn't hold
+        # the slot anymore.
+        response = client.post('/?method=sleep', data='{"seconds": 0.01}')
+        assert response.status_code == 200
+        started_at = time.time()
+        threads = [
+            threading.Thread(target=client.post, args=('/?method=sleep',),
+                             kwargs={'data': '{"seconds": 0.2}'})
+            for _ in range(3)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert time.time() - started_at >= 0.6
+    finally:
+        runner.close()
+    # The shared runner is used by default.
+    client = Client(LegacyWsgiApp(AsyncService()), Response)
+    response = client.post('/?method=sleep', data='{"seconds": 0}')
+    assert response.status_code == 200
+    assert CoroutineRunner.shared().loop is not None
+
+
+@mark.skipif(sys.version_info < (3, 5), reason='Python 3.5+ only')
+def test_coroutine_runner_without_timeout():
+    runner = CoroutineRunner(max_concurrency=1)
+    client = Client(LegacyWsgiApp(AsyncService(), coroutine_runner=runner),
+                    Response)
+    responses = []
+
+    def call():
+        responses.append(
+            client.post('/?method=sleep', data='{"seconds": 0.2}')
+        )
+    try:
+        threads = [threading.Thread(target=call) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        runner.close()
+    # Calls beyond max_concurrency wait for a slot rather than timing out.
+    assert [r.status_code for r in responses] == [200, 200]
+
+
+@mark.skipif(sys.version_info < (3, 5), reason='Python 3.5+ only')
+def test_coroutine_runner_deadline():
+    runner = CoroutineRunner()
+    app = LegacyWsgiApp(AsyncService(), coroutine_runner=runner,
+                        deadline_policy=DeadlinePolicy())
+    client = Client(app, Response)
+    try:
+        started_at = time.time()
+        response = client.post('/?method=sleep', data='{"seconds": 5}',
+                               headers={'X-Request-Timeout': '0.1'})
+        assert response.status_code == 504
+        assert time.time() - started_at < 1
+    finally:
+        runner.close()
+
+
+@mark.skipif(sys.version_info < (3, 5), reason='Python 3.5+ only')
+def test_coroutine_runner_request_context():
+    service = AsyncService()
+    runner = CoroutineRunner()
+    app = LegacyWsgiApp(service, coroutine_runner=runner,
+                        deadline_policy=DeadlinePolicy())
+    client = Client(app, Response)
+    try:
+        response = client.post('/?method=probe',
+                               headers={'X-Request-Timeout': '10'})
+        assert response.status_code == 200
+    finally:
+        runner.close()
+    first, second = service.contexts
+    assert first is second
+    assert first.service_method == 'probe'
+    assert first.deadline is not None
+
+
+class ThumbnailService(Service):
+
+    __nirum_service_methods__ = {
+        'get_thumbnail': {
+            '_v': 2,
+            '_return': lambda: bytes,
+            '_names': NameDict([('name', 'name')]),
+            'name': lambda: typing.Text,
+        },
+        'open_thumbnail': {
+            '_v': 2,
+            '_return': lambda: bytes,
+            '_names': NameDict([('name', 'name')]),
+            'name': lambda: typing.Text,
+        },
+        'find_thumbnail': {
+            '_v': 2,
+            '_return': lambda: typing.Optional[bytes],
+            '_names': NameDict([('name', 'name')]),
+            'name': lambda: typing.Text,
+        },
+        'count_thumbnails': {
+            '_v': 2,
+            '_return': lambda: int,
+            '_names': NameDict([]),
+        },
+        'put_thumbnail': {
+            '_v': 2,
+            '_return': lambda: int,
+            '_names': NameDict([('data', 'data')]),
+            'data': lambda: bytes,
+        },
+    }
+    __nirum_method_names__ = NameDict([
+        ('get_thumbnail', 'get_thumbnail'),
+        ('open_thumbnail', 'open_thumbnail'),
+        ('find_thumbnail', 'find_thumbnail'),
+        ('count_thumbnails', 'count_thumbnails'),
+        ('put_thumbnail', 'put_thumbnail'),
+    ])
+    __nirum_method_annotations__ = {
+        'get_thumbnail': {}, 'open_thumbnail': {}, 'find_thumbnail': {},
+        'count_thumbnails': {}, 'put_thumbnail': {},
+    }
+    __nirum_method_error_types__ = {}
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.uploads = []
+
+    def get_thumbnail(self, name):
+        with self.open_thumbnail(name) as f:
+            return f.read()
+
+    def open_thumbnail(self, name):
+        return open(os.path.join(self.directory, name), 'rb')
+
+    def find_thumbnail(self, name):
+        if os.path.isfile(os.path.join(self.directory, name)):
+            return self.get_thumbnail(name)
+
+    def count_thumbnails(self):
+        return len(os.listdir(self.directory))
+
+    def put_thumbnail(self, data):
+        self.uploads.append(data)
+        if isinstance(data, bytes):
+            return len(data)
+        return len(data.read())
+
+
+def test_binary_responses(tmpdir):
+    content = bytes(bytearray(range(256))) * 10
+    tmpdir.join('a.png').write_binary(content)
+    app = LegacyWsgiApp(
+        ThumbnailService(str(tmpdir)),
+        binary_responses=BinaryResponses({'open_thumbnail'}),
+        # The runtime may not validate binary.
+        validate_results=False
+    )
+    client = Client(app, Response)
+    payload = '{"name": "a.png"}'
+    # Negotiated through Accept.
+    response = client.post('/?method=get_thumbnail', data=payload)
+    assert response.status_code == 200
+    assert response.mimetype == 'application/json'
+    assert 'Accept' in response.vary
+    accept = {'Accept': 'application/octet-stream'}
+    response = client.post('/?method=get_thumbnail', data=payload,
+                           headers=accept)
+    assert response.status_code == 200
+    assert response.mimetype == 'application/octet-stream'
+    assert 'Accept' in response.vary
+    assert response.headers['Content-Length'] == str(len(content))
+    assert response.get_data() == content
+    # Methods returning other than binary are not affected.
+    response = client.post('/?method=count_thumbnails', headers=accept)
+    assert response.mimetype == 'application/json'
+    assert json.loads(response.get_data(as_text=True)) == 1
+    # A file-like result is sent through wsgi.file_wrapper.
+    wrapped = []
+
+    def file_wrapper(file_, block_size=8192):
+        wrapped.append((file_, block_size))
+        return iter(lambda: file_.read(block_size), b'')
+    response = client.post('/?method=open_thumbnail', data=payload,
+                           environ_overrides={
+                               'wsgi.file_wrapper': file_wrapper,
+                           })
+    assert response.status_code == 200
+    assert response.mimetype == 'application/octet-stream'
+    assert response.headers['Content-Length'] == str(len(content))
+    assert response.get_data() == content
+    assert [block_size for _, block_size in wrapped] == [65536]
+    response = client.post('/?method=open_thumbnail', data=payload)
+    assert response.get_data() == content
+    assert 'Accept' not in response.vary
+    # None of an optional binary is left to JSON.
+    response = client.post('/?method=find_thumbnail',
+                           data='{"name": "b.png"}', headers=accept)
+    assert response.status_code == 200
+    assert json.loads(response.get_data(as_text=True)) is None
+    with raises(TypeError):
+        LegacyWsgiApp(ThumbnailService(str(tmpdir)),
+                      binary_responses=BinaryResponses({'count_thumbnails'}))
+    with raises(TypeError):
+        BinaryResponses('get_thumbnail')
+
+
+def test_binary_responses_idempotency(tmpdir):
+    content = b'\x89PNG' * 100
+    tmpdir.join('a.png').write_binary(content)
+    app = LegacyWsgiApp(
+        ThumbnailService(str(tmpdir)),
+        binary_responses=BinaryResponses({'open_thumbnail'}),
+        idempotency_policy=IdempotencyPolicy(),
+        validate_results=False
+    )
+    client = Client(app, Response)
+    payload = '{"name": "a.png"}'
+    for replayed in [None, 'true']:
+        # File-like results are read to be stored.
+        response = client.post('/?method=open_thumbnail', data=payload,
+                               headers={'Idempotency-Key': 'open'})
+        assert response.status_code == 200
+        assert response.get_data() == content
+        assert response.headers.get('Idempotent-Replayed') == replayed
+    # Raw binary and JSON responses of the same key are stored apart.
+    for accept in ['application/octet-stream', 'application/json']:
+        response = client.post('/?method=get_thumbnail', data=payload,
+                               headers={'Idempotency-Key': 'get',
+                                        'Accept': accept})
+        assert response.status_code == 200
+        assert response.mimetype == accept
+        assert 'Idempotent-Replayed' not in response.headers
+
+
+def test_binary_uploads(tmpdir):
+    service = ThumbnailService(str(tmpdir))
+    app = LegacyWsgiApp(
+        service,
+        binary_uploads=BinaryUploads({'put_thumbnail'}, spool_threshold=100),
+        payload_limits=PayloadLimits(max_length=1000)
+    )
+    client = Client(app, Response)
+    content = bytes(bytearray(range(100)))
+    response = client.post('/?method=put_thumbnail', data=content,
+                           content_type='application/octet-stream')
+    assert response.status_code == 200
+    assert json.loads(response.get_data(as_text=True)) == 100
+    assert service.uploads[-1] == content
+    # Spooled to a temporary file above the threshold, and closed after
+    # the call.
+    response = client.post('/?method=put_thumbnail', data=content * 2,
+                           content_type='application/octet-stream')
+    assert response.status_code == 200
+    assert json.loads(response.get_data(as_text=True)) == 200
+    assert not isinstance(service.uploads[-1], bytes)
+    assert service.uploads[-1].closed
+    response = client.post('/?method=put_thumbnail', data=content * 11,
+                           content_type='application/octet-stream')
+    assert response.status_code == 413
+    assert len(service.uploads) == 2
+    # Other methods still take JSON.
+    response = client.post('/?method=count_thumbnails', data=content,
+                           content_type='application/octet-stream')
+    assert response.status_code == 400
+    with raises(TypeError):
+        LegacyWsgiApp(service,
+                      binary_uploads=BinaryUploads({'count_thumbnails'}))
+
+
+def test_binary_uploads_unknown_length():
+    uploads = BinaryUploads(set(), spool_threshold=10, chunk_size=4)
+    assert uploads.read(io.BytesIO(b'0123456789')) == b'0123456789'
+    spooled = uploads.read(io.BytesIO(b'0123456789a'))
+    assert spooled.read() == b'0123456789a'
+    spooled.close()
+
+
+class TracedMusicServiceImpl(MusicServiceImpl):
+
+    def __init__(self):
+        self.traces = []
+
+    def get_artist_by_music(self, music):
+        self.traces.append(current_request_context().trace)
+        return super(TracedMusicServiceImpl, self).get_artist_by_music(music)
+
+
+def test_tracing(tmpdir):
+    path = str(tmpdir.join('spans.jsonl'))
+    service = TracedMusicServiceImpl()
+    app = WsgiApp(service, tracing=Tracing(FileSpanExporter(path)))
+    client = Client(app, Response)
+
+    def spans():
+        with open(path) as f:
+            return [json.loads(line) for line in f]
+    response = client.post('/?method=find_artist',
+                           data='{"norae": "Elephant"}')
+    assert response.status_code == 200
+    root, phases = spans()[0], spans()[1:]
+    trace = service.traces[-1]
+    assert root['trace_id'] == trace.trace_id
+    assert root['span_id'] == trace.span_id
+    assert root['parent_id'] is None
+    assert root['name'] == 'find_artist'
+    assert root['attributes']['http.status_code'] == 200
+    assert [span['name'] for span in phases] == [
+        'parse', 'dispatch', 'decode', 'call', 'encode',
+    ]
+    assert all(span['trace_id'] == trace.trace_id and
+               span['parent_id'] == trace.span_id and
+               root['started_at'] <= span['started_at'] <=
+               span['ended_at'] <= root['ended_at']
+               for span in phases)
+    # The trace of the caller is joined.
+    traceparent = '00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01'
+    client.post('/?method=find_artist', data='{"norae": "Elephant"}',
+                headers={'traceparent': traceparent})
+    trace = service.traces[-1]
+    assert trace.trace_id == '0af7651916cd43dd8448eb211c80319c'
+    assert trace.parent_id == 'b7ad6b7169203331'
+    assert trace.traceparent == \
+        '00-0af7651916cd43dd8448eb211c80319c-{0}-01'.format(trace.span_id)
+    assert spans()[6]['parent_id'] == 'b7ad6b7169203331'
+    # Unsampled by the caller.
+    count = len(spans())
+    client.post('/?method=find_artist', data='{"norae": "Elephant"}',
+                headers={'traceparent': traceparent[:-2] + '00'})
+    assert not service.traces[-1].sampled
+    assert len(spans()) == count
+    # Unsampled by the sample rate, but the context is still propagated.
+    app.tracing.sample_rate = 0
+    client.post('/?method=find_artist', data='{"norae": "Elephant"}')
+    assert not service.traces[-1].sampled
+    assert len(spans()) == count
+    # Malformed traceparent starts a new trace.
+    app.tracing.sample_rate = 1
+    client.post('/?method=find_artist', data='{"norae": "Elephant"}',
+                headers={'traceparent': '00-xyz'})
+    assert service.traces[-1].parent_id is None
+    assert service.traces[-1].sampled
+    # Tracing is off by default.
+    service = TracedMusicServiceImpl()
+    Client(WsgiApp(service), Response).post(
+        '/?method=find_artist', data='{"norae": "Elephant"}'
+    )
+    assert service.traces == [None]
+
+
+def test_opentelemetry_span_exporter():
+    try:
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+        from opentelemetry.sdk.trace.export.in_memory_span_exporter import \
+            InMemorySpanExporter
+    except ImportError:
+        skip('opentelemetry-sdk is not installed')
+    memory = InMemorySpanExporter()
+    id_generator = OpenTelemetryIdGenerator()
+    provider = TracerProvider(id_generator=id_generator)
+    provider.add_span_processor(SimpleSpanProcessor(memory))
+    exporter = OpenTelemetrySpanExporter(provider.get_tracer(__name__),
+                                         id_generator)
+    traces = []
+
+    class TracingMusicServiceImpl(MusicServiceImpl):
+
+        def get_artist_by_music(self, music):
+            traces.append(current_request_context().trace)
+            return super(TracingMusicServiceImpl,
+                         self).get_artist_by_music(music)
+
+    client = Client(WsgiApp(TracingMusicServiceImpl(),
+                            tracing=Tracing(exporter)),
+                    Response)
+    client.post('/?method=find_artist', data='{"norae": "Elephant"}',
+                headers={'traceparent': '00-0af7651916cd43dd8448eb211c80319c'
+                                        '-b7ad6b7169203331-01'})
+    spans = memory.get_finished_spans()
+    assert len(spans) == 6
+    root = spans[-1]
+    trace, = traces
+    assert root.name == 'find_artist'
+    assert root.parent.span_id == 0xb7ad6b7169203331
+    assert root.context.span_id == int(trace.span_id, 16)
+    assert all(span.context.trace_id == 0x0af7651916cd43dd8448eb211c80319c
+               for span in spans)
+    assert all(span.parent.span_id == root.context.span_id
+               for span in spans[:-1])
+    # A new trace keeps the IDs propagated to service methods as well.
+    memory.clear()
+    client.post('/?method=find_artist', data='{"norae": "Elephant"}')
+    root = memory.get_finished_spans()[-1]
+    trace = traces[-1]
+    assert root.parent is None
+    assert root.context.trace_id == int(trace.trace_id, 16)
+    assert root.context.span_id == int(trace.span_id, 16)
+    with raises(TypeError):
+        OpenTelemetrySpanExporter(id_generator=object())
+
+
+def test_opentelemetry_span_exporter_new_ids():
+    try:
+        from opentelemetry.sdk.trace import TracerProvider
+    except ImportError:
+        skip('opentelemetry-sdk is not installed')
+    handler = ListHandler()
+    logger = logging.getLogger('nirum_wsgi')
+    logger.addHandler(handler)
+    try:
+        # The tracer provider is not configured with the ID generator.
+        exporter = OpenTelemetrySpanExporter(
+            TracerProvider().get_tracer(__name__), OpenTelemetryIdGenerator()
+        )
+        assert not handler.records
+        client = Client(WsgiApp(MusicServiceImpl(),
+                                tracing=Tracing(exporter)), Response)
+        client.get('/artists/damien/')
+        client.get('/artists/damien/')
+        record, = handler.records
+        assert record.levelno == logging.WARNING
+        handler.records[:] = []
+        OpenTelemetrySpanExporter(TracerProvider().get_tracer(__name__))
+        record, = handler.records
+        assert 'no id_generator' in record.getMessage()
+    finally:
+        logger.removeHandler(handler)
+
+
+@mark.parametrize('value, expected', [
+    ('00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01',
+     ('0af7651916cd43dd8448eb211c80319c', 'b7ad6b7169203331', True)),
+    ('00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-00',
+     ('0af7651916cd43dd8448eb211c80319c', 'b7ad6b7169203331', False)),
+    ('01-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01-future',
+     ('0af7651916cd43dd8448eb211c80319c', 'b7ad6b7169203331', True)),
+    ('ff-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01', None),
+    ('00-00000000000000000000000000000000-b7ad6b7169203331-01', None),
+    ('00-0af7651916cd43dd8448eb211c80319c-0000000000000000-01', None),
+    ('00-0AF7651916CD43DD8448EB211C80319C-b7ad6b7169203331-01', None),
+    ('', None),
+])
+def test_parse_traceparent(value, expected):
+    assert parse_traceparent(value) == expected
+
+
+def test_thread_pool_server():
+    server = ThreadPoolServer('127.0.0.1', 0, WsgiApp(MusicServiceImpl()),
+                              threads=2, keep_alive_timeout=0.5,
+                              receive_buffer_size=65536)
+    assert server.socket.getsockopt(socket.SOL_SOCKET,
+                                    socket.SO_RCVBUF) >= 65536
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        connection = http_client.HTTPConnection('127.0.0.1', server.port)
+        sockets = set()
+        # The body of the second request is left unread by the application.
+        for path, body, status_code in [
+            ('/?method=get_music_by_artist_name',
+             '{"artist_name": "damien rice"}', 200),
+            ('/artists/damien/', '{"x": 1}', 400),
+            ('/?method=get_music_by_artist_name',
+             '{"artist_name": "damien rice"}', 200),
+        ]:
+            connection.request('POST', path, body=body)
+            response = connection.getresponse()
+            assert response.status == status_code
+            response.read()
+            sockets.add(connection.sock)
+        assert len(sockets) == 1  # Kept alive
+        connection.close()
+        connection = http_client.HTTPConnection('127.0.0.1', server.port)
+        connection.putrequest('POST', '/?method=get_music_by_artist_name')
+        connection.putheader('Content-Length', 'many')
+        connection.endheaders()
+        response = connection.getresponse()
+        assert response.status == 400
+        assert response.getheader('Connection') == 'close'
+        connection.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+    assert not server._workers
+
+
+def test_resident_set_size():
+    if not os.path.isdir('/proc'):
+        skip('/proc is unavailable')
+    assert resident_set_size(os.getpid()) > 0
+    assert resident_set_size(-1) is None
+
+
+@mark.skipif(not hasattr(os, 'fork'), reason='POSIX only')
+def test_worker_supervisor():
+    app = WsgiApp(MusicServiceImpl())
+    supervisor = WorkerSupervisor(
+        lambda fd: ThreadPoolServer('127.0.0.1', 0, app, threads=2, fd=fd),
+        '127.0.0.1', 0, workers=2, max_requests=3, stagger=0
+    )
+    try:
+        supervisor.supervise()
+        pids = supervisor.pids
+        assert len(pids) == 2
+        for _ in range(12):
+            connection = http_client.HTTPConnection('127.0.0.1',
+                                                    supervisor.port)
+            connection.request('POST', '/?method=get_music_by_artist_name',
+                               body='{"artist_name": "damien rice"}')
+            assert connection.getresponse().status == 200
+            connection.close()
+            supervisor.supervise()
+        # Recycled workers are replaced, while they finish in-flight requests.
+        assert len(supervisor.pids) == 2
+        assert supervisor.pids != pids
+    finally:
+        supervisor.stop()
+    assert not supervisor._workers
+    for pid in pids:
+        with raises(OSError):
+            os.kill(pid, 0)
+
+
+def test_worker_supervisor_closes_app(tmpdir):
+    directory = str(tmpdir.join('metrics'))
+    os.mkdir(directory)
+    app = WsgiApp(MusicServiceImpl(), metrics=Metrics(directory))
+    supervisor = WorkerSupervisor(
+        lambda fd: ThreadPoolServer('127.0.0.1', 0, app, threads=2, fd=fd),
+        '127.0.0.1', 0, workers=1, max_requests=2, stagger=0
+    )
+    try:
+        supervisor.supervise()
+        for _ in range(4):
+            connection = http_client.HTTPConnection('127.0.0.1',
+                                                    supervisor.port)
+            connection.request('GET', '/artists/damien/')
+            assert connection.getresponse().status == 200
+            connection.close()
+            supervisor.supervise()
+    finally:
+        supervisor.stop()
+    # Values of recycled and stopped workers are merged into the archive,
+    # and their files are removed.
+    assert sorted(os.listdir(directory)) == [
+        'archive.lock', 'archive.metrics',
+    ]
+    assert sum(app.metrics.collect()[
+        'get_music_by_artist_name', 200
+    ][0]) == 4.0
+
+
+def test_percentile():
+    values = list(range(1, 1001))
+    assert percentile(values, 50) == 500
+    assert percentile(values, 99) == 990
+    assert percentile(values, 99.9) == 999
+    assert percentile(values, 100) == 1000
+    assert percentile(values, 0) == 1
+    assert percentile([], 50) is None
+
+
+@mark.parametrize('stub, processes', [
+    (False, False),
+    (True, False),
+    (True, True),
+])
+def test_benchmark(stub, processes):
+    benchmark = Benchmark(WsgiApp(MusicServiceImpl()), stub=stub)
+    assert benchmark.samples['routed'] == [
+        ('GET', u'/artists/nirum/', u'', None),
+    ]
+    result = benchmark.run(200, concurrency=2, processes=processes, seed=1)
+    assert len(result.latencies) == 200
+    assert sum(result.kinds.values()) == sum(result.statuses.values()) == 200
+    assert result.percentile(50) <= result.percentile(99.9)
+    if stub:
+        # Stubs return valid results, so only error requests fail.
+        assert sum(n for status, n in result.statuses.items()
+                   if status != 200) == result.kinds['error']
+    else:
+        assert 500 in result.statuses  # Unhandled exceptions
+    assert 'Throughput:' in result.report()
+
+
+def test_benchmark_invalid_mix():
+    with raises(ValueError):
+        Benchmark(WsgiApp(MusicServiceImpl()), mix={'unknown': 1})
+    with raises(ValueError):
+        Benchmark(WsgiApp(MusicServiceImpl()), mix={'rpc': 0})
+
+
+def test_bench_command(capsys):
+    main(['bench', '-n', '30', '--mix', 'rpc=1', '--stub',
+          'tests:MusicServiceImpl()'])
+    out, _ = capsys.readouterr()
+    assert 'Requests:    30 (rpc 30)' in out
+    assert 'Statuses:    200 30' in out
+
+
+def test_traffic_capture(tmpdir):
+    path = str(tmpdir.join('capture.jsonl'))
+    # Every file can have only a record.
+    capture = TrafficCapture(path, sample_rate=1.0, max_bytes=256,
+                             backup_count=2)
+    app = WsgiApp(MusicServiceImpl(), traffic_capture=capture)
+    client = Client(app, Response)
+    for _ in range(4):
+        response = client.post(
+            '/?method=get_music_by_artist_name',
+            data=json.dumps({'artist_name': u'damien rice'}),
+            headers={'Authorization': 'secret', 'X-Test': 'yes'}
+        )
+        assert response.status_code == 200
+        assert json.loads(response.get_data(as_text=True)) == [
+            u'9 crimes', u'Elephant',
+        ]
+    response = client.get('/artists/damien/')
+    assert response.status_code == 200
+    capture.close()
+    paths = [path + '.2', path + '.1', path]
+    assert all(tmpdir.join(p.rsplit('/', 1)[-1]).check() for p in paths)
+    records = list(load_traffic(paths))
+    assert len(records) == 3  # The oldest ones are rotated out
+    assert records[0]['headers']['X-Test'] == 'yes'
+    assert 'Authorization' not in records[0]['headers']
+    assert records[-1]['method'] == 'GET'
+    assert records[-1]['path'] == '/artists/damien/'
+    # Replayed on the same service
+    result = replay_traffic(WsgiApp(MusicServiceImpl()), records)
+    assert len(result.latencies) == len(records)
+    assert not result.mismatches
+
+    # Replayed on a service which behaves differently
+    class EmptyMusicServiceImpl(MusicServiceImpl):
+        music_map = {}
+
+    result = replay_traffic(WsgiApp(EmptyMusicServiceImpl()), records)
+    assert len(result.mismatches) == len(records)
+    assert 'Mismatches:' in result.report()
+    assert main(['replay', 'tests:MusicServiceImpl()'] + paths) == 0
+
+
+def test_traffic_capture_uncaptured(tmpdir):
+    path = str(tmpdir.join('capture.jsonl'))
+    capture = TrafficCapture(path, sample_rate=1.0, max_response_size=16)
+    app = WsgiApp(MusicServiceImpl(), traffic_capture=capture,
+                  bulk_calls=BulkCalls(['get_music_by_artist_name']))
+    client = Client(app, Response)
+    # A large response
+    response = client.post('/?method=get_music_by_artist_name',
+                           data=json.dumps({'artist_name': u'damien rice'}))
+    assert json.loads(response.get_data(as_text=True)) == [
+        u'9 crimes', u'Elephant',
+    ]
+    # A streamed response
+    response = client.post('/?method=get_music_by_artist_name',
+                           data=b'{"artist_name": "damien"}\n' * 2,
+                           content_type='application/x-ndjson')
+    assert len(response.get_data().splitlines()) == 2
+    # A body of unknown length is left as it is.
+    environ = create_environ('/?method=get_music_by_artist_name',
+                             method='POST',
+                             data=json.dumps({'artist_name': u'damien'}))
+    del environ['CONTENT_LENGTH']
+    environ['wsgi.input_terminated'] = True
+    response = Response.from_app(app, environ)
+    assert json.loads(response.get_data(as_text=True)) == [u'rice']
+    response = client.get('/artists/damien/')
+    assert response.status_code == 200
+    capture.close()
+    # A line truncated by a crash is skipped.
+    with open(path, 'ab') as f:
+        f.write(b'{"time": ')
+    record, = load_traffic([path])
+    assert record['path'] == '/artists/damien/'
+
+
+def test_main_services(monkeypatch):
+    served = []
+    monkeypatch.setattr('nirum_wsgi.run_simple',
+                        lambda host, port, app, **kwargs: served.append(app))
+    # Keyword arguments of a single import path are not a mount name.
+    main(['tests:ThumbnailService(directory="thumbnails")'])
+    app = served.pop()
+    assert isinstance(app, WsgiApp)
+    assert app.service.directory == 'thumbnails'
+    main(['music=tests:MusicServiceImpl()',
+          'thumbnails=tests:ThumbnailService(directory="a=b")'])
+    app = served.pop()
+    assert isinstance(app, CompositeWsgiApp)
+    assert app.mounts['thumbnails'].service.directory == 'a=b'
+    with raises(SystemExit):
+        main(['music=tests:MusicServiceImpl()', 'tests:MusicServiceImpl()'])
+
+
+def test_metrics(tmpdir):
+    metrics = Metrics(str(tmpdir), buckets=[0.5, 10])
+    app = WsgiApp(MusicServiceImpl(), metrics=metrics)
+    client = Client(app, Response)
+
+    def call(times):
+        for _ in range(times):
+            client.get('/artists/damien/')
+            client.post('/?method=no_such_method')
+
+    call(2)
+    # A worker process which exits
+    worker = multiprocessing.Process(
+        target=lambda: (call(3), metrics.close())
+    )
+    worker.start()
+    worker.join()
+    # Threads which exit, and whose slots are reused
+    for _ in range(3):
+        thread = threading.Thread(target=call, args=(1,))
+        thread.start()
+        thread.join()
+    assert len(metrics._shards) <= 2
+    assert sorted(os.listdir(str(tmpdir))) == [
+        '{0}.metrics'.format(os.getpid()), 'archive.lock', 'archive.metrics',
+    ]
+    response = client.get('/_metrics',
+                          environ_base={'REMOTE_ADDR': '127.0.0.1'})
+    assert response.status_code == 200
+    exposition = response.get_data(as_text=True)
+    name = 'nirum_request_duration_seconds'
+    for labels in ['method="get_music_by_artist_name",status="200"',
+                   'method="",status="400"']:
+        assert '{0}_bucket{{{1},le="10.0"}} 8.0'.format(name, labels) \
+            in exposition
+        assert '{0}_bucket{{{1},le="+Inf"}} 8.0'.format(name, labels) \
+            in exposition
+        assert '{0}_count{{{1}}} 8.0'.format(name, labels) in exposition
+    metrics.close()
+    assert sorted(os.listdir(str(tmpdir))) == [
+        'archive.lock', 'archive.metrics',
+    ]
+    assert metrics.collect()['', 400][0][0] == 8.0
+
+
+def test_metrics_authorize(tmpdir):
+    def get(metrics, authorization=None):
+        client = Client(WsgiApp(MusicServiceImpl(), metrics=metrics),
+                        Response)
+        headers = {}
+        if authorization is not None:
+            headers['Authorization'] = authorization
+        return client.get('/_metrics', headers=headers,
+                          environ_base={'REMOTE_ADDR': '192.0.2.1'})
+    metrics = Metrics(str(tmpdir), allowed_addresses=None, token='s3cret')
+    assert get(metrics, 'Bearer s3cret').status_code == 200
+    assert get(metrics).status_code == 403
+    assert get(metrics, 'Bearer wrong').status_code == 403
+    # Only the loopback addresses are allowed by default.
+    assert get(Metrics(str(tmpdir))).status_code == 403